@@ -1,5 +1,7 @@
 #!/bin/bash
 # this script is used as the entrypoint of a Docker container
 source venv/bin/activate
+# the flask commands use the production app, like gunicorn
+export FLASK_APP=wsgi.py
 flask db upgrade
-exec gunicorn -b :5000 --access-logfile - --error-logfile - run:app
+exec gunicorn -c gunicorn_config.py
@@ -0,0 +1,125 @@
+"""
+The gunicorn settings used to serve the application in production
+
+---
+
+Examples
+--------
+    Change directory to the app's top level directory, and hit:
+
+        $ gunicorn -c gunicorn_config.py
+
+    Every setting can be overridden by its GUNICORN_* env variable,
+    i.e. GUNICORN_WORKERS=4 GUNICORN_THREADS=8.
+
+Attributes
+----------
+workers : int
+    one worker process per usable cpu core
+threads : int
+    request threads per worker, they overlap db/elastic/mail waits
+preload_app : bool
+    create the app once in the master, workers share it copy-on-write
+max_requests, max_requests_jitter : int
+    recycle workers after a random number of requests around
+    max_requests, so they don't all restart at the same time
+
+Functions
+---------
+when_ready(server): return None
+    refuse workers which share nothing, compile the templates, clear
+    the metrics of the last run, and freeze the master's objects,
+    before workers are forked
+post_fork(server, worker): return None
+    give the new worker its own connections, and metrics file
+worker_exit(server, worker): return None
+    write the last metrics of the worker, before it exits
+child_exit(server, worker): return None
+    fold the metrics of an exited worker into the totals
+"""
+
+import gc
+import os
+import sys
+
+
+def _env(name, default):
+    """Return the GUNICORN_<name> env variable as an int, or default."""
+    return int(os.environ.get(f'GUNICORN_{name}', default))
+
+
+def _cpu_count():
+    """Return the number of cores this process may run on."""
+    try:
+        return len(os.sched_getaffinity(0))  # honors container limits
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+wsgi_app = 'wsgi:app'  # ProductionConfig, run.py's app is for development
+bind = os.environ.get('GUNICORN_BIND', ':5000')
+accesslog = '-'
+errorlog = '-'
+
+workers = _env('WORKERS', max(2, _cpu_count()))
+threads = _env('THREADS', 4)
+worker_class = 'gthread'
+worker_tmp_dir = '/dev/shm'  # heartbeat file off the (overlay) disk
+preload_app = True
+
+keepalive = _env('KEEPALIVE', 5)
+timeout = _env('TIMEOUT', 30)
+graceful_timeout = _env('GRACEFUL_TIMEOUT', 20)
+max_requests = _env('MAX_REQUESTS', 2000)
+max_requests_jitter = _env('MAX_REQUESTS_JITTER', 200)
+
+
+def when_ready(server):
+    """Compile the templates, clear old metrics, freeze the master.
+
+    Several workers without a shared store would each keep their own
+    rate limits and content versions, so caches wouldn't see the
+    changes made through other workers: refuse to start then.
+    The preloaded app lives in the master's memory, and forked workers
+    share its pages until they're written to. Compiling the templates
+    here spares every new worker from compiling them on its first
+    requests. The garbage collector writes to every object it tracks,
+    which copies the pages over. Moving the objects into the permanent
+    generation avoids that.
+    """
+
+    from personal_blog.metrics import clear
+    from personal_blog.templating import precompile_templates
+    app = server.app.wsgi()
+    if server.cfg.workers > 1 and not app.config['SHARED_STORE_PATH']:
+        server.log.error('%s workers need SHARED_STORE_PATH, set it (or '
+                         'serve wsgi:app, with ProductionConfig)',
+                         server.cfg.workers)
+        sys.exit(1)
+    precompile_templates(app)
+    if app.config['METRICS_PATH']:
+        clear(app.config['METRICS_PATH'])  # the workers of the last run
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    """Give the new worker its own connections, and metrics file."""
+    from personal_blog import reset_after_fork
+    from personal_blog.metrics import start_flusher
+    reset_after_fork(server.app.wsgi())
+    start_flusher(server.app.wsgi())
+
+
+def worker_exit(server, worker):
+    """Write the last metrics of the worker, before it exits."""
+    from personal_blog.metrics import flush, registry
+    if registry.path:
+        flush(registry.path)
+
+
+def child_exit(server, worker):
+    """Fold the metrics of an exited worker into the totals."""
+    from personal_blog.metrics import mark_process_dead
+    path = server.app.wsgi().config['METRICS_PATH']
+    if path:
+        mark_process_dead(path, worker.pid)
@@ -3,42 +3,47 @@ suggests, building a simple personal blog/profile website.
 
 Objects
 -------
-    db : SQLAlchemy
-        the database instance of the application
-    migrate: Migrate
-        a tool used for database migrations
-    bcrypt: Bcrypt
-        a tool used for encrypting/decripting
+    db : RoutingSQLAlchemy
+        the database instance of the application,
+        routes reads to a replica database if there's one
+    migrate: LazyMigrate
+        a tool used for database migrations, imported on first use
     ckeditor : CKEditor
         a tool used as text area editor
     login_manager : LoginManager
         a tool used for managing logged in sessions
-    mail : Mail
-        a tool used for sending emails
+    mail : LazyMail
+        a tool used for sending emails, imported on first use
+    store : SharedStore
+        a tool used for sharing counters and rate limits between workers
 
 Functions
 ---------
     create_app : returns a Flask instance
         used for creating and initializing an application instance
+    reset_after_fork : returns None
+        used for giving a forked worker its own connections
 """
 
-from elasticsearch import Elasticsearch
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
-from flask_bcrypt import Bcrypt
 from flask_login import LoginManager
 from flask_ckeditor import CKEditor
-from flask_mail import Mail
-from flask_migrate import Migrate
 
 from personal_blog.config import DevelopmentConfig
-
-db = SQLAlchemy()
-migrate = Migrate()
-bcrypt = Bcrypt()
+from personal_blog.lazy import LazyMail, LazyMigrate
+from personal_blog.metrics import init_metrics
+from personal_blog.profiling import init_profiling
+from personal_blog.routing import RoutingSQLAlchemy
+from personal_blog.search import init_elasticsearch
+from personal_blog.store import SharedStore
+from personal_blog.templating import init_templates
+
+db = RoutingSQLAlchemy()
+migrate = LazyMigrate()
 ckeditor = CKEditor()
 login_manager = LoginManager()
-mail = Mail()
+mail = LazyMail()
+store = SharedStore()
 
 login_manager.login_view = 'users.login'
 login_manager.login_message_category = 'info'  # bootstrap class
@@ -51,7 +56,10 @@ def create_app(config_class=DevelopmentConfig):
     Load the passed configuration.
     Add elasticsearch instance attribute if possible.
     Initialize instances of flask extensions.
+    Share compiled templates through the bytecode cache, if set.
+    Record the metrics of the requests, profile them on demand.
     Import and register blueprints.
+    Register the custom CLI commands.
 
     ---
 
@@ -71,18 +79,17 @@ def create_app(config_class=DevelopmentConfig):
 
     app.config.from_object(config_class(app.root_path))
 
-    if app.config['ELASTICSEARCH_URL']:
-        es = Elasticsearch([app.config['ELASTICSEARCH_URL']])
-        app.elasticsearch = es if es.ping() else None
-    else:
-        app.elasticsearch = None
+    init_elasticsearch(app)
 
     db.init_app(app)
     migrate.init_app(app, db)
-    bcrypt.init_app(app)
     ckeditor.init_app(app)
     login_manager.init_app(app)
     mail.init_app(app)
+    store.init_app(app)
+    init_templates(app)
+    init_metrics(app)
+    init_profiling(app)
 
     with app.app_context():
         from personal_blog.main.routes import main
@@ -91,10 +98,42 @@ def create_app(config_class=DevelopmentConfig):
     from personal_blog.posts.routes import posts
     from personal_blog.books.routes import books
     from personal_blog.errors.handlers import errors
+    from personal_blog.admin.routes import admin
+    from personal_blog.api.routes import api
     app.register_blueprint(main)
     app.register_blueprint(users)
     app.register_blueprint(posts)
     app.register_blueprint(books)
     app.register_blueprint(errors)
+    app.register_blueprint(admin)
+    app.register_blueprint(api)
+
+    from personal_blog.commands import commands
+    for command in commands:
+        app.cli.add_command(command)
 
     return app
+
+
+def reset_after_fork(app):
+    """Give a forked worker its own connections.
+
+    Called by gunicorn in every worker, right after it's forked off
+    the master, which has already created the app (preload_app).
+    Sockets inherited from the master must not be shared, so dispose
+    the pooled db connections, and recreate the elasticsearch client
+    and the mail state. They reconnect lazily, on first use.
+
+    ---
+
+    Parameters
+    ----------
+    app: Flask instance
+        the application preloaded by the master process
+    """
+
+    with app.app_context():
+        for bind in [None] + list(app.config.get('SQLALCHEMY_BINDS') or ()):
+            db.get_engine(app, bind).dispose()
+    init_elasticsearch(app)
+    mail.init_app(app)
@@ -0,0 +1,108 @@
+"""Module containing route functions for the admin blueprint.
+
+---
+
+Functions
+---------
+export(): return streamed http response
+    the route for downloading a backup of all content
+profiles(): return http response
+    the route for listing the latest request profiles
+profile(filename): return http response
+    the route for downloading a request profile
+"""
+
+from datetime import datetime
+
+from flask import Blueprint, Response, abort, request, stream_with_context,\
+    render_template, current_app, send_from_directory
+from flask_login import current_user, login_required
+
+from personal_blog.backup import export_lines, gzip_chunks
+from personal_blog.profiling import SUFFIXES, list_profiles
+
+admin = Blueprint('admin', __name__)
+
+
+@admin.route("/admin/export")
+@login_required
+def export():
+    """The route function for downloading a backup of all content.
+
+    If the current user isn't admin, return a 403.
+    Stream the NDJSON export (see the backup module) as a file
+    attachment, gzipped if the gzip query argument is set.
+    The response is generated while it's sent, so the export is
+    never held in memory.
+
+    ---
+
+    Returns
+    -------
+    streamed http response
+    """
+
+    if not current_user.is_admin:  # only the admin exports content
+        abort(403)
+    filename = f"blog-{datetime.utcnow():%Y%m%d-%H%M%S}.ndjson"
+    lines = export_lines()
+    if request.args.get('gzip', type=int):
+        body, mimetype = gzip_chunks(lines), 'application/gzip'
+        filename += '.gz'
+    else:
+        body, mimetype = lines, 'application/x-ndjson'
+    return Response(stream_with_context(body), mimetype=mimetype,
+                    headers={'Content-Disposition':
+                             f'attachment; filename={filename}'})
+
+
+@admin.route("/admin/profiles")
+@login_required
+def profiles():
+    """The route function for listing the latest request profiles.
+
+    If the current user isn't admin, return a 403.
+    Requests are profiled when the admin sends them with the
+    X-Profile: 1 header, or the _profile=1 query argument (see the
+    profiling module).
+
+    ---
+
+    Returns
+    -------
+    http response
+    """
+
+    if not current_user.is_admin:
+        abort(403)
+    return render_template(
+        'admin/profiles.html', title='Profiles',
+        profiles=list_profiles(current_app.config['PROFILE_PATH']))
+
+
+@admin.route("/admin/profiles/<filename>")
+@login_required
+def profile(filename):
+    """The route function for downloading a request profile.
+
+    If the current user isn't admin, or the file isn't a profile,
+    return a 403 or a 404.
+
+    ---
+
+    Parameters
+    ----------
+    filename: str
+        the name of the profile, followed by .pstats or .collapsed
+
+    Returns
+    -------
+    http response, the file as an attachment
+    """
+
+    if not current_user.is_admin:
+        abort(403)
+    if not filename.endswith(SUFFIXES):
+        abort(404)
+    return send_from_directory(current_app.config['PROFILE_PATH'], filename,
+                               as_attachment=True)
@@ -0,0 +1,245 @@
+"""Module containing route functions for the api blueprint.
+
+A read-only JSON api, versioned by its url prefix (/api/v1).
+Lists are paginated by cursor: a page comes with the cursor of the
+next one (null on the last page), passed back as the after argument.
+Every route accepts a fields argument (i.e. fields=id,title), to get
+only some fields of the records.
+
+---
+
+Functions
+---------
+api_error(error): return json response
+    the error handler of the api routes
+posts_list(): return json response
+    the route for the latest posts, optionally with a tag
+post_detail(post_id): return json response
+    the route for a single post
+tags_list(): return json response
+    the route for the tag names, with their number of posts
+books_list(): return json response
+    the route for the books
+book_detail(book_id): return json response
+    the route for a single book
+"""
+
+from datetime import datetime
+
+from flask import Blueprint, jsonify, request, abort
+
+from personal_blog import db
+from personal_blog.api.utilities import POST_FIELDS, BOOK_FIELDS,\
+    parse_fields, parse_limit, serialize, add_tags, cached_response
+from personal_blog.cursors import encode_cursor, decode_cursor
+from personal_blog.models import Post, Tag, Book
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+POST_DEFAULT_FIELDS = ['id', 'title', 'date_posted', 'comment_count',
+                       'tags']
+BOOK_DEFAULT_FIELDS = ['id', 'title', 'authors', 'edition']
+
+
+@api.errorhandler(400)
+@api.errorhandler(404)
+def api_error(error):
+    """The error handler of the api routes.
+
+    Return the error as JSON, instead of an html page.
+    """
+
+    return jsonify(error=error.name, message=error.description), error.code
+
+
+def _columns(fields, columns):
+    """Return the columns to select for the fields (tags aside)."""
+    return [columns[name] for name in fields if name != 'tags']
+
+
+def _decode(types):
+    """Decode the after argument, return None if missing, 400 if bad."""
+    after = request.args.get('after')
+    if not after:
+        return None
+    try:
+        return decode_cursor(after, types)
+    except ValueError:
+        abort(400, 'Malformed cursor')
+
+
+@api.route("/posts")
+def posts_list():
+    """The route function for the latest posts, optionally with a tag.
+
+    Posts are ordered from newest to oldest, by (date_posted, id),
+    and filtered by the tag argument if it's set.
+
+    ---
+
+    Returns
+    -------
+    json response, with data (list) and next (cursor) keys
+    """
+
+    fields = parse_fields(POST_FIELDS, POST_DEFAULT_FIELDS)
+    limit = parse_limit()
+    after = _decode((datetime, int))
+    tag = request.args.get('tag')
+
+    def build():
+        query = db.session.query(Post.date_posted,
+                                 *_columns(fields, POST_FIELDS))
+        if tag:
+            query = query.join(Tag, Tag.post_id == Post.id).filter(
+                Tag.content == tag)
+        if after:
+            date_posted, post_id = after
+            query = query.filter(db.or_(
+                Post.date_posted < date_posted,
+                db.and_(Post.date_posted == date_posted,
+                        Post.id < post_id)))
+        rows = query.order_by(Post.date_posted.desc(),
+                              Post.id.desc()).limit(limit + 1).all()
+        items = serialize((row[1:] for row in rows[:limit]), fields)
+        if 'tags' in fields:
+            add_tags(items)
+        last = rows[limit - 1] if len(rows) > limit else None
+        return {'data': items,
+                'next': encode_cursor(last[0], last[1]) if last else None}
+
+    return cached_response(
+        'version:posts',
+        lambda body: ['posts'] + [f"post-{item['id']}"
+                                  for item in body['data']],
+        build)
+
+
+@api.route("/posts/<int:post_id>")
+def post_detail(post_id):
+    """The route function for a single post.
+
+    All of its fields are returned, unless fields is set.
+    Return a 404 if there's no post with that id.
+
+    ---
+
+    Parameters
+    ----------
+    post_id: int
+        the id of the post
+
+    Returns
+    -------
+    json response, with a data (dict) key
+    """
+
+    fields = parse_fields(POST_FIELDS, POST_FIELDS)
+
+    def build():
+        row = db.session.query(*_columns(fields, POST_FIELDS)).filter(
+            Post.id == post_id).first()
+        if row is None:
+            return None
+        items = serialize([row], fields)
+        if 'tags' in fields:
+            add_tags(items)
+        return {'data': items[0]}
+
+    return cached_response(f'version:post:{post_id}',
+                           lambda body: [f'post-{post_id}'], build)
+
+
+@api.route("/tags")
+def tags_list():
+    """The route function for the tag names, with their number of posts.
+
+    Tags are ordered by name.
+
+    ---
+
+    Returns
+    -------
+    json response, with data (list) and next (cursor) keys
+    """
+
+    limit = parse_limit()
+    after = _decode((str,))
+
+    def build():
+        query = db.session.query(Tag.content, db.func.count(Tag.post_id))
+        if after:
+            query = query.filter(Tag.content > after[0])
+        rows = query.group_by(Tag.content).order_by(Tag.content).limit(
+            limit + 1).all()
+        items = [{'name': name, 'posts': count}
+                 for name, count in rows[:limit]]
+        next_cursor = encode_cursor(items[-1]['name']) \
+            if len(rows) > limit else None
+        return {'data': items, 'next': next_cursor}
+
+    return cached_response('version:posts', lambda body: ['tags'], build)
+
+
+@api.route("/books")
+def books_list():
+    """The route function for the books.
+
+    Books are ordered by id.
+
+    ---
+
+    Returns
+    -------
+    json response, with data (list) and next (cursor) keys
+    """
+
+    fields = parse_fields(BOOK_FIELDS, BOOK_DEFAULT_FIELDS)
+    limit = parse_limit()
+    after = _decode((int,))
+
+    def build():
+        query = db.session.query(*_columns(fields, BOOK_FIELDS))
+        if after:
+            query = query.filter(Book.id > after[0])
+        rows = query.order_by(Book.id).limit(limit + 1).all()
+        items = serialize(rows[:limit], fields)
+        next_cursor = encode_cursor(items[-1]['id']) \
+            if len(rows) > limit else None
+        return {'data': items, 'next': next_cursor}
+
+    return cached_response(
+        'version:books',
+        lambda body: ['books'] + [f"book-{item['id']}"
+                                  for item in body['data']],
+        build)
+
+
+@api.route("/books/<int:book_id>")
+def book_detail(book_id):
+    """The route function for a single book.
+
+    All of its fields are returned, unless fields is set.
+    Return a 404 if there's no book with that id.
+
+    ---
+
+    Parameters
+    ----------
+    book_id: int
+        the id of the book
+
+    Returns
+    -------
+    json response, with a data (dict) key
+    """
+
+    fields = parse_fields(BOOK_FIELDS, BOOK_FIELDS)
+
+    def build():
+        row = db.session.query(*_columns(fields, BOOK_FIELDS)).filter(
+            Book.id == book_id).first()
+        return {'data': serialize([row], fields)[0]} if row else None
+
+    return cached_response('version:books',
+                           lambda body: [f'book-{book_id}'], build)
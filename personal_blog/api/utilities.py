@@ -0,0 +1,178 @@
+"""Module containing utility functions for the api blueprint.
+
+The api reads columns, not ORM objects: a query selects only the
+columns of the requested fields, and rows are turned into dicts.
+Responses are cached in the worker under the version of the content
+they're made of (see models.bump_post_versions()), so a repeated
+read costs no query, and carry the headers edge caches work with.
+
+---
+
+Functions
+---------
+parse_fields(fields, default): return list
+    the requested fields, from the fields query argument
+parse_limit(): return int
+    the requested page size, from the limit query argument
+serialize(rows, fields): return list
+    turn query rows into dicts of JSON values
+add_tags(items): return None
+    add the tag names of posts, in one query
+cached_response(version_key, surrogate_keys, build): return response
+    serve a JSON body from the cache, or build it, with cache headers
+
+Attributes
+----------
+POST_FIELDS, BOOK_FIELDS: dict
+    field name: column, of the fields clients may ask for
+"""
+
+import hashlib
+import json
+from datetime import datetime
+
+from flask import abort, current_app, request
+
+from personal_blog import db, store
+from personal_blog.cache import api_cache
+from personal_blog.models import Post, Tag, Book
+
+POST_FIELDS = {'id': Post.id, 'title': Post.title,
+               'date_posted': Post.date_posted, 'content': Post.content,
+               'user_id': Post.user_id, 'comment_count': Post.comment_count,
+               'last_comment_at': Post.last_comment_at,
+               'tags': None}  # tags are fetched by add_tags()
+BOOK_FIELDS = {'id': Book.id, 'title': Book.title, 'authors': Book.authors,
+               'edition': Book.edition, 'link': Book.link,
+               'description': Book.description}
+
+
+def parse_fields(fields, default):
+    """Return the requested fields, from the fields query argument.
+
+    Return a 400 if a field is unknown. The id is always included,
+    since cursors and surrogate keys are made of it.
+
+    ---
+
+    Parameters
+    ----------
+    fields: dict
+        field name: column, of the resource
+    default: list of str
+        the fields returned if none are requested
+
+    Returns
+    -------
+    list of field names
+    """
+
+    requested = request.args.get('fields')
+    names = requested.split(',') if requested else list(default)
+    if any(name not in fields for name in names):
+        abort(400, 'Unknown field')
+    return ['id'] + [name for name in dict.fromkeys(names) if name != 'id']
+
+
+def parse_limit():
+    """Return the requested page size, from the limit query argument."""
+    limit = request.args.get('limit', current_app.config['API_PER_PAGE'],
+                             type=int)
+    return max(1, min(limit, current_app.config['API_MAX_LIMIT']))
+
+
+def serialize(rows, fields):
+    """Turn query rows into dicts of JSON values.
+
+    ---
+
+    Parameters
+    ----------
+    rows: iterable of tuples
+        query rows, with a value per field (tags aside)
+    fields: list of str
+        the field names, in the order of the row values
+
+    Returns
+    -------
+    list of dicts
+    """
+
+    names = [name for name in fields if name != 'tags']
+    items = []
+    for row in rows:
+        item = {}
+        for name, value in zip(names, row):
+            item[name] = value.isoformat() if isinstance(value, datetime) \
+                else value
+        items.append(item)
+    return items
+
+
+def add_tags(items):
+    """Add the tag names of posts, in one query.
+
+    ---
+
+    Parameters
+    ----------
+    items: list of dicts
+        serialized posts, each gets a sorted tags list
+    """
+
+    tags = {item['id']: [] for item in items}
+    if tags:
+        for post_id, content in db.session.query(
+                Tag.post_id, Tag.content).filter(Tag.post_id.in_(tags)):
+            tags[post_id].append(content)
+    for item in items:
+        item['tags'] = sorted(tags[item['id']])
+
+
+def cached_response(version_key, surrogate_keys, build):
+    """Serve a JSON body from the cache, or build it, with cache headers.
+
+    The body is cached under the request's path and query string, and
+    is valid as long as the content version hasn't changed. The ETag
+    is a strong one, the hash of the body, so that every worker gives
+    the same ETag for the same body. A request whose If-None-Match
+    matches gets a 304. Surrogate-Key lists the keys an edge cache
+    can purge the response by (i.e. 'posts post-3').
+
+    ---
+
+    Parameters
+    ----------
+    version_key: str
+        the store key of the version of the content
+    surrogate_keys: callable
+        called with the body (dict), returns the list of keys
+    build: callable
+        called with no arguments, returns the body (dict), or None
+        for a 404
+
+    Returns
+    -------
+    http response
+    """
+
+    version = store.get(version_key)
+    key = request.full_path
+    cached = api_cache.get(key)
+    if cached is None or cached[0] != version:
+        body = build()
+        if body is None:
+            abort(404)
+        data = json.dumps(body, separators=(',', ':'),
+                          sort_keys=True).encode('utf-8')
+        cached = (version, data, hashlib.sha1(data).hexdigest(),
+                  ' '.join(surrogate_keys(body)))
+        api_cache.set(key, cached, current_app.config['API_CACHE_TTL'])
+    _, data, etag, keys = cached
+    response = current_app.response_class(data, mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config['API_MAX_AGE']
+    response.headers['Surrogate-Key'] = keys
+    response.vary.add('Accept-Encoding')
+    return response.make_conditional(request)
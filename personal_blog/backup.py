@@ -0,0 +1,206 @@
+"""A module used to export all content as NDJSON, and restore it.
+
+The export is one JSON object per line: a header line, then a line
+per record, i.e. {"table": "post", "row": {...}}. Records are read
+in primary key order, through a server side cursor where the driver
+has one, fetching a chunk at a time, so memory stays flat whatever
+the size of the database. Users are exported without their password
+hashes.
+
+---
+
+Functions
+---------
+export_lines(chunk_size): return generator of str
+    yield the NDJSON lines of every exported table
+gzip_chunks(lines): return generator of bytes
+    compress lines into a gzip stream, on the fly
+restore(lines, batch_size): return dict
+    insert the records of an export into empty tables, in bulk
+
+Attributes
+----------
+TABLES: list
+    the exported tables, parents first
+FORMAT_VERSION: int
+    the version of the export format, written in the header line
+"""
+
+import json
+import zlib
+from datetime import datetime
+from itertools import islice
+from secrets import token_hex
+
+from personal_blog import db, store
+from personal_blog.models import User, Post, Tag, Comment, Book,\
+    bump_post_versions
+from personal_blog.users.utilities import hash_password
+
+TABLES = [User.__table__, Post.__table__, Tag.__table__,
+          Comment.__table__, Book.__table__]
+FORMAT_VERSION = 1
+
+# table name: columns which are never exported
+_EXCLUDED = {'user': {'password'}}
+
+
+def _columns(table):
+    """Return the exported columns of a table."""
+    excluded = _EXCLUDED.get(table.name, ())
+    return [column for column in table.columns if column.name not in excluded]
+
+
+def _encode(value):
+    """Make a column value JSON serializable."""
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def export_lines(chunk_size=1000):
+    """Yield the NDJSON lines of every exported table.
+
+    Needs an app context for as long as it's consumed (use
+    stream_with_context() in a response).
+
+    ---
+
+    Parameters
+    ----------
+    chunk_size: int
+        the number of rows fetched from the cursor at a time
+
+    Yields
+    ------
+    str, a JSON object followed by a newline
+    """
+
+    yield json.dumps({'format': 'personal_blog', 'version': FORMAT_VERSION,
+                      'exported_at': datetime.utcnow().isoformat(),
+                      'tables': [table.name for table in TABLES]}) + '\n'
+    connection = db.engine.connect().execution_options(stream_results=True)
+    try:
+        for table in TABLES:
+            columns = _columns(table)
+            names = [column.name for column in columns]
+            result = connection.execute(
+                db.select(columns).order_by(*table.primary_key.columns))
+            rows = result.fetchmany(chunk_size)
+            while rows:
+                for row in rows:
+                    record = {name: _encode(value)
+                              for name, value in zip(names, row)}
+                    yield json.dumps({'table': table.name,
+                                      'row': record}) + '\n'
+                rows = result.fetchmany(chunk_size)
+            result.close()
+    finally:
+        connection.close()
+
+
+def gzip_chunks(lines, level=6):
+    """Compress lines into a gzip stream, on the fly.
+
+    ---
+
+    Parameters
+    ----------
+    lines: iterable of str
+        i.e. the output of export_lines()
+    level: int
+        the compression level, from 1 (fast) to 9 (small)
+
+    Yields
+    ------
+    bytes, the gzip stream in pieces
+    """
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for line in lines:
+        chunk = compressor.compress(line.encode('utf-8'))
+        if chunk:
+            yield chunk
+    yield compressor.flush()
+
+
+def _decode(table, row):
+    """Turn the JSON values of a record back into column values."""
+    for column in table.columns:
+        value = row.get(column.name)
+        if value is not None and isinstance(column.type, db.DateTime):
+            row[column.name] = datetime.fromisoformat(value)
+    return row
+
+
+def _reset_sequences(connection):
+    """Move the id sequences past the restored ids (postgres)."""
+    if connection.dialect.name != 'postgresql':
+        return
+    for table in TABLES:
+        connection.execute(
+            f"SELECT setval(pg_get_serial_sequence('\"{table.name}\"', "
+            f"'id'), coalesce(max(id), 1)) FROM \"{table.name}\"")
+
+
+def restore(lines, batch_size=1000):
+    """Insert the records of an export into empty tables, in bulk.
+
+    The ids are kept, so the records still point to each other.
+    Password hashes aren't exported, so restored users get the hash
+    of a random secret: they have to reset their password.
+    Everything is inserted in one transaction, rolled back on error.
+
+    ---
+
+    Parameters
+    ----------
+    lines: iterable of str
+        the lines of an export, i.e. an open file
+    batch_size: int
+        the number of records per insert statement
+
+    Raises
+    ------
+    ValueError
+        if the export is malformed, or the tables aren't empty
+
+    Returns
+    -------
+    dict, table name: number of restored records
+    """
+
+    lines = iter(lines)
+    header = json.loads(next(lines, '{}'))
+    if header.get('format') != 'personal_blog' or \
+            header.get('version') != FORMAT_VERSION:
+        raise ValueError('Not a personal_blog export of a known version')
+    tables = {table.name: table for table in TABLES}
+    counts = dict.fromkeys(tables, 0)
+    password = hash_password(token_hex(16))
+    with db.engine.begin() as connection:
+        for table in TABLES:
+            if connection.execute(
+                    db.select([db.func.count()]).select_from(table)).scalar():
+                raise ValueError(f'Table {table.name} isn\'t empty')
+        records = (json.loads(line) for line in lines if line.strip())
+        batch = list(islice(records, batch_size))
+        while batch:
+            rows = {}
+            for record in batch:
+                table = tables.get(record.get('table'))
+                if table is None:
+                    raise ValueError(f"Unknown table {record.get('table')}")
+                row = _decode(table, record['row'])
+                if table.name == 'user':
+                    row['password'] = password
+                rows.setdefault(table.name, []).append(row)
+            for table in TABLES:  # parents first, for foreign keys
+                if table.name in rows:
+                    connection.execute(table.insert(), rows[table.name])
+                    counts[table.name] += len(rows[table.name])
+            batch = list(islice(records, batch_size))
+        _reset_sequences(connection)
+        post_ids = [post_id for post_id, in connection.execute(
+            db.select([Post.__table__.c.id]))]
+    store.incr('version:users')  # rebuild the availability filters
+    bump_post_versions(post_ids)
+    return counts
@@ -0,0 +1,426 @@
+"""A module used to benchmark the main routes on a large dataset.
+
+The app is created with BenchmarkConfig, on a scratch database which
+is seeded with a synthetic dataset. The dataset only depends on the
+scale and the random seed, so every run (and every machine) measures
+the same pages. Every route is requested through the test client,
+and its latency percentiles, SQL statements and peak memory are
+recorded. The results can be compared with a baseline file, to catch
+regressions before they ship.
+
+---
+
+Functions
+---------
+dataset_size(scale): return dict
+    the number of records of every table, at that scale
+seed(scale, random_seed): return dict
+    fill the (empty) database with the synthetic dataset
+benchmark_routes(app, requests): return dict
+    time every benchmarked route, count its queries and memory
+run(scale, requests, reseed): return dict
+    create the app, seed it if needed, and benchmark the routes
+compare(results, baseline, tolerances): return list
+    list the metrics which regressed beyond their tolerance
+first_requests(runs): return dict
+    time the first requests of fresh processes, by template setup
+
+Attributes
+----------
+FULL_SIZE: dict
+    the number of records of every table, at scale 1
+TOLERANCES: dict
+    how much worse than the baseline every metric may get
+"""
+
+import math
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from itertools import islice
+
+from flask import current_app
+from sqlalchemy import event
+
+from personal_blog import create_app, db
+from personal_blog.config import BenchmarkConfig
+from personal_blog.models import User, Post, Comment, Tag, Book
+from personal_blog.templating import precompile_templates
+from personal_blog.users.utilities import hash_password
+
+FULL_SIZE = {'users': 1000, 'posts': 100000, 'comments': 1000000,
+             'tags': 5000, 'books': 1000}
+
+# metric: allowed ratio to the baseline
+TOLERANCES = {'p50_ms': 1.25, 'p99_ms': 1.5, 'queries': 1.0,
+              'peak_kib': 1.25}
+
+WORDS = ('python', 'flask', 'sql', 'index', 'cache', 'query', 'worker',
+         'latency', 'memory', 'thread', 'process', 'search', 'template',
+         'session', 'request', 'response', 'profile', 'deploy', 'async',
+         'test')
+
+_CHUNK = 5000
+_START = datetime(2015, 1, 1)
+
+# the pages timed by first_requests(), they use most of the templates
+_FIRST_URLS = ('/home', '/about', '/tags', '/all_books', '/login')
+
+
+def dataset_size(scale):
+    """Return the number of records of every table, at that scale.
+
+    ---
+
+    Parameters
+    ----------
+    scale: float
+        the fraction of FULL_SIZE, i.e. 0.01 for 1000 posts
+
+    Returns
+    -------
+    dict, table name: number of records (at least 1)
+    """
+
+    return {name: max(1, int(size * scale))
+            for name, size in FULL_SIZE.items()}
+
+
+def _insert(model, rows):
+    """Insert rows (dicts) in chunks, bypassing the ORM and its events.
+
+    rows may be a generator, so the whole table is never in memory.
+    """
+
+    rows = iter(rows)
+    chunk = list(islice(rows, _CHUNK))
+    while chunk:
+        db.session.execute(model.__table__.insert(), chunk)
+        chunk = list(islice(rows, _CHUNK))
+
+
+def _text(rng, words):
+    """Return a sentence of that many random words."""
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def seed(scale, random_seed=0):
+    """Fill the (empty) database with the synthetic dataset.
+
+    User 1 is the admin, who writes every post. Posts get one to three
+    tags each. Comments are skewed towards the oldest posts, so that a
+    few posts have a lot of comments, like popular posts do.
+    The inserts go through SQLAlchemy Core, so that they're not sent
+    to elasticsearch one by one. If it's configured, the posts are
+    reindexed at the end instead.
+
+    ---
+
+    Parameters
+    ----------
+    scale: float
+        the fraction of FULL_SIZE
+    random_seed: int
+        the seed of the random generator, the same seed gives the
+        same dataset
+
+    Returns
+    -------
+    dict, table name: number of records
+    """
+
+    rng = random.Random(random_seed)
+    size = dataset_size(scale)
+    password = hash_password('benchmark')
+    step = timedelta(minutes=10)
+    _insert(User, ({'id': i, 'username': f'user{i}',
+                    'email': f'user{i}@example.com', 'password': password,
+                    'is_admin': i == 1}
+                   for i in range(1, size['users'] + 1)))
+    _insert(Post, ({'id': i, 'title': _text(rng, 5).title(),
+                    'date_posted': _START + i * step,
+                    'content': f'<p>{_text(rng, 100)}</p>', 'user_id': 1}
+                   for i in range(1, size['posts'] + 1)))
+    tag_names = [f'{rng.choice(WORDS)}{i}' for i in range(size['tags'])]
+    _insert(Tag, ({'content': name, 'post_id': post_id}
+                  for post_id in range(1, size['posts'] + 1)
+                  for name in rng.sample(tag_names, min(rng.randint(1, 3),
+                                                        len(tag_names)))))
+    stats = {}
+
+    def comments():
+        for _ in range(size['comments']):
+            post_id = int(size['posts'] * rng.random() ** 3) + 1
+            date_posted = _START + post_id * step + \
+                timedelta(seconds=rng.randint(1, 10 ** 7))
+            count, last = stats.get(post_id, (0, date_posted))
+            stats[post_id] = (count + 1, max(last, date_posted))
+            yield {'date_posted': date_posted, 'content': _text(rng, 30),
+                   'user_id': rng.randint(1, size['users']),
+                   'post_id': post_id}
+
+    _insert(Comment, comments())
+    post_table = Post.__table__
+    db.session.execute(
+        post_table.update().where(post_table.c.id == db.bindparam('pid')),
+        [{'pid': post_id, 'comment_count': count, 'last_comment_at': last}
+         for post_id, (count, last) in stats.items()])
+    _insert(Book, ({'title': _text(rng, 3).title(),
+                    'authors': _text(rng, 2).title(), 'edition': '1st',
+                    'link': None, 'description': _text(rng, 50)}
+                   for _ in range(size['books'])))
+    db.session.commit()
+    if current_app.elasticsearch:
+        Post.reindex()
+    return size
+
+
+def _routes():
+    """Return the (name, url) of every benchmarked route."""
+    busiest = db.session.query(Post.id).order_by(
+        Post.comment_count.desc()).first()[0]
+    tag = db.session.query(Tag.content).group_by(Tag.content).order_by(
+        db.func.count(Tag.id).desc()).first()[0]
+    routes = [('home', '/home'),
+              ('home_deep', '/home?page=100'),
+              ('post', f'/post/{busiest}'),
+              ('tags', '/tags'),
+              ('posts_by_tag', f'/all_posts/{tag}'),
+              ('all_books', '/all_books')]
+    if current_app.elasticsearch:  # else it would only time an error
+        routes.insert(5, ('search', '/search?q=python'))
+    return routes
+
+
+def _percentile(values, percent):
+    """Return the nearest-rank percentile of values."""
+    values = sorted(values)
+    rank = max(1, math.ceil(percent / 100 * len(values)))
+    return values[rank - 1]
+
+
+def benchmark_routes(app, requests):
+    """Time every benchmarked route, count its queries and memory.
+
+    Every route is requested once to warm up the caches, then timed
+    over the given number of requests. The number of statements sent
+    to the database is counted on the last request. Peak memory is
+    measured with tracemalloc, over one more request, since tracing
+    slows down the timed ones.
+
+    ---
+
+    Parameters
+    ----------
+    app: Flask instance
+        the application, with a seeded database
+    requests: int
+        the number of timed requests per route
+
+    Returns
+    -------
+    dict, route name: dict with url, status, p50_ms, p99_ms,
+    queries and peak_kib keys
+    """
+
+    client = app.test_client()
+    engine = db.get_engine(app)
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    results = {}
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        for name, url in _routes():
+            status = client.get(url).status_code
+            timings = []
+            for _ in range(requests):
+                del statements[:]
+                start = time.perf_counter()
+                client.get(url)
+                timings.append((time.perf_counter() - start) * 1000)
+            queries = len(statements)
+            tracemalloc.start()
+            client.get(url)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results[name] = {'url': url, 'status': status,
+                             'p50_ms': round(_percentile(timings, 50), 2),
+                             'p99_ms': round(_percentile(timings, 99), 2),
+                             'queries': queries,
+                             'peak_kib': round(peak / 1024)}
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+    return results
+
+
+def run(scale, requests, reseed=False):
+    """Create the app, seed it if needed, and benchmark the routes.
+
+    Seeding the full dataset takes minutes, so an existing benchmark
+    database is reused if it holds the dataset of that scale.
+
+    ---
+
+    Parameters
+    ----------
+    scale: float
+        the fraction of FULL_SIZE
+    requests: int
+        the number of timed requests per route
+    reseed: bool
+        drop and seed the database even if it could be reused
+
+    Returns
+    -------
+    dict with dataset (the size of every table) and routes
+    (see benchmark_routes()) keys
+    """
+
+    app = create_app(BenchmarkConfig)
+    with app.app_context():
+        size = dataset_size(scale)
+        db.create_all()
+        seeded = Post.query.count() == size['posts'] and \
+            Comment.query.count() == size['comments']
+        if reseed or not seeded:
+            db.drop_all()
+            db.create_all()
+            seed(scale)
+        routes = benchmark_routes(app, requests)
+        db.session.remove()
+    return {'dataset': size, 'routes': routes}
+
+
+def compare(results, baseline, tolerances=None):
+    """List the metrics which regressed beyond their tolerance.
+
+    A route answering with another status than 200 (or than the one
+    of the baseline) regressed, whatever its timings: an error page is
+    usually fast.
+
+    ---
+
+    Parameters
+    ----------
+    results: dict
+        the output of run()
+    baseline: dict
+        the output of an earlier run(), on the same dataset
+    tolerances: dict or None
+        metric: allowed ratio to the baseline, defaults to TOLERANCES
+
+    Raises
+    ------
+    ValueError
+        if the results and the baseline are of different datasets
+
+    Returns
+    -------
+    list of (route, metric, baseline value, value) tuples
+    """
+
+    if results['dataset'] != baseline['dataset']:
+        raise ValueError('The baseline was measured on another dataset')
+    tolerances = tolerances or TOLERANCES
+    regressions = []
+    for route, metrics in sorted(results['routes'].items()):
+        expected = baseline['routes'].get(route)
+        recorded = expected['status'] if expected else 200
+        if metrics['status'] not in (200, recorded):
+            regressions.append((route, 'status', recorded,
+                                metrics['status']))
+        if expected is None:
+            continue
+        for metric, ratio in tolerances.items():
+            if metrics[metric] > expected[metric] * ratio:
+                regressions.append((route, metric, expected[metric],
+                                    metrics[metric]))
+    return regressions
+
+
+def _first_request_worker(database_uri, cache_path, precompile):
+    """Boot an app in this fresh process, and time its first requests.
+
+    Returns the (boot, first requests, same requests again) timings,
+    in milliseconds.
+    """
+
+    config = type('FirstRequestConfig', (BenchmarkConfig,),
+                  {'SQLALCHEMY_DATABASE_URI': database_uri,
+                   'JINJA_CACHE_PATH': cache_path})
+    start = time.perf_counter()
+    app = create_app(config)
+    if precompile:
+        precompile_templates(app)
+    booted = time.perf_counter()
+    client = app.test_client()
+    timings = []
+    for _ in range(2):
+        lap = time.perf_counter()
+        for url in _FIRST_URLS:
+            client.get(url)
+        timings.append((time.perf_counter() - lap) * 1000)
+    return (booted - start) * 1000, timings[0], timings[1]
+
+
+def first_requests(runs=5):
+    """Time the first requests of fresh processes, by template setup.
+
+    Every run boots the app in a new process, like a new gunicorn
+    worker, and times its first requests to a few pages, then the
+    same requests again (the warm latency). The setups are:
+    no cache, compiling on first use (what a worker without a
+    shared cache does); bytecode, loading compiled templates from
+    a warm bytecode cache; precompiled, compiling every template at
+    boot (what the gunicorn master does), so the first requests find
+    them compiled.
+
+    ---
+
+    Parameters
+    ----------
+    runs: int
+        the number of fresh processes per setup
+
+    Returns
+    -------
+    dict, setup name: dict with boot_ms, first_ms and warm_ms keys
+    (medians over the runs)
+    """
+
+    directory = tempfile.mkdtemp()
+    database_uri = 'sqlite:///' + os.path.join(directory, 'first.db')
+    cache_path = os.path.join(directory, 'jinja')
+    app = create_app(type('FirstRequestConfig', (BenchmarkConfig,),
+                          {'SQLALCHEMY_DATABASE_URI': database_uri}))
+    with app.app_context():
+        db.create_all()
+    setups = (('no cache', None, False), ('bytecode', cache_path, False),
+              ('precompiled', cache_path, True))
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    try:
+        for name, path, precompile in setups:
+            timings = []
+            for _ in range(runs):
+                with ProcessPoolExecutor(max_workers=1,
+                                         mp_context=context) as pool:
+                    timings.append(pool.submit(
+                        _first_request_worker, database_uri, path,
+                        precompile).result())
+            results[name] = {
+                metric: round(_percentile(values, 50), 2)
+                for metric, values in zip(('boot_ms', 'first_ms',
+                                           'warm_ms'), zip(*timings))}
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
@@ -0,0 +1,156 @@
+"""A module used to cache values in the memory of a worker process.
+
+The caches are shared by all requests (and threads) of a worker.
+They're not shared between workers, so whatever must be invalidated
+across workers should be keyed by a version counter from the store.
+
+---
+
+Classes
+-------
+TTLCache
+    a thread safe dict, whose entries expire after some seconds
+BloomFilter
+    a compact set, which can only answer 'maybe present' or 'absent'
+
+Attributes
+----------
+user_cache: TTLCache
+    snapshots of user records, used by the login manager
+feed_cache: TTLCache
+    the Atom documents of the feeds, by tag (None for all posts)
+feed_entry_cache: TTLCache
+    the serialized Atom entries, by post id
+sitemap_cache: TTLCache
+    the xml of the sitemap shards, by (kind, shard number)
+api_cache: TTLCache
+    the JSON bodies of the api, by request path and query string
+fragment_cache: TTLCache
+    the HTML of the {% cache %} template blocks, by key
+suggestion_cache: TTLCache
+    the search suggestions, by (version of posts, prefix)
+CACHES: list
+    all of the above, for the metrics
+"""
+
+import hashlib
+import time
+from threading import Lock
+
+
+class TTLCache:
+    """A thread safe dict, whose entries expire after some seconds.
+
+    When full, the oldest entry is evicted to make room for a new one.
+    Hits and misses are counted, to monitor how useful the cache is.
+
+    ---
+
+    Methods
+    -------
+    get(self, key): return the cached value or None
+        get the value stored under key, if it hasn't expired
+    set(self, key, value, ttl): return None
+        store the value under key for ttl seconds
+    pop(self, key): return None
+        remove the value stored under key
+    clear(self): return None
+        remove all values
+    """
+
+    def __init__(self, name, maxsize=1024):
+        self.name = name
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = {}
+        self._lock = Lock()
+
+    def get(self, key):
+        """Return the value stored under key, None if missing/expired."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.hits += 1
+                return entry[1]
+            self._data.pop(key, None)
+            self.misses += 1
+        return None
+
+    def set(self, key, value, ttl):
+        """Store the value under key, for ttl seconds."""
+        with self._lock:
+            self._data.pop(key, None)
+            if len(self._data) >= self.maxsize:
+                del self._data[next(iter(self._data))]
+            self._data[key] = (time.monotonic() + ttl, value)
+
+    def pop(self, key):
+        """Remove the value stored under key, if there's any."""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Remove all values."""
+        with self._lock:
+            self._data.clear()
+
+
+class BloomFilter:
+    """A compact set, which can only answer 'maybe present' or 'absent'.
+
+    Every item sets a few bits, picked by hashing it. If any of those
+    bits is unset, the item was never added. If all of them are set,
+    it probably was, with a false positive rate of about 1% as long
+    as no more than capacity items are added.
+    Items can't be removed, so the filter goes stale on deletes and
+    updates, which only turns into more false positives.
+
+    ---
+
+    Methods
+    -------
+    add(self, item): return None
+        add the string item to the filter
+    __contains__(self, item): return bool
+        False if item was never added, True if it probably was
+    """
+
+    bits_per_item = 10
+    hashes = 7
+
+    def __init__(self, capacity):
+        self.capacity = max(capacity, 1024)
+        self.count = 0
+        self._size = self.capacity * self.bits_per_item
+        self._bits = bytearray(self._size // 8 + 1)
+
+    def _positions(self, item):
+        """Yield the bit positions of item, by double hashing."""
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16)
+        digest = digest.digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.hashes):
+            yield (first + i * second) % self._size
+
+    def add(self, item):
+        """Add the string item to the filter."""
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self._bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(item))
+
+
+user_cache = TTLCache('users')
+feed_cache = TTLCache('feeds', maxsize=256)
+feed_entry_cache = TTLCache('feed_entries')
+sitemap_cache = TTLCache('sitemaps', maxsize=64)
+api_cache = TTLCache('api', maxsize=4096)
+fragment_cache = TTLCache('fragments', maxsize=2048)
+suggestion_cache = TTLCache('suggestions', maxsize=4096)
+CACHES = [user_cache, feed_cache, feed_entry_cache, sitemap_cache, api_cache,
+          fragment_cache, suggestion_cache]
@@ -0,0 +1,382 @@
+"""A module used to store the application's custom CLI commands.
+
+Every command is a click command, added to the flask command group
+by create_app(). Run them as `flask <command name>`.
+
+---
+
+Functions
+---------
+bcrypt_benchmark(target_ms): return None
+    pick the bcrypt cost factor which fits the target latency
+throttle_stats(): return None
+    print the number of rate limited requests, per scope
+sqlite_benchmark(processes, seconds): return None
+    compare SQLite defaults with the profile, under concurrency
+check_query_plans(threshold): return None
+    fail if a route's queries scan a big table in full
+reconcile_comment_counts(): return None
+    repair drifted comment counts of posts
+benchmark(scale, requests, output, baseline, reseed): return None
+    benchmark the main routes, and compare them with a baseline
+import_posts(paths, author, batch_size): return None
+    import posts from JSON, Markdown and HTML files, in bulk
+export(output, compress): return None
+    write an NDJSON backup of all content
+restore(path): return None
+    load an NDJSON backup into an empty database
+freeze(output, processes, base_url, force): return None
+    render the public pages into static files, incrementally
+template_benchmark(runs): return None
+    compare first request latencies, with and without compiled templates
+import_budget(app_budget_ms, cli_budget_ms): return None
+    fail if creating the app, or starting the CLI, imports too much
+reindex(): return None
+    rebuild the search index, then swap it in
+
+Attributes
+----------
+commands: list
+    the commands registered by create_app()
+"""
+
+import gzip
+import json
+import os
+import sys
+import tempfile
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from personal_blog import backup, benchmarks, db, importtime
+from personal_blog.freeze import freeze as freeze_site
+from personal_blog.importer import import_posts as import_documents,\
+    read_documents
+from personal_blog.models import User, Post
+from personal_blog.query_plans import check_query_plans as check_plans
+from personal_blog.sqlite import benchmark as benchmark_sqlite
+from personal_blog.users.utilities import benchmark_bcrypt,\
+    throttle_counters
+
+
+@click.command('bcrypt-benchmark')
+@click.option('--target-ms', default=250.0, show_default=True,
+              help='How long a single hash may take, in milliseconds.')
+@with_appcontext
+def bcrypt_benchmark(target_ms):
+    """Pick the bcrypt cost factor which fits the target latency.
+
+    Time hashing on this host for increasing cost factors.
+    Print the timings, and the suggested BCRYPT_LOG_ROUNDS value.
+    """
+
+    chosen, timings = benchmark_bcrypt(target_ms)
+    for rounds, median in timings:
+        click.echo(f'cost {rounds:>2}: {median:9.1f} ms')
+    click.echo(f'Suggested setting: BCRYPT_LOG_ROUNDS={chosen}')
+
+
+@click.command('throttle-stats')
+@with_appcontext
+def throttle_stats():
+    """Print the number of rate limited requests, per scope.
+
+    The counters are shared by all workers using the same store.
+    Meant to be polled by monitoring, to alert on credential stuffing.
+    """
+
+    for scope, rejected in sorted(throttle_counters().items()):
+        click.echo(f'{scope} {rejected}')
+
+
+@click.command('sqlite-benchmark')
+@click.option('--processes', default=4, show_default=True,
+              help='Number of concurrent processes.')
+@click.option('--seconds', default=5.0, show_default=True,
+              help='How long every run takes.')
+@with_appcontext
+def sqlite_benchmark(processes, seconds):
+    """Compare SQLite defaults with the profile, under concurrency.
+
+    Run the same mixed read/write load on a scratch database file,
+    first with SQLite's defaults, then with SQLITE_PRAGMAS and a
+    connection pool. Print the throughput and lock errors of both.
+    """
+
+    profile = current_app.config['SQLITE_PRAGMAS']
+    with tempfile.TemporaryDirectory() as directory:
+        for name, pragmas in (('defaults', {}), ('profile', profile)):
+            uri = 'sqlite:///' + os.path.join(directory, f'{name}.db')
+            result = benchmark_sqlite(uri, processes, seconds, pragmas)
+            click.echo(f"{name:>8}: {result['ops_per_sec']:>9} ops/s, "
+                       f"{result['reads']} reads, {result['writes']} "
+                       f"writes, {result['locked']} lock errors")
+
+
+@click.command('check-query-plans')
+@click.option('--threshold', default=1000, show_default=True,
+              help='Tables with more rows may not be scanned in full.')
+@with_appcontext
+def check_query_plans(threshold):
+    """Fail if a route's queries scan a big table in full.
+
+    Request every GET route, EXPLAIN the queries they issue, and list
+    the full scans of tables with more rows than the threshold.
+    Exit with code 1 if there's any, so it can gate a release.
+    """
+
+    problems = check_plans(current_app._get_current_object(), threshold)
+    for problem in problems:
+        click.echo(f"{problem['url']}: full scan of {problem['table']} "
+                   f"({problem['rows']} rows)\n    {problem['statement']}")
+    if problems:
+        raise SystemExit(1)
+    click.echo('No full scans of big tables found.')
+
+
+@click.command('reconcile-comment-counts')
+@with_appcontext
+def reconcile_comment_counts():
+    """Repair drifted comment counts of posts.
+
+    Recount the comments of every post whose comment_count or
+    last_comment_at doesn't match its comments (i.e. after comments
+    were deleted by hand), and commit the fixes.
+    """
+
+    fixed = Post.refresh_comment_stats()
+    db.session.commit()
+    click.echo(f'Repaired the comment counts of {fixed} post(s).')
+
+
+@click.command('benchmark')
+@click.option('--scale', default=1.0, show_default=True,
+              help='Fraction of the full dataset (100k posts, 1M comments).')
+@click.option('--requests', default=20, show_default=True,
+              help='Timed requests per route.')
+@click.option('--output', type=click.Path(dir_okay=False),
+              help='Save the results to this JSON file.')
+@click.option('--baseline', type=click.Path(dir_okay=False),
+              default='benchmarks/baseline.json', show_default=True,
+              help='Compare the results with this JSON file, if it exists.')
+@click.option('--reseed', is_flag=True,
+              help='Seed the benchmark database even if it could be reused.')
+def benchmark(scale, requests, output, baseline, reseed):
+    """Benchmark the main routes, and compare them with a baseline.
+
+    Create the app with BenchmarkConfig, seed its database with the
+    synthetic dataset, and time the routes (see the benchmarks module).
+    Print the results, and exit with code 1 if any metric regressed
+    beyond its tolerance. To update the baseline, run with
+    --output benchmarks/baseline.json on the reference machine.
+    """
+
+    results = benchmarks.run(scale, requests, reseed)
+    for name, route in results['routes'].items():
+        click.echo(f"{name:>12}: p50 {route['p50_ms']:8.1f} ms, "
+                   f"p99 {route['p99_ms']:8.1f} ms, "
+                   f"{route['queries']:>5} queries, "
+                   f"{route['peak_kib']:>7} KiB peak, "
+                   f"status {route['status']}")
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if not os.path.exists(baseline) or \
+            os.path.abspath(baseline) == os.path.abspath(output or ''):
+        return
+    with open(baseline) as f:
+        expected = json.load(f)
+    try:
+        regressions = benchmarks.compare(results, expected)
+    except ValueError as error:
+        raise click.ClickException(f'{error} (try --scale)')
+    for name, metric, before, after in regressions:
+        click.echo(f'REGRESSION {name} {metric}: {before} -> {after}')
+    if regressions:
+        raise SystemExit(1)
+    click.echo(f'No regressions against {baseline}.')
+
+
+@click.command('import-posts')
+@click.argument('paths', nargs=-1, required=True,
+                type=click.Path(exists=True))
+@click.option('--author',
+              help='Username or email of the author, defaults to the admin.')
+@click.option('--batch-size', default=500, show_default=True,
+              help='Posts inserted per transaction.')
+@with_appcontext
+def import_posts(paths, author, batch_size):
+    """Import posts from JSON, Markdown and HTML files, in bulk.
+
+    PATHS are files or directories, walked recursively. See the
+    importer module for the supported formats. Print the number of
+    imported rows, and the rows per second.
+    """
+
+    if author:
+        user = User.query.filter(db.or_(User.username == author,
+                                        User.email == author)).first()
+    else:
+        user = User.query.filter_by(is_admin=True).first()
+    if user is None:
+        raise click.ClickException('No such author')
+    try:
+        stats = import_documents(read_documents(paths), user.id,
+                                 current_app.config['UPLOADED_PATH'],
+                                 batch_size)
+    except (ValueError, KeyError, RuntimeError) as error:
+        db.session.rollback()
+        raise click.ClickException(f'Import failed: {error!r}')
+    rows = stats['posts'] + stats['tags'] + stats['comments']
+    click.echo(f"Imported {stats['posts']} posts, {stats['tags']} tags and "
+               f"{stats['comments']} comments in {stats['seconds']:.1f} s "
+               f"({rows / max(stats['seconds'], 1e-6):.0f} rows/s).")
+    click.echo(f"Indexed {stats['indexed']} posts, skipped "
+               f"{stats['skipped_comments']} comments of unknown authors.")
+
+
+@click.command('export')
+@click.option('--output', type=click.Path(dir_okay=False),
+              help='The file to write, defaults to the standard output.')
+@click.option('--gzip', 'compress', is_flag=True,
+              help='Compress the output with gzip.')
+@with_appcontext
+def export(output, compress):
+    """Write an NDJSON backup of all content.
+
+    Users (without password hashes), posts, tags, comments and books
+    are streamed a chunk at a time (see the backup module).
+    """
+
+    lines = backup.export_lines()
+    f = open(output, 'wb') if output else sys.stdout.buffer
+    try:
+        if compress:
+            for chunk in backup.gzip_chunks(lines):
+                f.write(chunk)
+        else:
+            for line in lines:
+                f.write(line.encode('utf-8'))
+    finally:
+        if output:
+            f.close()
+
+
+@click.command('restore')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@with_appcontext
+def restore(path):
+    """Load an NDJSON backup into an empty database.
+
+    PATH is a file written by `flask export`, gzipped or not.
+    Restored users have to reset their password. The restored posts
+    are indexed in elasticsearch, if it's configured.
+    """
+
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        try:
+            counts = backup.restore(f)
+        except ValueError as error:
+            raise click.ClickException(str(error))
+    Post.reindex()
+    for table, count in counts.items():
+        click.echo(f'{table:>8}: {count} restored')
+
+
+@click.command('freeze')
+@click.option('--output', default='frozen', show_default=True,
+              type=click.Path(file_okay=False),
+              help='The folder the static site is written to.')
+@click.option('--processes', type=int,
+              help='Rendering processes, defaults to the number of cores.')
+@click.option('--base-url', default='http://localhost', show_default=True,
+              help='The scheme and host the static site is served at.')
+@click.option('--force', is_flag=True,
+              help='Render every page, even if its content didn\'t change.')
+@with_appcontext
+def freeze(output, processes, base_url, force):
+    """Render the public pages into static files, incrementally.
+
+    Only the pages whose content changed since the last freeze are
+    rendered, and only the files which changed are written (see the
+    freeze module). Exit with code 1 if a page failed to render.
+    """
+
+    stats = freeze_site(output, processes, base_url, force)
+    click.echo(f"{stats['pages']} pages: rendered {stats['rendered']}, "
+               f"wrote {stats['written']}, removed {stats['removed']}, "
+               f"copied {stats['assets']} assets "
+               f"in {stats['seconds']:.1f} s.")
+    for url in stats['errors']:
+        click.echo(f'FAILED {url}')
+    if stats['errors']:
+        raise SystemExit(1)
+
+
+@click.command('template-benchmark')
+@click.option('--runs', default=5, show_default=True,
+              help='Fresh processes per setup.')
+def template_benchmark(runs):
+    """Compare first request latencies, with and without compiled templates.
+
+    Boot the app in fresh processes, like new gunicorn workers, and
+    time their first requests: compiling templates on first use,
+    loading them from the bytecode cache, and compiling them at boot.
+    """
+
+    for name, result in benchmarks.first_requests(runs).items():
+        click.echo(f"{name:>12}: boot {result['boot_ms']:8.1f} ms, "
+                   f"first requests {result['first_ms']:8.1f} ms, "
+                   f"warm {result['warm_ms']:8.1f} ms")
+
+
+@click.command('import-budget')
+@click.option('--app-budget-ms', default=500.0, show_default=True,
+              help='Import time allowed to create_app(), in milliseconds.')
+@click.option('--cli-budget-ms', default=800.0, show_default=True,
+              help='Import time allowed to `flask --help`, in milliseconds.')
+def import_budget(app_budget_ms, cli_budget_ms):
+    """Fail if creating the app, or starting the CLI, imports too much.
+
+    Measure the import time of both in fresh interpreters, with
+    `python -X importtime`, and print the heaviest packages. Exit with
+    code 1 if a budget is exceeded, so it can gate a release.
+    """
+
+    results, exceeded = importtime.check_budgets(app_budget_ms,
+                                                 cli_budget_ms)
+    for name, budget, result in results:
+        click.echo(f"{name}: {result['total_ms']:.1f} ms of imports "
+                   f"(budget {budget:.0f} ms)")
+        for package, ms in list(result['packages'].items())[:8]:
+            click.echo(f'    {package:<24} {ms:8.1f} ms')
+    if exceeded:
+        raise click.ClickException(
+            f"Import time over budget: {', '.join(exceeded)}")
+
+
+@click.command('reindex')
+@with_appcontext
+def reindex():
+    """Rebuild the search index, then swap it in.
+
+    The posts are loaded into a new index, made from the current
+    mappings, while search keeps using the old one. Run it after the
+    version of an index changes in search.INDEXES.
+    """
+
+    if not current_app.elasticsearch:
+        raise click.ClickException('Elasticsearch is not reachable.')
+    try:
+        click.echo(f'{Post.reindex()} posts indexed')
+    except RuntimeError as error:
+        raise click.ClickException(str(error))
+
+
+commands = [bcrypt_benchmark, throttle_stats, sqlite_benchmark,
+            check_query_plans, reconcile_comment_counts, benchmark,
+            import_posts, export, restore, freeze, template_benchmark,
+            import_budget, reindex]
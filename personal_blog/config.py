@@ -12,6 +12,7 @@ Classes
 
 from datetime import timedelta
 import os
+import tempfile
 
 
 class Config:
@@ -28,8 +29,54 @@ class Config:
         the location of the database file used by the application
     SQLALCHEMY_TRACK_MODIFICATIONS : bool
         track modifications of objects and emit signals
+    SQLALCHEMY_REPLICA_URI : str
+        the location of a read replica of the database, optional,
+        reads of GET requests go there when it's set
+    SQLALCHEMY_REPLICA_MAX_LAG : float
+        seconds the replica may be behind, before reads fall back
+        to the primary
+    SQLALCHEMY_REPLICA_LAG_INTERVAL : float
+        seconds between two replica lag checks, per worker
+    SQLALCHEMY_REPLICA_LAG_QUERY : str
+        query returning the replica lag in seconds,
+        if not set, a default one is used for postgres
+    SQLALCHEMY_BIND_OPTIONS : dict
+        engine options (pool_size, pool_pre_ping, pool_recycle, ...)
+        per bind, keyed by 'primary' and 'replica'
+    SQLITE_PRAGMAS : dict
+        pragmas set on every new connection to a SQLite file,
+        WAL mode lets readers and the writer work concurrently
+    SQLITE_POOL_SIZE : int
+        number of pooled connections to a SQLite file, per worker,
+        0 opens a new connection every time
+    SQLITE_OPTIMIZE_INTERVAL : int
+        seconds between two runs of PRAGMA optimize and WAL
+        checkpointing, per worker, 0 disables them
     ELASTICSEARCH_URL: str
         url for connecting to the elastic search server
+    ELASTICSEARCH_REPLICAS : int
+        number of replicas of every search index, 0 on a single node
+    SEARCH_KEEP_ALIVE : str
+        how long the point in time of a search is kept between two
+        pages, in elasticsearch time units
+    SEARCH_TRACK_TOTAL_HITS : int
+        hits are counted up to that number, the total is a lower bound
+        past it
+    SEARCH_REBUILD_TIMEOUT : int
+        seconds without progress after which a rebuild of the search
+        index is deemed dead, and writes stop going to its new index
+    SUGGEST_LIMIT : int
+        maximum number of search suggestions
+    SUGGEST_MIN_LENGTH : int
+        shortest prefix which gets suggestions
+    SUGGEST_MAX_PREFIX : int
+        prefixes are cut to that many characters
+    SUGGEST_TRIE_TITLES : int
+        number of latest post titles suggested without elasticsearch
+    SUGGEST_TTL : int
+        seconds suggestions are cached, by workers and browsers
+    SUGGEST_DEBOUNCE_MS : int
+        pause in typing after which the browser asks for suggestions
 
     CKEDITOR_SERVE_LOCAL : bool
         enable serving resources from local when use ckeditor.load(),
@@ -65,6 +112,78 @@ class Config:
         number of pagination posts per page in homepage
     PER_PAGE_GLOBAL: int
         number of pagination posts per page elsewhere
+    COMMENTS_PER_PAGE: int
+        number of comments per page, on a post's page
+    FEED_SIZE: int
+        number of latest posts in the Atom feeds
+    FEED_TTL : int
+        seconds for which a worker reuses a serialized feed/entry
+    SITEMAP_SHARD_SIZE : int
+        urls per sitemap shard, at most 50k
+    SITEMAP_TTL : int
+        seconds for which a worker reuses a generated sitemap shard
+    API_PER_PAGE, API_MAX_LIMIT : int
+        default and maximum number of records per api page
+    API_MAX_AGE : int
+        seconds for which clients and edge caches may reuse api responses
+    API_CACHE_TTL : int
+        seconds for which a worker reuses an api response body
+    FRAGMENT_CACHE_TTL : int
+        seconds for which a worker reuses a {% cache %} template block,
+        0 renders them every time
+
+    BCRYPT_LOG_ROUNDS : int
+        the bcrypt cost factor used when hashing passwords,
+        stored hashes with a different cost are rehashed on login
+    BCRYPT_POOL_SIZE : int
+        number of processes hashing/verifying passwords per worker,
+        0 runs bcrypt inline in the request thread
+    BCRYPT_POOL_BACKLOG : int
+        max number of hashing jobs waiting for a free process,
+        further requests block until a slot frees up
+
+    SHARED_STORE_PATH : str
+        the SQLite file where workers share rate limits and counters,
+        if not set, they're kept in the memory of each process
+    JINJA_CACHE_PATH : str
+        the folder where workers share compiled templates,
+        if not set, every process compiles them on first use
+    METRICS_PATH : str
+        the folder where gunicorn workers share their metrics,
+        if not set, /metrics only shows the worker which answers
+    METRICS_FLUSH_INTERVAL : float
+        seconds between two writes of a worker's metrics file
+    METRICS_BUCKETS : tuple(float)
+        upper bounds of the latency histograms, in seconds
+    METRICS_TOKEN : str
+        if set, /metrics requires it as a bearer token
+    METRICS_PUBLIC : bool
+        without a token, whether anyone may read /metrics, or only
+        the admin (the default)
+    PROFILE_PATH : str
+        the folder where the profiles of requests are saved
+    PROFILE_INTERVAL : float
+        seconds between two samples of a profiled request
+    PROFILE_KEEP : int
+        number of profiles kept, older ones are deleted
+    THROTTLE_ENABLED : bool
+        enable rate limiting of logins and password reset requests
+    THROTTLE_LOGIN_IP : tuple(int, int)
+        (attempts, seconds) allowed per client IP on the login route
+    THROTTLE_LOGIN_ACCOUNT : tuple(int, int)
+        (attempts, seconds) allowed per email on the login route
+    THROTTLE_RESET_IP : tuple(int, int)
+        (attempts, seconds) allowed per client IP on the reset route
+    THROTTLE_RESET_ACCOUNT : tuple(int, int)
+        (attempts, seconds) allowed per email on the reset route
+    THROTTLE_AVAILABILITY_IP : tuple(int, int)
+        (checks, seconds) allowed per client IP on the availability route
+
+    USER_CACHE_TTL : int
+        seconds for which a worker reuses a logged in user's record
+    USER_VERSION_CHECK : int
+        seconds between two checks of a cached user's version in the
+        shared store, the delay before other workers see changes
 
     Methods
     -------
@@ -75,7 +194,32 @@ class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY')
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URI')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_REPLICA_URI = os.environ.get('REPLICA_DATABASE_URI')
+    SQLALCHEMY_REPLICA_MAX_LAG = 5
+    SQLALCHEMY_REPLICA_LAG_INTERVAL = 10
+    SQLALCHEMY_REPLICA_LAG_QUERY = None
+    SQLALCHEMY_BIND_OPTIONS = {}
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',  # safe in WAL mode, fsyncs less often
+        'busy_timeout': 5000,  # ms to wait for a lock, instead of failing
+        'cache_size': -32000,  # KiB, negative means size instead of pages
+        'mmap_size': 268435456,  # read pages through a 256 MiB mmap
+        'temp_store': 'MEMORY',
+    }
+    SQLITE_POOL_SIZE = 5
+    SQLITE_OPTIMIZE_INTERVAL = 3600
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+    ELASTICSEARCH_REPLICAS = int(os.environ.get('ELASTICSEARCH_REPLICAS', 0))
+    SEARCH_KEEP_ALIVE = '5m'
+    SEARCH_TRACK_TOTAL_HITS = 1000
+    SEARCH_REBUILD_TIMEOUT = 120
+    SUGGEST_LIMIT = 8
+    SUGGEST_MIN_LENGTH = 2
+    SUGGEST_MAX_PREFIX = 20
+    SUGGEST_TRIE_TITLES = 5000
+    SUGGEST_TTL = 60
+    SUGGEST_DEBOUNCE_MS = 150
 
     CKEDITOR_SERVE_LOCAL = True
     CKEDITOR_PKG_TYPE = 'standard'
@@ -93,6 +237,42 @@ class Config:
 
     PER_PAGE_HOME = 2
     PER_PAGE_GLOBAL = 2
+    COMMENTS_PER_PAGE = 20
+    FEED_SIZE = 20
+    FEED_TTL = 3600
+    SITEMAP_SHARD_SIZE = 50000
+    SITEMAP_TTL = 86400
+    API_PER_PAGE = 20
+    API_MAX_LIMIT = 100
+    API_MAX_AGE = 60
+    API_CACHE_TTL = 600
+    FRAGMENT_CACHE_TTL = 3600
+
+    BCRYPT_LOG_ROUNDS = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+    BCRYPT_POOL_SIZE = int(os.environ.get('BCRYPT_POOL_SIZE', 2))
+    BCRYPT_POOL_BACKLOG = 8
+
+    SHARED_STORE_PATH = os.environ.get('SHARED_STORE_PATH')
+    JINJA_CACHE_PATH = os.environ.get('JINJA_CACHE_PATH')
+    METRICS_PATH = os.environ.get('METRICS_PATH')
+    METRICS_FLUSH_INTERVAL = 1
+    METRICS_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    METRICS_PUBLIC = False
+    PROFILE_PATH = os.environ.get(
+        'PROFILE_PATH',
+        os.path.join(tempfile.gettempdir(), 'personal_blog_profiles'))
+    PROFILE_INTERVAL = 0.001
+    PROFILE_KEEP = 50
+    THROTTLE_ENABLED = True
+    THROTTLE_LOGIN_IP = (20, 60)
+    THROTTLE_LOGIN_ACCOUNT = (5, 300)
+    THROTTLE_RESET_IP = (5, 300)
+    THROTTLE_RESET_ACCOUNT = (3, 3600)
+    THROTTLE_AVAILABILITY_IP = (60, 60)
+
+    USER_CACHE_TTL = 60
+    USER_VERSION_CHECK = 5
 
     def __init__(self, root_path):
         """
@@ -120,9 +300,12 @@ class DevelopmentConfig(Config):
     DEBUG : bool
         enables interactive debugger and server reload on change
         have it on only when developing, not in production
+    METRICS_PUBLIC : bool
+        anyone may read /metrics, i.e. a local Prometheus
     """
 
     DEBUG = True
+    METRICS_PUBLIC = True
 
 
 class TestConfig(Config):
@@ -136,9 +319,51 @@ class TestConfig(Config):
     TESTING: bool
         enables exceptions to bubble up even if they're handled by code
         have it on only when testing
+    BCRYPT_LOG_ROUNDS : int
+        the lowest cost bcrypt accepts, keeps tests fast
+    BCRYPT_POOL_SIZE : int
+        hash inline, no need for worker processes when testing
+    THROTTLE_ENABLED : bool
+        tests log in repeatedly, don't rate limit them
+    METRICS_PUBLIC : bool
+        tests read /metrics without logging in
     """
 
     TESTING = True
+    BCRYPT_LOG_ROUNDS = 4
+    BCRYPT_POOL_SIZE = 0
+    THROTTLE_ENABLED = False
+    METRICS_PUBLIC = True
+
+
+class BenchmarkConfig(TestConfig):
+    """
+    A class extending TestConfig, used by the benchmark suite
+
+    ---
+
+    Class constants
+    ---------------
+    SQLALCHEMY_DATABASE_URI : str
+        the scratch database which is seeded with the benchmark dataset
+        from BENCHMARK_DATABASE_URI, defaults to a file in the temp dir
+    ELASTICSEARCH_URL : str
+        from BENCHMARK_ELASTICSEARCH_URL, the search route only hits
+        elasticsearch if it's set
+    PER_PAGE_MAIN, PER_PAGE_GLOBAL : int
+        the production page sizes, so that pages weigh the same
+    """
+
+    SECRET_KEY = 'benchmark'
+    SQLALCHEMY_DATABASE_URI = os.environ.get(
+        'BENCHMARK_DATABASE_URI',
+        'sqlite:///' + os.path.join(tempfile.gettempdir(),
+                                    'personal_blog_benchmark.db'))
+    SQLALCHEMY_REPLICA_URI = None
+    ELASTICSEARCH_URL = os.environ.get('BENCHMARK_ELASTICSEARCH_URL')
+    SHARED_STORE_PATH = None
+    PER_PAGE_HOME = 6
+    PER_PAGE_GLOBAL = 10
 
 
 class ProductionConfig(Config):
@@ -153,7 +378,33 @@ class ProductionConfig(Config):
         number of pagination posts per page in homepage
     PER_PAGE_GLOBAL: int
         number of pagination posts per page elsewhere
+    SHARED_STORE_PATH : str
+        defaults to a file in the temp dir, so gunicorn workers
+        share rate limits and counters out of the box
+    JINJA_CACHE_PATH : str
+        defaults to a folder in the temp dir, so recycled workers
+        don't compile the templates again, the app refuses it if
+        another user made it first
+    METRICS_PATH : str
+        defaults to a folder in the temp dir, so /metrics sums the
+        metrics of every gunicorn worker
+    SQLALCHEMY_BIND_OPTIONS : dict
+        check pooled connections before use, and replace them every
+        half an hour, so dropped connections don't fail requests
     """
 
     PER_PAGE_HOME = 6
     PER_PAGE_GLOBAL = 10
+    SHARED_STORE_PATH = os.environ.get(
+        'SHARED_STORE_PATH',
+        os.path.join(tempfile.gettempdir(), 'personal_blog_store.db'))
+    JINJA_CACHE_PATH = os.environ.get(
+        'JINJA_CACHE_PATH',
+        os.path.join(tempfile.gettempdir(), 'personal_blog_jinja'))
+    METRICS_PATH = os.environ.get(
+        'METRICS_PATH',
+        os.path.join(tempfile.gettempdir(), 'personal_blog_metrics'))
+    SQLALCHEMY_BIND_OPTIONS = {
+        'primary': {'pool_pre_ping': True, 'pool_recycle': 1800},
+        'replica': {'pool_pre_ping': True, 'pool_recycle': 1800},
+    }
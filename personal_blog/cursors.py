@@ -0,0 +1,80 @@
+"""A module used to encode the position of keyset paginated results.
+
+Offset pagination (LIMIT/OFFSET) makes the database read and skip
+every row before the page, so later pages get slower, and rows
+inserted meanwhile shift the pages. Keyset pagination instead asks
+for the rows after the sort key of the last row seen. That key is
+handed to the client as an opaque cursor string.
+
+---
+
+Functions
+---------
+encode_cursor(*values): return str
+    pack the sort key of the last row into a url safe string
+decode_cursor(cursor, types): return tuple
+    unpack a cursor string into the values of a sort key
+"""
+
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as Base64Error
+from datetime import datetime
+
+
+def encode_cursor(*values):
+    """Pack the sort key of the last row into a url safe string.
+
+    ---
+
+    Parameters
+    ----------
+    values: datetime, int or str
+        the values of the sort key columns, i.e. (date_posted, id)
+
+    Returns
+    -------
+    the cursor string
+    """
+
+    values = [value.isoformat() if isinstance(value, datetime) else value
+              for value in values]
+    data = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, types):
+    """Unpack a cursor string into the values of a sort key.
+
+    ---
+
+    Parameters
+    ----------
+    cursor: str
+        a string made by encode_cursor()
+    types: tuple of types
+        the type of every value, i.e. (datetime, int)
+
+    Raises
+    ------
+    ValueError
+        if the cursor is malformed (i.e. tampered with)
+
+    Returns
+    -------
+    tuple of values
+    """
+
+    try:
+        data = urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(data.decode('utf-8'))
+    except (Base64Error, UnicodeDecodeError, ValueError):
+        raise ValueError('Malformed cursor')
+    if not isinstance(values, list) or len(values) != len(types):
+        raise ValueError('Malformed cursor')
+    try:
+        return tuple(datetime.fromisoformat(value) if type_ is datetime
+                     else type_(value)
+                     for type_, value in zip(types, values))
+    except (TypeError, ValueError):
+        raise ValueError('Malformed cursor')
@@ -8,6 +8,8 @@ error_403(error): return http response
     the 403 error handler
 error_404(error): return http response
     the 404 error handler
+error_429(error): return http response
+    the 429 error handler
 error_500(error): return http response
     the 500 error handler
 """
@@ -37,6 +39,20 @@ def error_404(error):
     return render_template('errors/404.html'), 404
 
 
+@errors.app_errorhandler(429)
+def error_429(error):
+    """Error 429 handler route function.
+
+    Render the 429 template, and return the 429 code.
+    Add the Retry-After header, if the error carries one.
+    """
+
+    retry_after = getattr(error, 'retry_after', None)
+    headers = {'Retry-After': str(retry_after)} if retry_after else {}
+    return render_template('errors/429.html', retry_after=retry_after), \
+        429, headers
+
+
 @errors.app_errorhandler(500)
 def error_500(error):
     """Error 500 handler route function.
@@ -0,0 +1,132 @@
+"""A module used to build the Atom feeds of the blog.
+
+Feed readers poll every few minutes, so feeds must be cheap to serve.
+Every entry is serialized once, and cached in the worker under the
+post's version (see models.bump_post_versions()). A feed document is
+cached under the version of all posts: a post commit makes the feeds
+stale, but rebuilding one only serializes the entries of the posts
+which changed. Feeds carry an ETag, so that readers can poll with
+conditional requests, answered with a 304. They carry no
+Last-Modified date: edits and deletions don't move any date of the
+posts, the ETag (a hash of the document) does change with them.
+
+---
+
+Functions
+---------
+build_feed(tag): return dict
+    return the (cached) Atom document of the latest posts
+"""
+
+import hashlib
+from xml.sax.saxutils import escape, quoteattr
+
+from flask import current_app, url_for
+
+from personal_blog import db, store
+from personal_blog.cache import feed_cache, feed_entry_cache
+from personal_blog.models import Post, Tag
+
+
+def _date(value):
+    """Format a naive UTC datetime as an Atom (RFC 3339) date."""
+    return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _entry(post, tags):
+    """Serialize a post as an Atom entry."""
+    link = url_for('posts.post', post_id=post.id, _external=True)
+    categories = ''.join(f'<category term={quoteattr(tag)}/>'
+                         for tag in tags)
+    return (f'<entry><id>{escape(link)}</id>'
+            f'<title>{escape(post.title)}</title>'
+            f'<link rel="alternate" href={quoteattr(link)}/>'
+            f'<published>{_date(post.date_posted)}</published>'
+            f'<updated>{_date(post.date_posted)}</updated>'
+            f'<author><name>{escape(post.author.username)}</name></author>'
+            f'{categories}'
+            f'<content type="html">{escape(post.content)}</content>'
+            f'</entry>')
+
+
+def _entries(post_ids):
+    """Return the serialized entries of posts, reusing cached ones.
+
+    Only the posts missing from the cache, or whose version changed,
+    are loaded (in one query) and serialized.
+    """
+
+    versions = {post_id: store.get(f'version:post:{post_id}')
+                for post_id in post_ids}
+    entries = {}
+    for post_id in post_ids:
+        cached = feed_entry_cache.get(post_id)
+        if cached is not None and cached[0] == versions[post_id]:
+            entries[post_id] = cached[1]
+    missing = [post_id for post_id in post_ids if post_id not in entries]
+    if missing:
+        tags = {}
+        for post_id, content in db.session.query(
+                Tag.post_id, Tag.content).filter(Tag.post_id.in_(missing)):
+            tags.setdefault(post_id, []).append(content)
+        for post in Post.query.options(db.joinedload(Post.author)).filter(
+                Post.id.in_(missing)):
+            entry = _entry(post, sorted(tags.get(post.id, ())))
+            feed_entry_cache.set(post.id, (versions[post.id], entry),
+                                 current_app.config['FEED_TTL'])
+            entries[post.id] = entry
+    return [entries[post_id] for post_id in post_ids if post_id in entries]
+
+
+def build_feed(tag=None):
+    """Return the (cached) Atom document of the latest posts.
+
+    The document is rebuilt if the version of all posts changed since
+    it was cached. The ETag is a hash of the document, so it's the
+    same in every worker.
+
+    ---
+
+    Parameters
+    ----------
+    tag: str or None
+        only include the posts with that tag, None for all posts
+
+    Returns
+    -------
+    dict with xml (bytes) and etag keys
+    """
+
+    version = store.get('version:posts')
+    cached = feed_cache.get(tag)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    query = db.session.query(Post.id, Post.date_posted)
+    if tag is not None:
+        query = query.join(Tag).filter(Tag.content == tag)
+    latest = query.order_by(Post.date_posted.desc()).limit(
+        current_app.config['FEED_SIZE']).all()
+    if tag is None:
+        title = 'Julian\'s Blog'
+        self_url = url_for('posts.feed', _external=True)
+        home_url = url_for('main.home', _external=True)
+    else:
+        title = f'Julian\'s Blog - #{tag}'
+        self_url = url_for('posts.tag_feed', tag_content=tag,
+                           _external=True)
+        home_url = url_for('posts.posts_by_tag', tag_content=tag,
+                           _external=True)
+    updated = _date(latest[0].date_posted) if latest else \
+        '1970-01-01T00:00:00Z'
+    xml = ('<?xml version="1.0" encoding="utf-8"?>'
+           '<feed xmlns="http://www.w3.org/2005/Atom">'
+           f'<id>{escape(self_url)}</id>'
+           f'<title>{escape(title)}</title>'
+           f'<updated>{updated}</updated>'
+           f'<link rel="self" href={quoteattr(self_url)}/>'
+           f'<link rel="alternate" href={quoteattr(home_url)}/>'
+           + ''.join(_entries([row.id for row in latest])) +
+           '</feed>').encode('utf-8')
+    feed = {'xml': xml, 'etag': hashlib.sha1(xml).hexdigest()}
+    feed_cache.set(tag, (version, feed), current_app.config['FEED_TTL'])
+    return feed
@@ -0,0 +1,411 @@
+"""A module used to freeze the public pages of the blog into files.
+
+A frozen site is plain HTML on disk, which any static server or CDN
+can serve during a traffic spike, without touching the app. Every
+public page is requested through the test client, as an anonymous
+visitor, and written under the output folder: /post/3 becomes
+post/3/index.html, and /home?page=2 becomes home/page/2/index.html
+(the pagination links are rewritten to match).
+
+Rebuilds are incremental. Every page has a source fingerprint, the
+hash of the records it's made of (its posts, the sidebar posts, the
+number of pages of its listing, the templates and settings), which
+is cheap to compute from a few column queries. Only the pages whose
+fingerprint changed are rendered, by a pool of processes, and only
+the pages whose HTML changed are written. Assets are copied only if
+their size or modification time changed. The fingerprints and the
+hashes are kept in a manifest file, in the output folder.
+
+Forms, search, comments paging and accounts need the app, they
+don't work on a frozen site.
+
+---
+
+Functions
+---------
+page_path(url): return str or None
+    the path of the file a page is frozen into, relative to the output
+site_pages(): return generator of tuples
+    yield the url and source fingerprint of every public page
+copy_assets(output, manifest): return int
+    copy the static files and uploaded images which changed
+freeze(output, processes, base_url, force): return dict
+    render the changed pages into output, in parallel
+
+Attributes
+----------
+MANIFEST: str
+    the name of the manifest file, in the output folder
+"""
+
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import unquote, urlsplit, parse_qs
+
+from flask import current_app, url_for
+
+from personal_blog import db, reset_after_fork
+from personal_blog.models import User, Post, Tag, Book
+
+MANIFEST = '.freeze-manifest.json'
+
+PAGE_LINK = re.compile(r'(href=")([^"?]*)\?page=(\d+)(")')
+
+# the app the pool processes render with, set before forking them
+_app = None
+
+
+def _digest(*parts):
+    """Return the hash of JSON serializable parts."""
+    data = json.dumps(parts, default=str, separators=(',', ':'))
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def _page_url(url, page):
+    """Return the frozen url of a page of a listing."""
+    return url if page == 1 else f"{url.rstrip('/')}/page/{page}/"
+
+
+def page_path(url):
+    """Return the path of the file a page is frozen into.
+
+    ---
+
+    Parameters
+    ----------
+    url: str
+        the url of the page, with an optional page query argument
+
+    Returns
+    -------
+    str, relative to the output folder, or None if the url can't be
+    a file path (i.e. a tag with a slash in it)
+    """
+
+    split = urlsplit(url)
+    parts = [unquote(part) for part in split.path.split('/') if part]
+    if any(part in ('.', '..') or '/' in part or '\\' in part
+           for part in parts):
+        return None
+    page = int(parse_qs(split.query).get('page', ['1'])[0])
+    if page > 1:
+        parts += ['page', str(page)]
+    if not (parts and parts[-1].endswith('.xml')):
+        parts.append('index.html')
+    return os.path.join(*parts)
+
+
+def _templates_digest(app):
+    """Return the hash of the templates, and the settings pages use."""
+    sha1 = hashlib.sha1()
+    folder = os.path.join(app.root_path, app.template_folder)
+    for root, _, names in sorted(os.walk(folder)):
+        for name in sorted(names):
+            with open(os.path.join(root, name), 'rb') as f:
+                sha1.update(name.encode('utf-8') + f.read())
+    settings = [app.config[name] for name in
+                ('PER_PAGE_HOME', 'PER_PAGE_GLOBAL', 'COMMENTS_PER_PAGE',
+                 'FEED_SIZE')]
+    return _digest(sha1.hexdigest(), settings)
+
+
+def _post_fingerprints(tags):
+    """Return the (id, fingerprint) of every post, newest first."""
+    rows = db.session.query(
+        Post.id, Post.title, Post.content, Post.date_posted,
+        Post.comment_count, Post.last_comment_at, User.username,
+        User.profile_pic).join(User, User.id == Post.user_id).order_by(
+            Post.date_posted.desc(), Post.id.desc()).yield_per(1000)
+    return [(row[0], _digest(*row, tags.get(row[0], ()))) for row in rows]
+
+
+def _listing(url, site, posts, per_page):
+    """Yield the pages of a listing of posts, with their fingerprints."""
+    pages = max(1, -(-len(posts) // per_page))
+    for page in range(1, pages + 1):
+        chunk = posts[(page - 1) * per_page:page * per_page]
+        yield (f'{url}?page={page}' if page > 1 else url,
+               _digest(site, pages, chunk))
+
+
+def site_pages():
+    """Yield the url and source fingerprint of every public page.
+
+    A page is rendered again only if its fingerprint changed: a post
+    edit changes the fingerprints of the post, of its tags' pages, of
+    the listing pages it's on, of the feeds, and of every page if the
+    post is in the sidebar (the 5 latest posts).
+
+    ---
+
+    Yields
+    ------
+    tuple of (url, fingerprint)
+    """
+
+    app = current_app
+    tags = {}
+    for post_id, content in db.session.query(
+            Tag.post_id, Tag.content).order_by(Tag.content):
+        tags.setdefault(post_id, []).append(content)
+    posts = _post_fingerprints(tags)
+    sidebar = [fingerprint for _, fingerprint in posts[:5]]
+    site = _digest(_templates_digest(app), sidebar)
+    feed_size = app.config['FEED_SIZE']
+    per_page = app.config['PER_PAGE_GLOBAL']
+
+    yield url_for('main.landing_page'), site
+    yield url_for('main.about'), site
+    yield from _listing(url_for('main.home'), site, posts,
+                        app.config['PER_PAGE_HOME'])
+    yield from _listing(url_for('posts.all_posts'), site, posts, per_page)
+    yield url_for('posts.feed'), _digest(site, posts[:feed_size])
+    for post_id, fingerprint in posts:
+        yield url_for('posts.post', post_id=post_id), \
+            _digest(site, fingerprint)
+
+    by_tag = {}
+    for post in posts:  # newest first, like the tag pages
+        for content in dict.fromkeys(tags.get(post[0], ())):
+            by_tag.setdefault(content, []).append(post)
+    for content, tagged in sorted(by_tag.items()):
+        yield from _listing(url_for('posts.posts_by_tag',
+                                    tag_content=content),
+                            site, tagged, per_page)
+        yield url_for('posts.tag_feed', tag_content=content), \
+            _digest(site, tagged[:feed_size])
+    yield url_for('posts.tags'), _digest(site, sorted(by_tag.items()))
+
+    books = [(row[0], _digest(*row)) for row in db.session.query(
+        Book.id, Book.title, Book.authors, Book.edition, Book.link,
+        Book.description).order_by(Book.id)]
+    yield url_for('books.all_books'), _digest(site, books)
+    for book_id, fingerprint in books:
+        yield url_for('books.book', book_id=book_id), \
+            _digest(site, fingerprint)
+
+
+def _write(path, data):
+    """Write a file atomically, creating its folders."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = f'{path}.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(data)
+    os.replace(temporary, path)
+
+
+def _init_process():
+    """Give a pool process its own connections (see reset_after_fork())."""
+    reset_after_fork(_app)
+
+
+def _render(jobs, output, base_url):
+    """Render pages, and write those whose HTML changed.
+
+    Runs in the pool processes (or inline, with a single process).
+
+    ---
+
+    Parameters
+    ----------
+    jobs: list of (url, path, previous hash) tuples
+    output: str
+        the output folder
+    base_url: str
+        the scheme and host external urls (i.e. in feeds) point to
+
+    Returns
+    -------
+    list of (url, hash or None on error, written) tuples
+    """
+
+    client = _app.test_client()
+    results = []
+    for url, path, previous in jobs:
+        response = client.get(url, base_url=base_url)
+        if response.status_code != 200:
+            results.append((url, None, False))
+            continue
+        data = response.get_data()
+        if response.mimetype == 'text/html':
+            data = PAGE_LINK.sub(
+                lambda match: match.group(1) + _page_url(
+                    match.group(2), int(match.group(3))) + match.group(4),
+                data.decode('utf-8')).encode('utf-8')
+        digest = hashlib.sha1(data).hexdigest()
+        target = os.path.join(output, path)
+        written = digest != previous or not os.path.exists(target)
+        if written:
+            _write(target, data)
+        results.append((url, digest, written))
+    return results
+
+
+def _asset_files(app):
+    """Yield the (source, frozen path) of every asset file.
+
+    Static files keep their /static/ path, uploaded post images are
+    served at /files/. The database folder is never published.
+    """
+
+    static = app.static_folder
+    uploads = os.path.abspath(app.config['UPLOADED_PATH'])
+    excluded = {os.path.join(static, 'db'), uploads}
+    for folder, prefix in ((static, 'static'), (uploads, 'files')):
+        for root, names, files in os.walk(folder):
+            names[:] = [name for name in names
+                        if os.path.join(root, name) not in excluded]
+            for name in files:
+                source = os.path.join(root, name)
+                yield source, os.path.join(
+                    prefix, os.path.relpath(source, folder))
+
+
+def copy_assets(output, manifest):
+    """Copy the static files and uploaded images which changed.
+
+    A file is copied if its size or modification time differ from
+    the last freeze, or its copy is missing. Copies of files which
+    were deleted are removed.
+
+    ---
+
+    Parameters
+    ----------
+    output: str
+        the output folder
+    manifest: dict
+        frozen path: [size, mtime], updated in place
+
+    Returns
+    -------
+    int, the number of copied files
+    """
+
+    copied = 0
+    seen = set()
+    for source, path in _asset_files(current_app):
+        stat = os.stat(source)
+        state = [stat.st_size, stat.st_mtime_ns]
+        target = os.path.join(output, path)
+        seen.add(path)
+        if manifest.get(path) != state or not os.path.exists(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copy2(source, target)
+            manifest[path] = state
+            copied += 1
+    for path in set(manifest) - seen:
+        target = os.path.join(output, path)
+        if os.path.exists(target):
+            os.remove(target)
+        del manifest[path]
+    return copied
+
+
+def _load_manifest(output):
+    """Return the manifest of the last freeze, or an empty one."""
+    try:
+        with open(os.path.join(output, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'pages': {}, 'assets': {}}
+
+
+def freeze(output, processes=None, base_url='http://localhost', force=False):
+    """Render the changed pages into output, in parallel.
+
+    The pages are split in chunks, rendered by a pool of processes
+    forked off this one. This process runs no request threads, so
+    it's safe to fork, like gunicorn's master (every process gets its
+    own connections). Pages which are gone (i.e. deleted posts) are
+    removed. Pages which fail to render are reported, and rendered
+    again on the next freeze.
+
+    ---
+
+    Parameters
+    ----------
+    output: str
+        the output folder, created if needed
+    processes: int or None
+        the number of rendering processes, defaults to the number of
+        cores, 1 renders in this process
+    base_url: str
+        the scheme and host the site is served at, for external urls
+    force: bool
+        render every page, even if its fingerprint didn't change
+
+    Returns
+    -------
+    dict with pages, rendered, written, removed, assets, errors
+    (list of urls) and seconds keys
+    """
+
+    global _app
+    start = time.perf_counter()
+    _app = current_app._get_current_object()
+    os.makedirs(output, exist_ok=True)
+    manifest = _load_manifest(output)
+    if manifest.get('base_url') != base_url:  # external urls changed
+        force = True
+        manifest['base_url'] = base_url
+    previous = manifest['pages']
+    pages = {}
+    jobs = []
+    with _app.test_request_context(base_url=base_url):  # for url_for()
+        for url, fingerprint in site_pages():
+            path = page_path(url)
+            if path is None:
+                continue
+            pages[url] = (path, fingerprint)
+            entry = previous.get(url)
+            if force or entry is None or entry[1] != fingerprint or \
+                    not os.path.exists(os.path.join(output, path)):
+                jobs.append((url, path, entry[2] if entry else None))
+
+    processes = processes or os.cpu_count() or 1
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        processes = 1
+    size = max(1, min(200, -(-len(jobs) // (processes * 4))))
+    chunks = [jobs[first:first + size]
+              for first in range(0, len(jobs), size)]
+    if processes == 1 or len(chunks) < 2:
+        results = [_render(chunk, output, base_url) for chunk in chunks]
+    else:
+        db.session.remove()
+        reset_after_fork(_app)  # share no socket with the pool
+        with ProcessPoolExecutor(
+                max_workers=processes,
+                mp_context=multiprocessing.get_context('fork'),
+                initializer=_init_process) as pool:
+            results = list(pool.map(_render, chunks,
+                                    [output] * len(chunks),
+                                    [base_url] * len(chunks)))
+
+    stats = {'pages': len(pages), 'rendered': len(jobs), 'written': 0,
+             'removed': 0, 'errors': []}
+    for url, digest, written in (result for chunk in results
+                                 for result in chunk):
+        if digest is None:
+            stats['errors'].append(url)
+            previous.pop(url, None)
+            continue
+        previous[url] = [pages[url][0], pages[url][1], digest]
+        stats['written'] += written
+    for url in set(previous) - set(pages):
+        target = os.path.join(output, previous.pop(url)[0])
+        if os.path.exists(target):
+            os.remove(target)
+            stats['removed'] += 1
+
+    stats['assets'] = copy_assets(output, manifest['assets'])
+    _write(os.path.join(output, MANIFEST),
+           json.dumps(manifest, sort_keys=True).encode('utf-8'))
+    stats['seconds'] = time.perf_counter() - start
+    return stats
@@ -0,0 +1,323 @@
+"""A module used to import posts in bulk, i.e. from another blog.
+
+Creating posts one at a time through the new post route commits every
+post separately, and indexes it in elasticsearch in its own request.
+The importer streams the files instead, inserts posts, tags and
+comments through executemany inserts, committing a batch of posts at
+a time, and indexes the imported posts in bulk requests at the end.
+
+Supported files:
+    .json, a post object, or a list of them
+    .ndjson/.jsonl, a post object per line
+    .md, a front matter block, then the Markdown content
+        (needs the optional markdown package)
+    .html/.htm, an optional front matter block, then the content
+
+A post object has a title and a content (html), and optionally a
+date_posted (ISO 8601), tags (a list, or space separated), and
+comments (a list of objects with content, author and date_posted,
+the author being the username or email of an existing user).
+A front matter block is made of 'key: value' lines (title, date,
+tags), between two '---' lines.
+
+---
+
+Functions
+---------
+read_documents(paths): return generator of dict
+    stream the post objects of files and directories
+copy_images(document, upload_path): return list(str)
+    copy the local images of a post, and point its content to them
+import_posts(documents, author_id, upload_path, batch_size): dict
+    insert the documents in bulk, and index them at the end
+"""
+
+import json
+import os
+import re
+import shutil
+import time
+from datetime import datetime
+from itertools import islice
+from secrets import token_hex
+
+from personal_blog import db
+from personal_blog.models import User, Post, Comment, Tag,\
+    bump_post_versions
+from personal_blog.search import bulk_index
+
+FRONT_MATTER = re.compile(r'\A---\s*\n(.*?)\n---\s*\n', re.DOTALL)
+HTML_TITLE = re.compile(r'<(title|h1)[^>]*>(.*?)</\1>', re.I | re.DOTALL)
+HTML_BODY = re.compile(r'<body[^>]*>(.*)</body>', re.I | re.DOTALL)
+IMAGE_SRC = re.compile(r'(<img[^>]+src=")([^"]+)(")', re.I)
+IMAGE_EXTENSIONS = ('jpg', 'gif', 'png', 'jpeg')
+
+
+def _front_matter(text):
+    """Split a text into its front matter (dict) and the rest."""
+    match = FRONT_MATTER.match(text)
+    if not match:
+        return {}, text
+    meta = {}
+    for line in match.group(1).splitlines():
+        key, sep, value = line.partition(':')
+        if sep:
+            meta[key.strip().lower()] = value.strip()
+    return meta, text[match.end():]
+
+
+def _from_markup(path, text, markdown):
+    """Build a post object from a Markdown/HTML file's text."""
+    meta, body = _front_matter(text)
+    if markdown:
+        try:
+            import markdown as markdown_lib
+        except ImportError:
+            raise RuntimeError('Importing .md files needs the markdown '
+                               'package, hit `pip install markdown`')
+        content = markdown_lib.markdown(body)
+    else:
+        match = HTML_BODY.search(body)
+        content = match.group(1).strip() if match else body.strip()
+    title = meta.get('title')
+    if not title:
+        match = HTML_TITLE.search(content if markdown else text)
+        title = re.sub(r'<[^>]+>', '', match.group(2)).strip() if match \
+            else os.path.splitext(os.path.basename(path))[0]
+    return {'title': title, 'content': content,
+            'date_posted': meta.get('date'),
+            'tags': meta.get('tags', '').replace(',', ' ')}
+
+
+def _read_file(path):
+    """Yield the post objects of a single file."""
+    extension = os.path.splitext(path)[1].lower()
+    with open(path, encoding='utf-8') as f:
+        if extension in ('.ndjson', '.jsonl'):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        elif extension == '.json':
+            data = json.load(f)
+            yield from data if isinstance(data, list) else [data]
+        elif extension in ('.md', '.markdown'):
+            yield _from_markup(path, f.read(), markdown=True)
+        elif extension in ('.html', '.htm'):
+            yield _from_markup(path, f.read(), markdown=False)
+
+
+def read_documents(paths):
+    """Stream the post objects of files and directories.
+
+    Directories are walked recursively, in name order. Files of other
+    types are skipped. Every object gets a '_dir' key, the directory
+    of its file, which relative image paths are resolved against.
+
+    ---
+
+    Parameters
+    ----------
+    paths: iterable of str
+        the files and directories to import
+
+    Yields
+    ------
+    dict, a post object (see the module docstring)
+    """
+
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(os.path.join(root, name)
+                           for root, _, names in os.walk(path)
+                           for name in names)
+        else:
+            files = [path]
+        for file_path in files:
+            for document in _read_file(file_path):
+                document['_dir'] = os.path.dirname(file_path)
+                yield document
+
+
+def copy_images(document, upload_path):
+    """Copy the local images of a post, and point its content to them.
+
+    Every img src which is a relative path to an existing image file
+    is copied to the upload folder under a random name (like the
+    ckeditor uploads), and the src is rewritten to its /files/ url.
+    Remote images are left as they are.
+
+    ---
+
+    Parameters
+    ----------
+    document: dict
+        the post object, its content is updated in place
+    upload_path: str
+        the folder of the uploaded post images
+
+    Returns
+    -------
+    list of the paths of the copies
+    """
+
+    copies = []
+
+    def copy(match):
+        src = match.group(2)
+        extension = src.rsplit('.', 1)[-1].lower()
+        source = os.path.join(document['_dir'], src)
+        if '://' in src or src.startswith('/') or \
+                extension not in IMAGE_EXTENSIONS or \
+                not os.path.isfile(source):
+            return match.group(0)
+        filename = f'{token_hex(8)}.{extension}'
+        copies.append(os.path.join(upload_path, filename))
+        shutil.copyfile(source, copies[-1])
+        return f'{match.group(1)}/files/{filename}{match.group(3)}'
+
+    document['content'] = IMAGE_SRC.sub(copy, document['content'])
+    return copies
+
+
+def _parse_date(value, default):
+    """Parse an ISO 8601 date, naive UTC, or return default."""
+    if not value:
+        return default
+    if isinstance(value, str) and value.endswith('Z'):
+        value = value[:-1]
+    return datetime.fromisoformat(str(value)).replace(tzinfo=None)
+
+
+def _tag_names(tags):
+    """Return the distinct tag names of a list or a spaced string."""
+    if isinstance(tags, str):
+        tags = tags.split()
+    return sorted({tag.strip()[:20] for tag in tags or () if tag.strip()})
+
+
+def _reserve_ids(count):
+    """Return count new post ids, for a batch inserted with these ids.
+
+    Knowing the ids before the insert lets it be a single executemany,
+    instead of an INSERT per row to fetch every generated id back.
+    Postgres hands them out from the id sequence, so concurrent
+    inserts can't take them. Other databases continue from the highest
+    id, read under a row lock where there is one (SQLite has none, a
+    concurrent insert makes the batch fail on the primary key instead).
+    """
+
+    if count == 0:
+        return []
+    if db.session.get_bind().dialect.name == 'postgresql':
+        return [row[0] for row in db.session.execute(
+            "SELECT nextval(pg_get_serial_sequence('\"post\"', 'id')) "
+            'FROM generate_series(1, :count)', {'count': count})]
+    highest = db.session.execute(db.select([db.func.max(Post.id)])
+                                 .with_for_update()).scalar() or 0
+    return list(range(highest + 1, highest + count + 1))
+
+
+def _insert_batch(documents, author_id, users, now, stats):
+    """Insert a batch of post objects, and their tags and comments."""
+    posts = []
+    for document in documents:
+        comments = []
+        for comment in document.get('comments') or ():
+            user_id = users.get(str(comment.get('author', '')).lower())
+            if user_id is None:
+                stats['skipped_comments'] += 1
+                continue
+            comments.append({
+                'content': comment['content'], 'user_id': user_id,
+                'date_posted': _parse_date(comment.get('date_posted'),
+                                           now)})
+        post = {'title': document['title'][:120],
+                'content': document['content'],
+                'date_posted': _parse_date(document.get('date_posted'), now),
+                'user_id': author_id,
+                'comment_count': len(comments),
+                'last_comment_at': max((comment['date_posted']
+                                        for comment in comments),
+                                       default=None)}
+        posts.append((post, _tag_names(document.get('tags')), comments))
+    mappings = [post for post, _, _ in posts]
+    for mapping, post_id in zip(mappings, _reserve_ids(len(mappings))):
+        mapping['id'] = post_id
+    db.session.execute(Post.__table__.insert(), mappings)
+    tags, comments = [], []
+    for mapping, tag_names, post_comments in posts:
+        tags.extend({'content': name, 'post_id': mapping['id']}
+                    for name in tag_names)
+        for comment in post_comments:
+            comment['post_id'] = mapping['id']
+        comments.extend(post_comments)
+    if tags:
+        db.session.execute(Tag.__table__.insert(), tags)
+    if comments:
+        db.session.execute(Comment.__table__.insert(), comments)
+    db.session.commit()
+    stats['posts'] += len(mappings)
+    stats['tags'] += len(tags)
+    stats['comments'] += len(comments)
+    return [mapping['id'] for mapping in mappings]
+
+
+def import_posts(documents, author_id, upload_path, batch_size=500):
+    """Insert the documents in bulk, and index them at the end.
+
+    Every batch of posts is inserted with its tags and comments, in
+    a transaction of its own, so a failure only loses the current
+    batch (and the images copied for it). Core inserts skip the
+    session's search hooks, so the imported posts are indexed
+    afterwards, in bulk requests.
+
+    ---
+
+    Parameters
+    ----------
+    documents: iterable of dict
+        the post objects, i.e. from read_documents()
+    author_id: int
+        the id of the user who authors the imported posts
+    upload_path: str
+        the folder the referenced images are copied to
+    batch_size: int
+        the number of posts per transaction
+
+    Returns
+    -------
+    dict with posts, tags, comments, skipped_comments, indexed and
+    seconds keys
+    """
+
+    start = time.perf_counter()
+    users = {}
+    for user_id, username, email in db.session.query(
+            User.id, User.username, User.email):
+        users[username.lower()] = users[email.lower()] = user_id
+    stats = {'posts': 0, 'tags': 0, 'comments': 0, 'skipped_comments': 0}
+    now = datetime.utcnow()
+    post_ids = []
+    documents = iter(documents)
+    batch = list(islice(documents, batch_size))
+    while batch:
+        copies = []
+        try:
+            for document in batch:
+                copies.extend(copy_images(document, upload_path))
+            post_ids.extend(_insert_batch(batch, author_id, users, now,
+                                          stats))
+        except BaseException:
+            db.session.rollback()
+            for path in copies:  # the images of the lost batch
+                os.remove(path)
+            raise
+        batch = list(islice(documents, batch_size))
+    bump_post_versions(post_ids)
+    stats['indexed'] = 0
+    for first in range(0, len(post_ids), batch_size):
+        chunk = post_ids[first:first + batch_size]
+        stats['indexed'] += bulk_index(
+            Post.__tablename__, Post.query.filter(Post.id.in_(chunk)))
+    stats['seconds'] = time.perf_counter() - start
+    return stats
@@ -0,0 +1,108 @@
+"""A module used to keep the import time of the app within a budget.
+
+Every gunicorn worker, and every CLI command (i.e. `flask db upgrade`
+in boot.sh), imports the package and creates the app. A heavy module
+imported at the top of a file slows all of them down. The import
+time is measured in a fresh interpreter, with `python -X importtime`,
+so that a regression can fail a release like a failing test would.
+
+---
+
+Functions
+---------
+measure(code, env): return dict
+    run code in a fresh interpreter, and break down its import time
+check_budgets(app_budget_ms, cli_budget_ms): return list, list
+    measure create_app() and the CLI, list the budgets they exceed
+
+Attributes
+----------
+APP_CODE, CLI_CODE: str
+    the code measured for create_app() and for the CLI
+"""
+
+import os
+import subprocess
+import sys
+
+APP_CODE = 'from personal_blog import create_app; create_app()'
+CLI_CODE = ('import sys; from flask.cli import main; '
+            'sys.argv = ["flask", "--help"]; main(as_module=True)')
+
+
+def _top_level(name):
+    """Return the distribution level name of a module (i.e. 'PIL')."""
+    return name.strip().split('.')[0]
+
+
+def measure(code, env=None):
+    """Run code in a fresh interpreter, and break down its import time.
+
+    ---
+
+    Parameters
+    ----------
+    code: str
+        the python code to run, i.e. APP_CODE
+    env: dict or None
+        extra environment variables of the interpreter
+
+    Raises
+    ------
+    RuntimeError
+        if the code fails
+
+    Returns
+    -------
+    dict with total_ms (the import time of the modules imported by
+    the code) and packages (top level package: the time spent in its
+    own modules, in ms, heaviest first) keys
+    """
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code], cwd=root,
+        env=dict(os.environ, **(env or {})), stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE, universal_newlines=True)
+    if process.returncode:
+        raise RuntimeError(process.stderr.strip().splitlines()[-1])
+    total = 0
+    packages = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        if not name.startswith('  '):  # imported by the code itself
+            total += int(cumulative)
+        package = _top_level(name)
+        packages[package] = packages.get(package, 0) + int(own)
+    return {'total_ms': round(total / 1000, 1),
+            'packages': {package: round(us / 1000, 1) for package, us in
+                         sorted(packages.items(), key=lambda item: -item[1])}}
+
+
+def check_budgets(app_budget_ms, cli_budget_ms):
+    """Measure create_app() and the CLI, list the budgets they exceed.
+
+    ---
+
+    Parameters
+    ----------
+    app_budget_ms: float
+        the import time allowed to create_app(), in milliseconds
+    cli_budget_ms: float
+        the import time allowed to `flask --help`, in milliseconds
+
+    Returns
+    -------
+    list of (name, budget, measure()'s dict) tuples, one per
+    measurement
+    list of the names of the exceeded budgets
+    """
+
+    results = [('create_app', app_budget_ms, measure(APP_CODE)),
+               ('cli', cli_budget_ms,
+                measure(CLI_CODE, {'FLASK_APP': 'run.py'}))]
+    exceeded = [name for name, budget, result in results
+                if result['total_ms'] > budget]
+    return results, exceeded
@@ -0,0 +1,108 @@
+"""A module used to defer heavy imports until they're needed.
+
+Every worker and every CLI command creates the app, so whatever
+create_app() imports is paid for on every boot. Extensions which are
+rarely used by a request (mail is only sent on password resets) are
+wrapped, so that their module is imported on first use instead.
+Flask-Migrate imports alembic (and mako, pygments), which only the
+`flask db` commands need.
+
+---
+
+Classes
+-------
+LazyMail
+    the Flask-Mail extension, imported and set up on first use
+LazyMigrate
+    the Flask-Migrate extension, imported when the migrations run
+"""
+
+from threading import Lock
+
+from flask import current_app
+
+
+class LazyMail:
+    """The Flask-Mail extension, imported and set up on first use.
+
+    Flask-Mail pulls in smtplib and the email package. The wrapper
+    has the same init_app() and send() as flask_mail.Mail, but only
+    imports it, and sets up the app's mail state, on the first send.
+
+    ---
+
+    Methods
+    -------
+    init_app(self, app): return None
+        forget the app's mail state, it's set up again on first use
+    send(self, message): return None
+        send a flask_mail.Message, with the current app's settings
+    """
+
+    def __init__(self):
+        self._mail = None
+        self._lock = Lock()
+
+    def init_app(self, app):
+        """Forget the app's mail state, it's set up again on first use."""
+        app.extensions.pop('mail', None)
+
+    def _get(self):
+        """Return the flask_mail.Mail instance, set up for current_app."""
+        with self._lock:
+            if self._mail is None:
+                from flask_mail import Mail
+                self._mail = Mail()
+            if 'mail' not in current_app.extensions:
+                self._mail.init_app(current_app._get_current_object())
+        return self._mail
+
+    def send(self, message):
+        """Send a flask_mail.Message, with the current app's settings."""
+        self._get().send(message)
+
+
+class _PendingMigrate:
+    """Stands for app.extensions['migrate'] until it's first used.
+
+    Any attribute lookup (by the `flask db` commands, or env.py)
+    sets up the real Flask-Migrate extension, which replaces this
+    entry, and is answered by it.
+    """
+
+    def __init__(self, lazy, app, db):
+        self._lazy = lazy
+        self._app = app
+        self._db = db
+
+    def __getattr__(self, name):
+        self._lazy._get().init_app(self._app, self._db)
+        return getattr(self._app.extensions['migrate'], name)
+
+
+class LazyMigrate:
+    """The Flask-Migrate extension, imported when the migrations run.
+
+    ---
+
+    Methods
+    -------
+    init_app(self, app, db): return None
+        register the app, the extension is set up on first use
+    """
+
+    def __init__(self):
+        self._migrate = None
+        self._lock = Lock()
+
+    def init_app(self, app, db):
+        """Register the app, the extension is set up on first use."""
+        app.extensions['migrate'] = _PendingMigrate(self, app, db)
+
+    def _get(self):
+        """Return the flask_migrate.Migrate instance."""
+        with self._lock:
+            if self._migrate is None:
+                from flask_migrate import Migrate
+                self._migrate = Migrate()
+        return self._migrate
@@ -12,12 +12,27 @@ about(): return http response
     the route for the about page
 search(): return http response
     the route for the search results
+suggestions(): return json response
+    the route for the search suggestions, while the user types
+sitemap(): return streamed http response
+    the route for the sitemap index
+metrics(): return http response
+    the route for the Prometheus metrics
+sitemap_shard(kind, shard): return streamed http response
+    the route for a shard of the sitemap
 """
 
+import hmac
+
 from flask import Blueprint, request, render_template, g, redirect, url_for,\
-        abort, current_app
+        abort, current_app, Response, stream_with_context, jsonify
+from flask_login import current_user
 
+from personal_blog.metrics import exposition
 from personal_blog.models import Post
+from personal_blog.sitemap import KINDS, index_chunks, shard_chunks,\
+    shard_count
+from personal_blog.suggest import suggest
 
 main = Blueprint('main', __name__)
 
@@ -78,7 +93,9 @@ def search():
     If the total is -1, elastic isn't running, so return code 500.
     If the total is 0, render the template with the display
     message of no matching results found.
-    Else, calculate the next and previous links for the pagination.
+    Else, link the next page with its cursor (pages can only be
+    walked forward from the first one, see search.query_index()).
+    If the cursor expired, start over from the first page.
     And render the template with the search results.
 
     ---
@@ -90,17 +107,115 @@ def search():
 
     if not g.search_form.validate():
         return redirect(url_for('main.home'))
-    page = request.args.get('page', 1, type=int)
+    after = request.args.get('after')
     per_page = current_app.config['PER_PAGE_GLOBAL']
-    posts, total = Post.search(g.search_form.q.data, page, per_page)
+    try:
+        posts, total, cursor = Post.search(g.search_form.q.data, per_page,
+                                           after)
+    except ValueError:
+        return redirect(url_for('main.search', q=g.search_form.q.data))
     if total == -1:
         abort(500)
     elif total == 0:
         return render_template('main/search.html', title='Search',
                                results=False)
-    next_url = url_for('main.search', q=g.search_form.q.data, page=page + 1) \
-        if total > page * per_page else None
-    prev_url = url_for('main.search', q=g.search_form.q.data, page=page - 1) \
-        if page > 1 else None
+    next_url = url_for('main.search', q=g.search_form.q.data, after=cursor) \
+        if cursor else None
+    prev_url = url_for('main.search', q=g.search_form.q.data) \
+        if after else None
     return render_template('main/search.html', title='Search', posts=posts,
                            next_url=next_url, prev_url=prev_url, results=True)
+
+
+@main.route("/search/suggest")
+def suggestions():
+    """The route function for the search suggestions.
+
+    Called by the search bar, while the user types (see the suggest
+    module for the debounce contract). Expects the prefix as the q
+    url parameter. The answer only depends on the prefix and the
+    posts, so browsers and proxies may cache it for SUGGEST_TTL.
+
+    ---
+
+    Returns
+    -------
+    json response, with query and suggestions keys
+    """
+
+    prefix = request.args.get('q', '')
+    response = jsonify(query=prefix, suggestions=suggest(prefix))
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config['SUGGEST_TTL']
+    return response
+
+
+@main.route("/sitemap.xml")
+def sitemap():
+    """The route function for the sitemap index.
+
+    List the shards of every kind (see the sitemap module).
+
+    ---
+
+    Returns
+    -------
+    streamed http response
+    """
+
+    return Response(stream_with_context(index_chunks()),
+                    mimetype='application/xml')
+
+
+@main.route("/sitemap-<string:kind>-<int:shard>.xml")
+def sitemap_shard(kind, shard):
+    """The route function for a shard of the sitemap.
+
+    Return a 404 if there's no such shard. Else, stream its xml.
+
+    ---
+
+    Parameters
+    ----------
+    kind: str
+        pages, posts, tags or books
+    shard: int
+        the number of the shard, from 0
+
+    Returns
+    -------
+    streamed http response
+    """
+
+    if kind not in KINDS or shard >= shard_count(kind):
+        abort(404)
+    return Response(stream_with_context(shard_chunks(kind, shard)),
+                    mimetype='application/xml')
+
+
+@main.route("/metrics")
+def metrics():
+    """The route function for the Prometheus metrics.
+
+    The metrics of every gunicorn worker, summed (see the metrics
+    module). If METRICS_TOKEN is set, scrapers must send it as a
+    bearer token, anyone else gets a 404. Without it, they're only
+    served to the admin, unless METRICS_PUBLIC (development and tests).
+
+    ---
+
+    Returns
+    -------
+    http response, in the Prometheus text format
+    """
+
+    token = current_app.config['METRICS_TOKEN']
+    if token:
+        if not hmac.compare_digest(request.headers.get('Authorization', ''),
+                                   f'Bearer {token}'):
+            abort(404)
+    elif not current_app.config['METRICS_PUBLIC'] and not (
+            current_user.is_authenticated and current_user.is_admin):
+        abort(404)
+    return Response(exposition(),
+                    mimetype='text/plain; version=0.0.4; charset=utf-8')
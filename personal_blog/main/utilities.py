@@ -5,12 +5,12 @@
 Functions
 ---------
 sidebar_posts(): dict
-    the function that gets the posts to be displayed on the sidebar
+    the function that gives templates the posts of the sidebar
 before_request(): None
     the function executed before each request
 """
 
-from flask import current_app, g
+from flask import g
 
 
 from personal_blog.models import Post
@@ -18,22 +18,25 @@ from personal_blog.main.forms import SearchForm
 from personal_blog.main.routes import main
 
 
-@current_app.context_processor
+@main.app_context_processor
 def sidebar_posts():
-    """The function that gets the posts to be displayed on the sidebar.
+    """The function that gives templates the posts of the sidebar.
 
-    Get the 5 latest posts. Return a dict with 1 element.
-    The key is sidebar_posts, the value is the posts collected earlier.
+    Return a dict with 1 element. The key is sidebar_posts, the value
+    a function which gets the 5 latest posts. The sidebar is a cached
+    fragment, so the posts are only queried when it's rendered.
 
     ---
 
     Returns
     -------
-    dict with a sidebar_posts key and the posts list as a value
+    dict with a sidebar_posts key and the function as a value
     """
 
-    posts = Post.query.order_by(Post.date_posted.desc()).limit(5).all()
-    return dict(sidebar_posts=posts)
+    def latest_posts():
+        return Post.query.order_by(Post.date_posted.desc()).limit(5).all()
+
+    return dict(sidebar_posts=latest_posts)
 
 
 @main.before_app_request
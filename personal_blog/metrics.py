@@ -0,0 +1,528 @@
+"""A module used to collect metrics, and expose them to Prometheus.
+
+Every process records its metrics in memory: request latencies per
+endpoint, requests in flight, SQL statements, elasticsearch calls,
+cache hits and the mail and image queues. Recording is a few dict
+updates, no I/O.
+
+Gunicorn workers share no memory, and a scrape only reaches one of
+them. So under gunicorn (see gunicorn_config.py), every worker writes
+a snapshot of its metrics to its own file in METRICS_PATH, every
+METRICS_FLUSH_INTERVAL seconds, from a background thread. A scrape
+sums the files of every worker. When a worker exits, the master folds
+its counters and histograms into an archive file, so totals don't go
+back down on worker recycling, and drops its gauges. Files are read
+and folded under a file lock, so a scrape never sees a worker both in
+the archive and in its own file.
+
+---
+
+Classes
+-------
+Registry
+    the metrics of the current process
+
+Functions
+---------
+init_metrics(app): return None
+    time the requests of the app, and count its SQL statements
+instrument_elasticsearch(es): return None
+    time the requests of an elasticsearch client
+tracked(name): context manager
+    count a piece of work in the gauge name, while it runs
+start_flusher(app): return None
+    write the metrics of this worker to its file, periodically
+flush(path): return None
+    write the metrics of this process to its file
+mark_process_dead(path, pid): return None
+    fold the file of an exited worker into the archive
+clear(path): return None
+    remove the files of a previous run
+exposition(): return str
+    the metrics of all workers, in the Prometheus text format
+
+Attributes
+----------
+METRICS: dict
+    name: (type, help text) of every metric
+registry: Registry
+    the metrics of the current process
+"""
+
+import fcntl
+import json
+import os
+import time
+from contextlib import contextmanager
+from threading import Lock, Thread
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from personal_blog.cache import CACHES
+
+METRICS = {
+    'http_requests_total': (
+        'counter', 'HTTP requests, by endpoint, method and status.'),
+    'http_request_duration_seconds': (
+        'histogram', 'HTTP request latency, by endpoint.'),
+    'http_requests_in_flight': (
+        'gauge', 'HTTP requests being served.'),
+    'db_statements_total': (
+        'counter', 'SQL statements executed.'),
+    'db_statement_duration_seconds_total': (
+        'counter', 'Time spent executing SQL statements.'),
+    'elasticsearch_request_duration_seconds': (
+        'histogram', 'Elasticsearch request latency, by operation.'),
+    'elasticsearch_errors_total': (
+        'counter', 'Failed elasticsearch requests, by operation and error.'),
+    'cache_hits_total': (
+        'counter', 'Hits of the in-process caches, by cache.'),
+    'cache_misses_total': (
+        'counter', 'Misses of the in-process caches, by cache.'),
+    'mail_queue_depth': (
+        'gauge', 'Emails waiting to be sent.'),
+    'image_queue_depth': (
+        'gauge', 'Uploaded images being resized.'),
+}
+
+ARCHIVE = 'archive.json'
+LOCK = 'metrics.lock'
+
+
+class Registry:
+    """The metrics of the current process.
+
+    Series are keyed by (metric name, tuple of (label, value) pairs).
+    A histogram is a list of the counts of every bucket (the last one
+    is +Inf), followed by the sum of the observed values.
+
+    ---
+
+    Methods
+    -------
+    inc(self, name, amount, **labels): return None
+        add amount to a counter or a gauge
+    observe(self, name, value, **labels): return None
+        add value to a histogram
+    snapshot(self): return dict
+        a JSON-able copy of all series
+    reset(self): return None
+        drop all series
+    """
+
+    def __init__(self, buckets=(.005, .01, .025, .05, .1, .25, .5, 1,
+                                2.5, 5, 10)):
+        self.buckets = tuple(buckets)
+        self.path = None  # the metrics folder, once shared by workers
+        self.dirty = False
+        self._lock = Lock()
+        self._values = {}
+        self._histograms = {}
+
+    def inc(self, name, amount=1, **labels):
+        """Add amount to the counter or gauge name (can be negative)."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+            self.dirty = True
+
+    def observe(self, name, value, **labels):
+        """Add value to the histogram name."""
+        key = (name, tuple(sorted(labels.items())))
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self._lock:
+            series = self._histograms.get(key)
+            if series is None:
+                series = self._histograms[key] = \
+                    [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+            self.dirty = True
+
+    def snapshot(self):
+        """Return a JSON-able copy of all series."""
+        with self._lock:
+            for cache in CACHES:  # counted by the caches themselves
+                self._values[('cache_hits_total',
+                              (('cache', cache.name),))] = cache.hits
+                self._values[('cache_misses_total',
+                              (('cache', cache.name),))] = cache.misses
+            self.dirty = False
+            return {
+                'buckets': list(self.buckets),
+                'values': [[name, labels, value] for (name, labels), value
+                           in self._values.items()],
+                'histograms': [[name, labels, list(series)]
+                               for (name, labels), series
+                               in self._histograms.items()],
+            }
+
+    def reset(self):
+        """Drop all series."""
+        with self._lock:
+            self._values.clear()
+            self._histograms.clear()
+            self.dirty = False
+
+
+registry = Registry()
+
+
+def _before_request():
+    """Count the request in flight, and start its clock."""
+    g.metrics_start = time.perf_counter()
+    registry.inc('http_requests_in_flight')
+
+
+def _after_request(response):
+    """Remember the status of the response, for the teardown."""
+    g.metrics_status = response.status_code
+    return response
+
+
+def _teardown_request(error):
+    """Record the latency and status of the request."""
+    start = g.pop('metrics_start', None)
+    if start is None:
+        return
+    registry.inc('http_requests_in_flight', -1)
+    # one series per route, not per url, 'none' for unknown urls
+    endpoint = request.url_rule.endpoint if request.url_rule else 'none'
+    status = 500 if error else g.pop('metrics_status', 500)
+    registry.inc('http_requests_total', endpoint=endpoint,
+                 method=request.method, status=str(status))
+    registry.observe('http_request_duration_seconds',
+                     time.perf_counter() - start, endpoint=endpoint)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    # on the context, which goes away with the statement, even if the
+    # statement fails and there's no after_cursor_execute
+    if context is not None:
+        context._metrics_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    registry.inc('db_statements_total')
+    start = getattr(context, '_metrics_start', None)
+    if start is not None:
+        registry.inc('db_statement_duration_seconds_total',
+                     time.perf_counter() - start)
+
+
+def init_metrics(app):
+    """Time the requests of the app, and count its SQL statements.
+
+    Statements are counted for every engine, of every app of the
+    process (i.e. the primary and the replica databases).
+
+    ---
+
+    Parameters
+    ----------
+    app: Flask instance
+        the application
+    """
+
+    registry.buckets = tuple(app.config['METRICS_BUCKETS'])
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    if not event.contains(Engine, 'before_cursor_execute',
+                          _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def _operation(method, url):
+    """Return the operation of an elasticsearch request (i.e. _search)."""
+    parts = [part for part in url.split('?')[0].split('/')
+             if part.startswith('_')]
+    return parts[-1] if parts else method
+
+
+def instrument_elasticsearch(es):
+    """Time the requests of an elasticsearch client, count the errors.
+
+    ---
+
+    Parameters
+    ----------
+    es: Elasticsearch instance
+        the client
+    """
+
+    perform_request = es.transport.perform_request
+
+    def timed(method, url, *args, **kwargs):
+        operation = _operation(method, url)
+        start = time.perf_counter()
+        try:
+            return perform_request(method, url, *args, **kwargs)
+        except Exception as error:
+            registry.inc('elasticsearch_errors_total', operation=operation,
+                         error=type(error).__name__)
+            raise
+        finally:
+            registry.observe('elasticsearch_request_duration_seconds',
+                             time.perf_counter() - start,
+                             operation=operation)
+
+    es.transport.perform_request = timed
+
+
+@contextmanager
+def tracked(name):
+    """Count a piece of work in the gauge name, while it runs.
+
+    ---
+
+    Parameters
+    ----------
+    name: str
+        a gauge of METRICS (i.e. 'image_queue_depth')
+    """
+
+    registry.inc(name)
+    try:
+        yield
+    finally:
+        registry.inc(name, -1)
+
+
+def _filename(path, pid):
+    """Return the file of the metrics of the process pid."""
+    return os.path.join(path, f'worker-{pid}.json')
+
+
+@contextmanager
+def _locked(path, exclusive):
+    """Hold the lock of the metrics folder, shared or exclusive."""
+    with open(os.path.join(path, LOCK), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _write(filename, snapshot):
+    """Write a snapshot to filename, atomically."""
+    temporary = f'{filename}.{os.getpid()}.tmp'
+    with open(temporary, 'w') as f:
+        json.dump(snapshot, f, separators=(',', ':'))
+    os.replace(temporary, filename)
+
+
+def _read(filename):
+    """Return the snapshot in filename, None if there's none."""
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def flush(path):
+    """Write the metrics of this process to its file.
+
+    ---
+
+    Parameters
+    ----------
+    path: str
+        the metrics folder
+    """
+
+    _write(_filename(path, os.getpid()), registry.snapshot())
+
+
+def start_flusher(app):
+    """Write the metrics of this worker to its file, periodically.
+
+    Called in every gunicorn worker, right after it's forked. The
+    series inherited from the master are dropped first. Does nothing
+    else if METRICS_PATH isn't set, then a scrape only sees the worker
+    which answers it.
+
+    ---
+
+    Parameters
+    ----------
+    app: Flask instance
+        the application
+    """
+
+    registry.reset()
+    path = app.config['METRICS_PATH']
+    if not path:
+        return
+    os.makedirs(path, exist_ok=True)
+    registry.path = path
+    interval = app.config['METRICS_FLUSH_INTERVAL']
+
+    def run():
+        while True:
+            time.sleep(interval)
+            if registry.dirty:
+                flush(path)
+
+    Thread(target=run, name='metrics-flusher', daemon=True).start()
+
+
+def _merge(into, snapshot, gauges=True):
+    """Add the series of snapshot to the series of into."""
+    into.setdefault('buckets', snapshot['buckets'])
+    values = {(name, tuple(map(tuple, labels))): value
+              for name, labels, value in into.get('values', ())}
+    for name, labels, value in snapshot['values']:
+        if gauges or METRICS[name][0] != 'gauge':
+            key = (name, tuple(map(tuple, labels)))
+            values[key] = values.get(key, 0) + value
+    histograms = {(name, tuple(map(tuple, labels))): series
+                  for name, labels, series in into.get('histograms', ())}
+    for name, labels, series in snapshot['histograms']:
+        key = (name, tuple(map(tuple, labels)))
+        total = histograms.get(key)
+        histograms[key] = series if total is None else \
+            [a + b for a, b in zip(total, series)]
+    into['values'] = [[name, labels, value]
+                      for (name, labels), value in values.items()]
+    into['histograms'] = [[name, labels, series]
+                          for (name, labels), series in histograms.items()]
+    return into
+
+
+def mark_process_dead(path, pid):
+    """Fold the file of an exited worker into the archive.
+
+    Its counters and histograms keep counting in the totals, its
+    gauges are dropped. Called by the gunicorn master.
+
+    ---
+
+    Parameters
+    ----------
+    path: str
+        the metrics folder
+    pid: int
+        the process id of the worker
+    """
+
+    filename = _filename(path, pid)
+    snapshot = _read(filename)
+    if snapshot is None:
+        return
+    with _locked(path, exclusive=True):
+        archive = _read(os.path.join(path, ARCHIVE)) or {}
+        _write(os.path.join(path, ARCHIVE),
+               _merge(archive, snapshot, gauges=False))
+        os.remove(filename)
+
+
+def clear(path):
+    """Remove the files of a previous run, when the server starts.
+
+    ---
+
+    Parameters
+    ----------
+    path: str
+        the metrics folder
+    """
+
+    os.makedirs(path, exist_ok=True)
+    for name in os.listdir(path):
+        if name.endswith('.json'):
+            os.remove(os.path.join(path, name))
+
+
+def _alive(pid):
+    """Return True if the process pid is running."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _collect(path):
+    """Return the metrics of all workers, summed."""
+    flush(path)  # this worker's latest
+    total = {'buckets': list(registry.buckets), 'values': [],
+             'histograms': []}
+    with _locked(path, exclusive=False):
+        for name in os.listdir(path):
+            if name == ARCHIVE:
+                snapshot, gauges = _read(os.path.join(path, name)), False
+            elif name.startswith('worker-') and name.endswith('.json'):
+                snapshot = _read(os.path.join(path, name))
+                # a worker which exited, not folded into the archive yet
+                gauges = _alive(int(name[len('worker-'):-len('.json')]))
+            else:
+                continue
+            if snapshot and snapshot['buckets'] == total['buckets']:
+                _merge(total, snapshot, gauges)
+    return total
+
+
+def _labels(labels, extra=()):
+    """Format labels as {name="value",...}."""
+    pairs = [*labels, *extra]
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"')
+               .replace('\n', r'\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value
+                          in zip(pairs, escaped)) + '}'
+
+
+def exposition():
+    """Return the metrics of all workers, in the Prometheus text format.
+
+    Only the metrics of this process, if they aren't shared through
+    files (see start_flusher()).
+
+    ---
+
+    Returns
+    -------
+    str
+    """
+
+    metrics = _collect(registry.path) if registry.path else \
+        _merge({}, registry.snapshot())
+    series = {}
+    for name, labels, value in metrics['values']:
+        series.setdefault(name, []).append((labels, value))
+    for name, labels, counts in metrics['histograms']:
+        series.setdefault(name, []).append((labels, counts))
+    bounds = [f'{bound:g}' for bound in metrics['buckets']] + ['+Inf']
+    lines = []
+    for name, (type_, text) in METRICS.items():
+        lines += [f'# HELP {name} {text}', f'# TYPE {name} {type_}']
+        if type_ == 'gauge' and name not in series:
+            lines.append(f'{name} 0')  # nothing queued yet
+        for labels, value in sorted(series.get(name, ())):
+            if type_ != 'histogram':
+                lines.append(f'{name}{_labels(labels)} {value}')
+                continue
+            cumulative = 0
+            for bound, count in zip(bounds, value):
+                cumulative += count
+                lines.append(f'{name}_bucket'
+                             f"{_labels(labels, [('le', bound)])} "
+                             f'{cumulative}')
+            lines.append(f'{name}_sum{_labels(labels)} {value[-1]}')
+            lines.append(f'{name}_count{_labels(labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
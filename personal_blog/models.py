@@ -4,14 +4,20 @@
 
 Functions
 ---------
-load_user(user_id): return an instance of class User
+load_user(user_id): return an instance of class CachedUser
     used by login_manager extension for loading users
+invalidate_user(user_id): return None
+    drop the cached snapshot of a user, in every worker
+bump_post_versions(post_ids, titles): return None
+    mark posts as changed, for the caches of every worker
 
 
 Classes
 -------
 SearchableMixin: SearchableMixin
     mixin class which provides full-text search functionality
+CachedUser: inherits from flask_login.UserMixin
+    read-only snapshot of a user, which doesn't need a db session
 User: inherits from SQLAlchemy.Model and flask_login.UserMixin
     db class used for modelling user records
 Post: inherits from SQLAlchemy.Model and SearchableMixin
@@ -24,19 +30,81 @@ Book: inherits from SQLAlchemy.Model
     db class used for modelling book records
 """
 
+import time
 from datetime import datetime
+from itertools import chain
 
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
 from flask import current_app
 from flask_login import UserMixin
 
-from personal_blog import db, login_manager
-from personal_blog.search import add_to_index, remove_from_index, query_index
+from personal_blog import db, login_manager, store
+from personal_blog.cache import user_cache
+from personal_blog.search import add_to_index, rebuild_index,\
+    remove_from_index, query_index
 
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    """Load the logged in user, from the cache if possible.
+
+    Called on every request of a logged in user, static files aside.
+    Look up the snapshot in the worker's user cache. It's used as is
+    for USER_VERSION_CHECK seconds after it was last checked, without
+    asking the shared store (changes made by another worker show up
+    that late, this worker's own changes right away). Then it's still
+    valid if the user's version in the shared store hasn't changed
+    since it was taken (see invalidate_user()), and the check time is
+    moved forward. Else, query the user, and cache a fresh snapshot.
+
+    ---
+
+    Parameters
+    ----------
+    user_id: str
+        the id stored in the session cookie
+
+    Returns
+    -------
+    CachedUser instance, or None if there's no user with that id
+    """
+
+    user_id = int(user_id)
+    now = time.monotonic()
+    cached = user_cache.get(user_id)  # [version, snapshot, checked at]
+    if cached is not None and \
+            now - cached[2] < current_app.config['USER_VERSION_CHECK']:
+        return cached[1]
+    version = store.get(f'version:user:{user_id}')
+    if cached is not None and cached[0] == version:
+        cached[2] = now
+        return cached[1]
+    user = User.query.get(user_id)
+    if user is None:
+        return None
+    snapshot = CachedUser(user)
+    user_cache.set(user_id, [version, snapshot, now],
+                   current_app.config['USER_CACHE_TTL'])
+    return snapshot
+
+
+def invalidate_user(user_id):
+    """Drop the cached snapshot of a user, in every worker.
+
+    Call it after commiting changes to a user record.
+    Bumping the user's version in the shared store makes the
+    snapshots cached by other workers stale too.
+
+    ---
+
+    Parameters
+    ----------
+    user_id: int
+        the id of the updated/deleted user
+    """
+
+    store.incr(f'version:user:{user_id}')
+    user_cache.pop(user_id)
 
 
 class SearchableMixin():
@@ -46,21 +114,22 @@ class SearchableMixin():
 
     Class Methods
     -------------
-    search(cls, expression, page, per_page): return result set, total
+    search(cls, expression, per_page, after): return result set, total,
+    cursor
         search for the given expression and paginate results
     before_commit(cls, session): return None
         store session changes before they are commited (and lost)
     after_commit: return None
         add the stored session changes to the index database
-    reindex(cls): return None
+    reindex(cls): return int
         reindex (to the index database) the caller table
     """
 
     @classmethod
-    def search(cls, expression, page, per_page):
+    def search(cls, expression, per_page, after=None):
         """Search for the given expression and paginate results.
 
-        Get the matching posts' ids and their total.
+        Get the matching posts' ids, their total and the next cursor.
         Depending on total's value, different actions are taken.
         If the total is -1, elastic server isn't set up or running.
         That's still okay, because the search feature is optional.
@@ -73,10 +142,15 @@ class SearchableMixin():
         ----------
         expression: str
             the text to search for
-        page: int
-            the current page number of the (paginated) result set
         per_page: int
             the number by which pages are being paginated
+        after: str or None
+            the cursor of the page, None for the first one
+
+        Raises
+        ------
+        ValueError
+            if the cursor is malformed or expired
 
         Returns
         -------
@@ -84,18 +158,21 @@ class SearchableMixin():
             it's empty when the total is -1 or zero
         the total: int
             can be -1, 0 or a natural number, see description above
+        the cursor of the next page: str
+            None if this is the last one
         """
 
-        ids, total = query_index(cls.__tablename__, expression, page, per_page)
+        ids, total, cursor = query_index(cls.__tablename__, expression,
+                                         per_page, after)
         if total == -1:
-            return cls.query.filter_by(id=0), -1
-        elif total == 0:
-            return cls.query.filter_by(id=0), 0
+            return cls.query.filter_by(id=0), -1, None
+        elif total == 0 or not ids:
+            return cls.query.filter_by(id=0), total, None
         when = []
         for i in range(len(ids)):
             when.append((ids[i], i))
         return cls.query.filter(cls.id.in_(ids)).order_by(
-            db.case(when, value=cls.id)), total
+            db.case(when, value=cls.id)), total, cursor
 
     @classmethod
     def before_commit(cls, session):
@@ -138,15 +215,126 @@ class SearchableMixin():
 
     @classmethod
     def reindex(cls):
-        """Reindex to the index database the caller table class."""
-        for obj in cls.query:
-            add_to_index(cls.__tablename__, obj)
+        """Rebuild the index of the caller table class, swap it in.
+
+        Return the number of records indexed.
+        """
+
+        return rebuild_index(cls.__tablename__, cls.query.yield_per(1000))
 
 
 db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
 
 
+def bump_post_versions(post_ids, titles=True):
+    """Mark posts as changed, for the caches of every worker.
+
+    Bump the version of every post, and the version of all posts,
+    in the shared store. Caches built from posts (i.e. feeds) key
+    their entries by these versions. Called after every commit which
+    touches posts, tags or comments, and by bulk writes, which the
+    session doesn't see. The version of titles is only bumped when
+    titles, dates or tags changed, not for every comment, it keys the
+    title/tag suggestions (see the suggest module).
+
+    ---
+
+    Parameters
+    ----------
+    post_ids: iterable of int
+        the ids of the inserted/updated/deleted posts
+    titles: bool
+        whether the titles, dates or tags of these posts changed
+    """
+
+    post_ids = set(post_ids)
+    for post_id in post_ids:
+        store.incr(f'version:post:{post_id}')
+    if post_ids:
+        store.incr('version:posts')
+        if titles:
+            store.incr('version:titles')
+
+
+def _collect_changes(session, flush_context):
+    """Remember the posts (or their children) and books a flush touched.
+
+    Also whether any post title, date or tag changed: a new comment
+    changes its post, but none of these.
+    """
+
+    changed = session.info.setdefault('changed_posts', set())
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, Post):
+            changed.add(obj.id)
+            state = db.inspect(obj)
+            if obj not in session.dirty or any(
+                    state.attrs[name].history.has_changes()
+                    for name in ('title', 'date_posted')):
+                session.info['changed_titles'] = True
+        elif isinstance(obj, (Tag, Comment)):
+            changed.add(obj.post_id)
+            if isinstance(obj, Tag):
+                session.info['changed_titles'] = True
+        elif isinstance(obj, Book):
+            session.info['changed_books'] = True
+
+
+def _bump_versions(session):
+    """Bump the versions of what the transaction touched."""
+    bump_post_versions(session.info.pop('changed_posts', ()),
+                       session.info.pop('changed_titles', False))
+    if session.info.pop('changed_books', False):
+        store.incr('version:books')
+
+
+def _forget_changes(session):
+    """Drop the changes collected by a rolled back transaction."""
+    session.info.pop('changed_posts', None)
+    session.info.pop('changed_titles', None)
+    session.info.pop('changed_books', None)
+
+
+db.event.listen(db.session, 'after_flush', _collect_changes)
+db.event.listen(db.session, 'after_commit', _bump_versions)
+db.event.listen(db.session, 'after_rollback', _forget_changes)
+
+
+class CachedUser(UserMixin):
+    """Read-only snapshot of a user, which doesn't need a db session.
+
+    Used as current_user, so templates and permission checks don't
+    need a User query on every request. Routes which modify the user
+    should query the User record by id instead.
+    Compares equal to the User instance (or snapshot) with the same id.
+
+    ---
+
+    Class variables
+    ---------------
+    columns : tuple(str)
+        names of the User columns copied into the snapshot
+    """
+
+    columns = ('id', 'username', 'email', 'profile_pic', 'is_admin')
+
+    def __init__(self, user):
+        for column in self.columns:
+            setattr(self, column, getattr(user, column))
+
+    def __eq__(self, other):
+        if isinstance(other, (User, CachedUser)):
+            return self.id == other.id
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return f"Cached user: {self.username}, \nEmail: {self.email}\n"
+
+
 class User(db.Model, UserMixin):
     """ORM class used for modelling users and their behavior.
 
@@ -262,7 +450,11 @@ class Post(SearchableMixin, db.Model):
     content: SQLALchemy.Column
         text, mandatory
     user_id: SQLALchemy.Column
-        integer, foreign key, points to User.id
+        integer, foreign key, points to User.id, indexed
+    comment_count: SQLALchemy.Column
+        integer, mandatory, defaults to 0, the number of comments
+    last_comment_at: SQLALchemy.Column
+        datetime, the date of the latest comment, if there's any
     tags: SQLAlchemy.relationship
         every tag record has a parent post, delete on cascade
     comments: SQLAlchemy.relationship
@@ -272,16 +464,26 @@ class Post(SearchableMixin, db.Model):
     -------
     __repr__(self): str
         string representation of a Post instance
+    add_comment(cls, comment): return None
+        count a new comment in its post, in the same transaction
+    refresh_comment_stats(cls, post_ids): return int
+        recount the comments of posts, to repair drift
     """
 
-    __searchable__ = ['content']
+    __searchable__ = ['title', 'content', 'date_posted']
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(120), index=True, nullable=False)
     date_posted = db.Column(db.DateTime, nullable=False, index=True,
                             default=datetime.utcnow)
     content = db.Column(db.Text, nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False,
+                        index=True)
     # 'user' above is in lowercase because it references the table name
+    # comment_count and last_comment_at are denormalized from Comment,
+    # so that listings show activity without a COUNT per post
+    comment_count = db.Column(db.Integer, nullable=False, default=0,
+                              server_default='0')
+    last_comment_at = db.Column(db.DateTime)
     comments = db.relationship('Comment', cascade='all,delete',
                                backref='parent_post', lazy=True)
     tags = db.relationship('Tag', cascade='all,delete', backref='parent_post',
@@ -290,6 +492,70 @@ class Post(SearchableMixin, db.Model):
     def __repr__(self):
         return f"Blog post: {self.title}, \nPosted on: {self.date_posted}\n"
 
+    @classmethod
+    def add_comment(cls, comment):
+        """Count a new comment in its post, in the same transaction.
+
+        Add the comment to the session, and increment the counter in
+        the database (UPDATE ... SET comment_count = comment_count + 1),
+        so concurrent comments don't overwrite each other's counts.
+        The caller commits both.
+
+        ---
+
+        Parameters
+        ----------
+        comment: Comment instance
+            the new comment, with its post_id set
+        """
+
+        if comment.date_posted is None:
+            comment.date_posted = datetime.utcnow()
+        db.session.add(comment)
+        cls.query.filter_by(id=comment.post_id).update(
+            {cls.comment_count: cls.comment_count + 1,
+             cls.last_comment_at: comment.date_posted},
+            synchronize_session=False)
+
+    @classmethod
+    def refresh_comment_stats(cls, post_ids=None):
+        """Recount the comments of posts, to repair drift.
+
+        Call it, before commiting, after deleting comments in bulk
+        (i.e. those of a deleted user). The session is flushed first,
+        so that the deletions are counted.
+
+        ---
+
+        Parameters
+        ----------
+        post_ids: iterable of int, or None
+            the ids of the posts to recount, None for every drifted one
+
+        Returns
+        -------
+        the number of posts updated
+        """
+
+        db.session.flush()
+        count = db.select([db.func.count(Comment.id)]).where(
+            Comment.post_id == cls.id).as_scalar()
+        last = db.select([db.func.max(Comment.date_posted)]).where(
+            Comment.post_id == cls.id).as_scalar()
+        query = cls.query
+        if post_ids is None:
+            query = query.filter(db.or_(
+                cls.comment_count != count,
+                cls.last_comment_at.is_distinct_from(last)))
+        else:
+            post_ids = list(post_ids)
+            if not post_ids:
+                return 0
+            query = query.filter(cls.id.in_(post_ids))
+        return query.update({cls.comment_count: count,
+                             cls.last_comment_at: last},
+                            synchronize_session=False)
+
 
 class Comment(db.Model):
     """ORM class used for modelling comments.
@@ -301,6 +567,9 @@ class Comment(db.Model):
 
     Class variables
     ---------------
+    __table_args__ : tuple
+        composite index on (post_id, date_posted), which serves
+        fetching the comments of a post in date order
     id : SQLALchemy.Column
         integer, primary key
     date_posted: SQLALchemy.Column
@@ -308,7 +577,7 @@ class Comment(db.Model):
     content: SQLALchemy.Column
         text, mandatory
     user_id: SQLALchemy.Column
-        integer, foreign key, points to User.id
+        integer, foreign key, points to User.id, indexed
     post_id: SQLALchemy.Column
         integer, foreign key, points to Post.id
 
@@ -318,11 +587,15 @@ class Comment(db.Model):
         string representation of a Comment
     """
 
+    __table_args__ = (
+        db.Index('ix_comment_post_id_date_posted', 'post_id', 'date_posted'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     date_posted = db.Column(db.DateTime, nullable=False, index=True,
                             default=datetime.utcnow)
     content = db.Column(db.Text, nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False,
+                        index=True)
     post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False)
 
     def __repr__(self):
@@ -340,12 +613,15 @@ class Tag(db.Model):
 
     Class variables
     ---------------
+    __table_args__ : tuple
+        composite index on (content, post_id), which serves looking
+        up (and counting) the posts of a tag without touching the table
     id : SQLALchemy.Column
         integer, primary key
     content: SQLALchemy.Column
         string, mandatory
     post_id: SQLALchemy.Column
-        integer, foreign key, points to Post.id
+        integer, foreign key, points to Post.id, indexed
 
     Methods
     -------
@@ -353,9 +629,13 @@ class Tag(db.Model):
         string representation of a Tag
     """
 
+    __table_args__ = (
+        db.Index('ix_tag_content_post_id', 'content', 'post_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.String(20), nullable=False)
-    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False,
+                        index=True)
 
     def __repr__(self):
         return f"Tag {self.id} for post {self.post_id}\n"
@@ -8,6 +8,8 @@ new_post(): return http response
     the route for creating a new post
 post(post_id): return http response
     the route for displaying a post with that id
+post_comments(post_id): return json response
+    the route for getting the next page of a post's comments
 update_post(post_id): return http response
     the route for updating a post with that id
 delete_post(post_id): return http response
@@ -20,6 +22,10 @@ posts_by_tag(tag_content): return http response
     the route for displaying all posts with that tag
 tags(): return http response
     the route for displaying all posts, grouped by tag
+feed(): return http response
+    the route for the Atom feed of the latest posts
+tag_feed(tag_content): return http response
+    the route for the Atom feed of the latest posts with that tag
 uploaded_files(filename): return http response, file url
     the route for getting the static file with that filename
 upload(): return http response, file url
@@ -30,14 +36,16 @@ import os
 from secrets import token_hex
 
 from flask import Blueprint, render_template, url_for, flash, redirect,\
-    request, abort, send_from_directory, current_app
+    request, abort, send_from_directory, current_app, jsonify
 from flask_login import current_user, login_required
 from flask_ckeditor import upload_fail, upload_success
 
 from personal_blog import db
+from personal_blog.feeds import build_feed
 from personal_blog.models import Post, Tag, Comment
 from personal_blog.posts.forms import PostForm, CommentForm
-from personal_blog.posts.utilities import delete_post_images
+from personal_blog.posts.utilities import delete_post_images,\
+    comments_page
 
 posts = Blueprint('posts', __name__)
 
@@ -64,7 +72,7 @@ def new_post():
     form = PostForm()
     if form.validate_on_submit():
         post = Post(title=form.title.data, content=form.content.data,
-                    author=current_user)
+                    user_id=current_user.id)
         db.session.add(post)
         # add tags
         tags = form.tags.data
@@ -86,7 +94,9 @@ def post(post_id):
     """The route function for displaying a post with that id.
 
     Get the post with that id, or return a 404.
-    Get the comments for the post, ordered by date posted.
+    Get the first page of the post's comments, ordered by date
+    posted. The next pages are fetched on scroll, from
+    post_comments().
     Get the tags for the post. Render the template.
 
     ---
@@ -102,11 +112,44 @@ def post(post_id):
     """
 
     post = Post.query.get_or_404(post_id)
-    comments = Comment.query.filter_by(post_id=post_id).order_by(
-            Comment.date_posted.asc())
+    comments, next_cursor = comments_page(
+        post_id, None, current_app.config['COMMENTS_PER_PAGE'])
     tags = Tag.query.filter_by(post_id=post_id)
     return render_template('posts/post.html', title=post.title, post=post,
-                           comments=comments, tags=tags)
+                           comments=comments, next_cursor=next_cursor,
+                           tags=tags)
+
+
+@posts.route("/post/<int:post_id>/comments")
+def post_comments(post_id):
+    """The route function for getting the next page of a post's comments.
+
+    Get the cursor of the page from the 'after' query argument.
+    Return a 400 if it's malformed.
+    Render the page's comments as an html fragment, and return it
+    in json, along with the cursor of the next page (null if it's
+    the last one).
+
+    ---
+
+    Parameters
+    ----------
+    post_id: int
+        the id of the post whose comments are fetched
+
+    Returns
+    -------
+    json response
+    """
+
+    try:
+        comments, next_cursor = comments_page(
+            post_id, request.args.get('after'),
+            current_app.config['COMMENTS_PER_PAGE'])
+    except ValueError:
+        abort(400)
+    html = render_template('posts/_comments.html', comments=comments)
+    return jsonify(html=html, next=next_cursor)
 
 
 @posts.route("/post/<int:post_id>/update", methods=['GET', 'POST'])
@@ -135,7 +178,7 @@ def update_post(post_id):
     """
 
     post = Post.query.get_or_404(post_id)
-    if post.author != current_user:
+    if post.user_id != current_user.id:
         abort(403)  # forbidden route
     form = PostForm()
     form.submit.label.text = 'Update'
@@ -186,7 +229,7 @@ def delete_post(post_id):
     """
 
     post = Post.query.get_or_404(post_id)
-    if post.author != current_user:
+    if post.user_id != current_user.id:
         abort(403)  # forbidden route
     content = post.content
     db.session.delete(post)
@@ -223,7 +266,9 @@ def comment(post_id):
     """The route function for adding a comment to that post.
 
     Get the post with that id, or return a 404.
-    If the form validates, create a comment record and commit it.
+    If the form validates, create a comment record, count it in
+    the post's comment stats (see Post.add_comment()), and commit
+    both.
     Flash the message, and redirect to the post.
     If it doesn't validate, simply render the template.
 
@@ -244,7 +289,7 @@ def comment(post_id):
     if form.validate_on_submit():
         comment = Comment(content=form.content.data, user_id=current_user.id,
                           post_id=post.id)
-        db.session.add(comment)
+        Post.add_comment(comment)
         db.session.commit()
         flash('Comment has been posted!', 'success')
         return redirect(url_for('posts.post', post_id=post.id))
@@ -303,6 +348,56 @@ def tags():
                            tags=tags)
 
 
+def _feed_response(tag):
+    """Serve a feed, or a 304 if the client's copy is up to date."""
+    feed = build_feed(tag)
+    response = current_app.response_class(
+        feed['xml'], mimetype='application/atom+xml')
+    response.set_etag(feed['etag'])
+    response.cache_control.public = True
+    response.cache_control.max_age = 300
+    return response.make_conditional(request)
+
+
+@posts.route("/feed.xml")
+def feed():
+    """The route function for the Atom feed of the latest posts.
+
+    Get the cached feed (see the feeds module). Return it with its
+    ETag header, or a 304 with no body if the request's If-None-Match
+    header matches it.
+
+    ---
+
+    Returns
+    -------
+    http response
+    """
+
+    return _feed_response(None)
+
+
+@posts.route("/all_posts/<string:tag_content>/feed.xml")
+def tag_feed(tag_content):
+    """The route function for the Atom feed of the posts with that tag.
+
+    Same as feed(), restricted to the posts with that tag.
+
+    ---
+
+    Parameters
+    ----------
+    tag_content: str
+        the tag whose posts are in the feed (i.e. 'django')
+
+    Returns
+    -------
+    http response
+    """
+
+    return _feed_response(tag_content)
+
+
 @posts.route('/files/<string:filename>')
 def uploaded_files(filename):
     """The route function used by Ckeditor for getting uploaded files.
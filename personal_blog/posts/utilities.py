@@ -6,10 +6,19 @@ Functions
 ---------
 delete_post_images(content, root_path): return None
     delete the image files associated with a post
+comments_page(post_id, after, per_page): return list, str
+    get a page of a post's comments, after a cursor
 """
 
 import re
 import os
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import selectinload
+
+from personal_blog.cursors import encode_cursor, decode_cursor
+from personal_blog.models import Comment
 
 
 def delete_post_images(content, root_path):
@@ -37,3 +46,51 @@ def delete_post_images(content, root_path):
         filename = match.group(1)
         filepath = os.path.join(root_path, 'static/post_images', filename)
         os.remove(filepath)
+
+
+def comments_page(post_id, after, per_page):
+    """Get a page of a post's comments, after a cursor.
+
+    Comments are ordered by (date_posted, id), the id breaking ties.
+    Instead of an offset, the page starts after the sort key in the
+    cursor, so the (post_id, date_posted) index leads straight to it.
+    One more comment than needed is fetched, to know if there's a
+    next page. The authors of the page are loaded in one more query.
+
+    ---
+
+    Parameters
+    ----------
+    post_id: int
+        the id of the post whose comments are fetched
+    after: str or None
+        the cursor returned with the previous page, None for the first
+    per_page: int
+        the number of comments per page
+
+    Raises
+    ------
+    ValueError
+        if the cursor is malformed
+
+    Returns
+    -------
+    list of Comment instances, and the cursor of the next page
+    (None if this is the last one)
+    """
+
+    query = Comment.query.filter(Comment.post_id == post_id)
+    if after:
+        date_posted, comment_id = decode_cursor(after, (datetime, int))
+        query = query.filter(or_(
+            Comment.date_posted > date_posted,
+            and_(Comment.date_posted == date_posted,
+                 Comment.id > comment_id)))
+    comments = query.options(selectinload(Comment.author)).order_by(
+        Comment.date_posted.asc(), Comment.id.asc()).limit(
+            per_page + 1).all()
+    if len(comments) <= per_page:
+        return comments, None
+    comments = comments[:per_page]
+    last = comments[-1]
+    return comments, encode_cursor(last.date_posted, last.id)
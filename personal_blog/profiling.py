@@ -0,0 +1,253 @@
+"""A module used to profile single requests in production, on demand.
+
+A slow route often can't be reproduced locally, with other data and
+load. The admin can profile one request of the live app, by adding
+the X-Profile: 1 header, or the _profile=1 query argument. It's run
+under a sampling profiler: a thread records the stack of the request
+thread every PROFILE_INTERVAL seconds, so the request runs at its
+normal speed. The profile is saved to PROFILE_PATH, both as a pstats
+file (for pstats, snakeviz...) and as collapsed stacks (for
+flamegraph.pl, speedscope...). The response carries its name in the
+X-Profile header, and /admin/profiles lists the latest ones.
+
+Requests without the switch aren't touched, besides checking for it.
+
+---
+
+Classes
+-------
+Sampler
+    a thread recording the stack of another thread, periodically
+
+Functions
+---------
+init_profiling(app): return None
+    profile the requests of the admin which ask for it
+list_profiles(path): return list(dict)
+    the saved profiles, latest first
+"""
+
+import marshal
+import os
+import sys
+import time
+from collections import Counter
+from datetime import datetime
+from threading import Event, Thread, get_ident
+
+from flask import current_app, g, request
+from flask_login import current_user
+
+SUFFIXES = ('.pstats', '.collapsed')
+
+
+class Sampler(Thread):
+    """A thread recording the stack of another thread, periodically.
+
+    Every sample is weighted by the time elapsed since the previous
+    one, since the sampler may wait longer than the interval for the
+    GIL, while the sampled thread is busy.
+
+    ---
+
+    Methods
+    -------
+    run(self): return None
+        record stacks until stopped
+    stop(self): return None
+        stop sampling, and wait for the thread
+    collapsed(self): return str
+        the samples as collapsed stacks, weighted in microseconds
+    pstats(self): return dict
+        the samples as pstats data
+    """
+
+    def __init__(self, thread_id, interval):
+        super().__init__(name='profile-sampler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stopped = Event()
+
+    def run(self):
+        """Record the stack of the thread until stopped."""
+        last = time.perf_counter()
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            now = time.perf_counter()
+            if self._stopped.is_set():
+                break  # the thread is waiting for stop() by now
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_filename, code.co_firstlineno,
+                              code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += now - last
+                self.samples += 1
+            last = now
+
+    def stop(self):
+        """Stop sampling, and wait for the thread."""
+        self._stopped.set()
+        self.join()
+
+    def collapsed(self):
+        """Return the samples as collapsed stacks, one per line.
+
+        Frames are separated by semicolons, root first, followed by
+        the time spent in the stack, in microseconds.
+        """
+
+        lines = []
+        for stack, seconds in self.stacks.items():
+            frames = ';'.join(f'{name} ({os.path.basename(filename)}:'
+                              f'{line})' for filename, line, name in stack)
+            lines.append(f'{frames} {round(seconds * 1e6)}')
+        return '\n'.join(lines) + '\n'
+
+    def pstats(self):
+        """Return the samples as the data of a pstats file.
+
+        Call counts are sample counts, times are sampled times.
+        """
+
+        stats = {}
+        for stack, seconds in self.stacks.items():
+            seen = set()
+            for depth, function in enumerate(stack):
+                entry = stats.setdefault(function, [0, 0, 0.0, 0.0, {}])
+                if function not in seen:  # recursion counts once
+                    seen.add(function)
+                    entry[0] += 1
+                    entry[1] += 1
+                    entry[3] += seconds
+                if depth:
+                    caller = entry[4].setdefault(stack[depth - 1],
+                                                 [0, 0, 0.0, 0.0])
+                    caller[0] += 1
+                    caller[1] += 1
+                    caller[3] += seconds
+                    if depth == len(stack) - 1:
+                        caller[2] += seconds
+            stats[stack[-1]][2] += seconds
+        return {function: (cc, nc, tt, ct, {caller: tuple(values)
+                                            for caller, values
+                                            in callers.items()})
+                for function, (cc, nc, tt, ct, callers) in stats.items()}
+
+
+def _wants_profile():
+    """Return True if the request asks to be profiled, by the admin."""
+    if request.headers.get('X-Profile') != '1' and \
+            request.args.get('_profile') != '1':
+        return False
+    return current_user.is_authenticated and current_user.is_admin
+
+
+def _start_profile():
+    """Start sampling the request thread, if it asks for it."""
+    if 'X-Profile' not in request.headers and \
+            '_profile' not in request.args:
+        return  # the only cost of requests which aren't profiled
+    if _wants_profile():
+        g.profile_start = time.perf_counter()
+        g.profile_sampler = Sampler(get_ident(),
+                                    current_app.config['PROFILE_INTERVAL'])
+        g.profile_sampler.start()
+
+
+def _stop_profile(response):
+    """Stop sampling, save the profile, and name it in the response.
+
+    A request shorter than the interval has no sample, so nothing to
+    save, only its duration.
+    """
+
+    sampler = g.pop('profile_sampler', None)
+    if sampler is None:
+        return response
+    sampler.stop()
+    ms = (time.perf_counter() - g.pop('profile_start')) * 1000
+    if not sampler.samples:
+        response.headers['X-Profile'] = f'none, done in {ms:.1f}ms'
+        return response
+    endpoint = request.url_rule.endpoint if request.url_rule else 'none'
+    name = f'{datetime.utcnow():%Y%m%d-%H%M%S-%f}-{endpoint}-{ms:.0f}ms'
+    path = current_app.config['PROFILE_PATH']
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, name + '.pstats'), 'wb') as f:
+        marshal.dump(sampler.pstats(), f)
+    with open(os.path.join(path, name + '.collapsed'), 'w') as f:
+        f.write(sampler.collapsed())
+    for profile in list_profiles(path)[current_app.config['PROFILE_KEEP']:]:
+        for suffix in SUFFIXES:
+            os.remove(os.path.join(path, profile['name'] + suffix))
+    response.headers['X-Profile'] = name
+    return response
+
+
+def _discard_profile(error):
+    """Stop sampling a request which failed before its response."""
+    sampler = g.pop('profile_sampler', None)
+    if sampler is not None:
+        sampler.stop()
+
+
+def init_profiling(app):
+    """Profile the requests of the admin which ask for it.
+
+    The current user is only loaded to check the switch, when it's
+    there. The sampler stops after the response is made, templates
+    included. If the request fails, it's stopped, and nothing is
+    saved.
+
+    ---
+
+    Parameters
+    ----------
+    app: Flask instance
+        the application
+    """
+
+    app.before_request(_start_profile)
+    app.after_request(_stop_profile)
+    app.teardown_request(_discard_profile)
+
+
+def list_profiles(path):
+    """Return the saved profiles, latest first.
+
+    ---
+
+    Parameters
+    ----------
+    path: str
+        the profiles folder
+
+    Returns
+    -------
+    list of dicts, with name, date, endpoint, ms and size (in bytes,
+    of both files) keys
+    """
+
+    try:
+        names = {filename[:-len('.pstats')] for filename in os.listdir(path)
+                 if filename.endswith('.pstats')}
+    except FileNotFoundError:
+        return []
+    profiles = []
+    for name in sorted(names, reverse=True):
+        files = [os.path.join(path, name + suffix) for suffix in SUFFIXES]
+        if not all(os.path.exists(file) for file in files):
+            continue
+        date, endpoint, ms = name[:22], name[23:name.rindex('-')], \
+            name[name.rindex('-') + 1:-2]
+        profiles.append({'name': name,
+                         'date': datetime.strptime(date, '%Y%m%d-%H%M%S-%f'),
+                         'endpoint': endpoint, 'ms': int(ms),
+                         'size': sum(os.path.getsize(file)
+                                     for file in files)})
+    return profiles
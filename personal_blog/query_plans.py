@@ -0,0 +1,177 @@
+"""A module used to catch full table scans in the queries of routes.
+
+Request every GET route through the test client, record the queries
+each one issues, and ask the database how it would run them (EXPLAIN).
+A plan which reads a whole table, without an index, is fine for small
+tables, but it's a problem once the table grows. Meant to be run
+against a database with realistic data, before a release.
+
+---
+
+Functions
+---------
+sample_urls(app): return list(str)
+    build a url for every GET route, filling in existing ids
+full_scans(connection, statement, parameters): return list(str)
+    return the tables a statement reads in full
+check_query_plans(app, threshold): return list(dict)
+    find the full scans of tables over the threshold, per route
+
+Attributes
+----------
+SKIPPED_ENDPOINTS: set
+    the GET routes which aren't checked
+"""
+
+import re
+
+from sqlalchemy import event
+
+from personal_blog import db
+from personal_blog.models import User, Post, Tag, Book
+
+SQLITE_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)')
+POSTGRES_SCAN = re.compile(r'Seq Scan on (\w+)')
+
+# GET routes with side effects, or which aren't pages: logout would end
+# the admin's pass halfway, export dumps every table, availability is
+# rate limited, metrics doesn't query the database
+SKIPPED_ENDPOINTS = {'users.logout', 'admin.export', 'users.availability',
+                     'main.metrics'}
+
+
+def sample_urls(app):
+    """Build a url for every GET route, filling in existing ids.
+
+    Routes with arguments other than a post id, book id or tag are
+    skipped (i.e. tokens and file names), and so are the routes of
+    SKIPPED_ENDPOINTS.
+
+    ---
+
+    Parameters
+    ----------
+    app: Flask instance
+        the application whose routes are listed
+
+    Returns
+    -------
+    list of urls
+    """
+
+    post = Post.query.order_by(Post.id.desc()).first()
+    book = Book.query.first()
+    tag = Tag.query.first()
+    values = {'post_id': post.id if post else 1,
+              'book_id': book.id if book else 1,
+              'tag_content': tag.content if tag else 'python'}
+    urls = []
+    for rule in app.url_map.iter_rules():
+        if 'GET' not in rule.methods or rule.endpoint == 'static' or \
+                rule.endpoint in SKIPPED_ENDPOINTS or \
+                not set(rule.arguments) <= set(values):
+            continue
+        urls.append(rule.build({arg: values[arg] for arg in rule.arguments},
+                               append_unknown=False)[1])
+    return sorted(urls)
+
+
+def full_scans(connection, statement, parameters):
+    """Return the tables a statement reads in full.
+
+    Understand the plans of SQLite (EXPLAIN QUERY PLAN) and postgres.
+    A scan through an index (i.e. to return rows in index order)
+    doesn't count as a full scan.
+
+    ---
+
+    Parameters
+    ----------
+    connection: sqlalchemy Connection
+        the connection the statement was executed on
+    statement: str
+        the SQL statement, as sent to the driver
+    parameters: tuple or dict
+        the parameters, as sent to the driver
+
+    Returns
+    -------
+    list of table names
+    """
+
+    sqlite = connection.dialect.name == 'sqlite'
+    prefix = 'EXPLAIN QUERY PLAN ' if sqlite else 'EXPLAIN '
+    cursor = connection.connection.cursor()
+    try:
+        cursor.execute(prefix + statement, parameters)
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+    tables = []
+    for row in rows:
+        if sqlite:
+            detail = row[-1]
+            match = SQLITE_SCAN.match(detail)
+            if match and 'USING' not in detail:
+                tables.append(match.group(1))
+        else:
+            tables.extend(POSTGRES_SCAN.findall(row[0]))
+    return tables
+
+
+def check_query_plans(app, threshold):
+    """Find the full scans of tables over the threshold, per route.
+
+    Request the sample url of every GET route, once logged out and
+    once logged in as the admin (if there's one), so that both
+    versions of the pages are covered. Record every SELECT issued
+    meanwhile, and check its plan with full_scans().
+
+    ---
+
+    Parameters
+    ----------
+    app: Flask instance
+        the application, connected to the database to be checked
+    threshold: int
+        tables with at most this many rows may be scanned in full
+
+    Returns
+    -------
+    list of dicts with url, table, rows and statement keys
+    """
+
+    engines = [db.get_engine(app, bind) for bind in
+               [None] + list(app.config['SQLALCHEMY_BINDS'] or ())]
+    row_counts = {table.name: db.session.query(table).count()
+                  for table in db.metadata.sorted_tables}
+    admin = User.query.filter_by(is_admin=True).first()
+    urls = sample_urls(app)
+    seen = set()
+    problems = []
+
+    def explain(conn, cursor, statement, parameters, context, executemany):
+        if not statement.lstrip().upper().startswith('SELECT') or \
+                (current_url, statement) in seen:
+            return
+        seen.add((current_url, statement))
+        for table in full_scans(conn, statement, parameters):
+            if row_counts.get(table, 0) > threshold:
+                problems.append({'url': current_url, 'table': table,
+                                 'rows': row_counts[table],
+                                 'statement': statement})
+
+    for engine in engines:
+        event.listen(engine, 'before_cursor_execute', explain)
+    try:
+        for user in (None, admin):
+            client = app.test_client()
+            if user is not None:
+                with client.session_transaction() as session:
+                    session['_user_id'] = str(user.id)
+            for current_url in urls:
+                client.get(current_url)
+    finally:
+        for engine in engines:
+            event.remove(engine, 'before_cursor_execute', explain)
+    return problems
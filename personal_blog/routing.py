@@ -0,0 +1,201 @@
+"""A module used to split reads and writes between two databases.
+
+If SQLALCHEMY_REPLICA_URI is set, the app gets a second engine, bound
+to a read replica of the main (primary) database. The session routes
+every statement to one of them, see RoutingSession.get_bind().
+
+---
+
+Classes
+-------
+RoutingSession: child of flask_sqlalchemy.SignallingSession
+    the session which picks the primary or the replica engine
+RoutingSQLAlchemy: child of flask_sqlalchemy.SQLAlchemy
+    the extension which uses RoutingSession and per bind options
+
+Functions
+---------
+replica_lagging(db, app): return bool
+    check if the replica is too far behind the primary
+"""
+
+import time
+from threading import Lock
+
+from flask import has_request_context, request, session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession,\
+    _EngineConnector
+from sqlalchemy import orm
+from sqlalchemy.sql.expression import UpdateBase
+
+from personal_blog import sqlite
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# dialect: query returning the replica's lag in seconds
+LAG_QUERIES = {
+    'postgresql': 'SELECT EXTRACT(EPOCH FROM now() - '
+                  'pg_last_xact_replay_timestamp())',
+}
+
+_lag = {'checked': 0.0, 'lagging': False}
+_lag_lock = Lock()
+
+
+def replica_lagging(db, app):
+    """Check if the replica is too far behind the primary.
+
+    Run the lag query on the replica, at most once every
+    SQLALCHEMY_REPLICA_LAG_INTERVAL seconds per worker, and compare
+    its result to SQLALCHEMY_REPLICA_MAX_LAG.
+    The query is SQLALCHEMY_REPLICA_LAG_QUERY, or a default one for
+    the dialect. With no query at all, the replica is trusted.
+    If the query fails, the replica counts as lagging.
+
+    ---
+
+    Parameters
+    ----------
+    db: RoutingSQLAlchemy instance
+        the extension owning the engines
+    app: Flask instance
+        the current application
+
+    Returns
+    -------
+    True if reads should go to the primary instead, else False
+    """
+
+    now = time.monotonic()
+    interval = app.config['SQLALCHEMY_REPLICA_LAG_INTERVAL']
+    with _lag_lock:
+        if now - _lag['checked'] < interval:
+            return _lag['lagging']
+        _lag['checked'] = now
+    engine = db.get_engine(app, bind='replica')
+    query = app.config['SQLALCHEMY_REPLICA_LAG_QUERY'] or \
+        LAG_QUERIES.get(engine.dialect.name)
+    if query is None:
+        lagging = False
+    else:
+        try:
+            lag = engine.execute(query).scalar()
+        except Exception:
+            app.logger.exception('Replica lag check failed')
+            lagging = True
+        else:
+            max_lag = app.config['SQLALCHEMY_REPLICA_MAX_LAG']
+            lagging = lag is not None and lag > max_lag
+    _lag['lagging'] = lagging
+    return lagging
+
+
+class RoutingSession(SignallingSession):
+    """The session which picks the primary or the replica engine.
+
+    Statements go to the replica only if all of these hold:
+    a replica is configured, this is a GET/HEAD/OPTIONS request,
+    the session hasn't written anything yet (read your own writes),
+    the client hasn't written anything in the last
+    SQLALCHEMY_REPLICA_MAX_LAG seconds (i.e. the GET of a redirect
+    after a POST), and the replica isn't lagging behind.
+    Everything else, writes included, goes to the primary.
+
+    ---
+
+    Methods
+    -------
+    get_bind(self, mapper, clause): return Engine
+        return the engine the statement should run on
+    """
+
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def _use_replica(self):
+        """Return True if reads may go to the replica right now."""
+        if 'replica' not in (self.app.config['SQLALCHEMY_BINDS'] or ()):
+            return False
+        if self.info.get('wrote') or not has_request_context() or \
+                request.method not in SAFE_METHODS or \
+                session.get('primary_until', 0) > time.time():
+            return False
+        return not replica_lagging(self.db, self.app)
+
+    def get_bind(self, mapper=None, clause=None):
+        """Return the engine the statement should run on.
+
+        A flush, or an insert/update/delete statement, is a write.
+        Flag the session, so its later reads go to the primary too,
+        until it's removed at the end of the request. If there's a
+        replica, also pin the client to the primary for a while, by
+        storing a deadline in its (cookie) session.
+        """
+
+        if self._flushing or isinstance(clause, UpdateBase):
+            if not self.info.get('wrote') and has_request_context() and \
+                    'replica' in (self.app.config['SQLALCHEMY_BINDS'] or ()):
+                session['primary_until'] = time.time() + \
+                    self.app.config['SQLALCHEMY_REPLICA_MAX_LAG']
+            self.info['wrote'] = True
+        elif self._use_replica():
+            return self.db.get_engine(self.app, bind='replica')
+        return super().get_bind(mapper, clause)
+
+
+class _BindConnector(_EngineConnector):
+    """Engine connector applying per bind options and the SQLite profile.
+
+    The options of the SQLALCHEMY_BIND_OPTIONS entry of the bind
+    override every other option.
+    """
+
+    def get_options(self, sa_url, echo):
+        options = super().get_options(sa_url, echo)
+        sqlite.engine_options(sa_url, options,
+                              self._app.config['SQLITE_POOL_SIZE'])
+        bind_options = self._app.config['SQLALCHEMY_BIND_OPTIONS']
+        options.update(bind_options.get(self._bind or 'primary', {}))
+        return options
+
+    def get_engine(self):
+        engine = self._engine
+        new_engine = super().get_engine()
+        if new_engine is not engine:
+            sqlite.apply_profile(new_engine,
+                                 self._app.config['SQLITE_PRAGMAS'],
+                                 self._app.config['SQLITE_OPTIMIZE_INTERVAL'])
+        return new_engine
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """The extension which uses RoutingSession and per bind options.
+
+    ---
+
+    Methods
+    -------
+    init_app(self, app): return None
+        add the replica bind, if configured, and init the extension
+    create_session(self, options): return sessionmaker
+        make sessions of the RoutingSession class
+    make_connector(self, app, bind): return _BindConnector
+        make engine connectors which apply per bind options,
+        and the SQLite profile (see the sqlite module)
+    """
+
+    def init_app(self, app):
+        """Add the replica bind, if configured, and init the extension."""
+        replica_uri = app.config.get('SQLALCHEMY_REPLICA_URI')
+        if replica_uri:
+            binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+            binds['replica'] = replica_uri
+            app.config['SQLALCHEMY_BINDS'] = binds
+        super().init_app(app)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def make_connector(self, app=None, bind=None):
+        return _BindConnector(self, self.get_app(app), bind)
@@ -1,19 +1,165 @@
 """A module used to perform full-text search.
 
+Every index (i.e. 'post') is an alias, pointing to a physical index
+(i.e. 'post-v1-20210301120000000000') made from an index template:
+explicit settings, analyzers and typed field mappings, versioned in
+INDEXES. HTML is stripped before it's analyzed. A rebuild loads a new
+physical index, then swaps the alias to it in one atomic action, so
+search keeps answering from the old index until the new one is ready.
+
 ---
 
 Functions
 ---------
+init_elasticsearch(app): return None
+    create the elasticsearch client of the app, if it's reachable
+ensure_index(es, index): return None
+    create the index template, and the aliased index, if missing
 add_to_index(index, model): return None
     create/update documents on the index
+bulk_index(index, models): return int
+    create/update many documents, in bulk requests
+rebuild_index(index, models): return int
+    load the documents into a new index, then swap the alias to it
 remove_from_index(index, model): return None
     delete document from the index
-query_index(index, query, page, per_page): list(int), int
-    search the index with the given query
+query_index(index, query, per_page, after): list(int), int, str
+    search the index with the given query, a page at a time
+
+Attributes
+----------
+INDEXES: dict
+    index name: its version, field mappings and searched fields,
+    bump the version when the mappings change, and rebuild
 """
 
+import time
+from datetime import datetime
+
 from flask import current_app
 
+from personal_blog.cursors import encode_cursor, decode_cursor
+from personal_blog.metrics import instrument_elasticsearch
+
+INDEXES = {
+    'post': {
+        'version': 2,
+        'mappings': {
+            'dynamic': 'strict',
+            'properties': {
+                'title': {'type': 'text', 'analyzer': 'text_en', 'fields': {
+                    'suggest': {'type': 'search_as_you_type'}}},
+                'content': {'type': 'text', 'analyzer': 'html_en'},
+                'date_posted': {'type': 'date'},
+            },
+        },
+        'search_fields': ['title^2', 'content'],
+    },
+}
+
+ANALYSIS = {
+    'filter': {
+        'english_stop': {'type': 'stop', 'stopwords': '_english_'},
+        'english_stemmer': {'type': 'stemmer', 'language': 'english'},
+    },
+    'analyzer': {
+        'text_en': {
+            'type': 'custom', 'tokenizer': 'standard',
+            'filter': ['lowercase', 'asciifolding', 'english_stop',
+                       'english_stemmer'],
+        },
+        'html_en': {
+            'type': 'custom', 'tokenizer': 'standard',
+            'char_filter': ['html_strip'],
+            'filter': ['lowercase', 'asciifolding', 'english_stop',
+                       'english_stemmer'],
+        },
+    },
+}
+
+
+def _rebuilding_key(index):
+    """Return the store key of the last heartbeat of a rebuild of index."""
+    return f'search:rebuilding:{index}'
+
+
+def _template(index):
+    """Return the body of the index template of index."""
+    definition = INDEXES[index]
+    return {
+        'index_patterns': [f'{index}-v*'],
+        'version': definition['version'],
+        'settings': {
+            'number_of_shards': 1,
+            'number_of_replicas':
+                current_app.config['ELASTICSEARCH_REPLICAS'],
+            'analysis': ANALYSIS,
+        },
+        'mappings': definition['mappings'],
+    }
+
+
+def _physical_name(index):
+    """Return a new, unique name for a physical index of index."""
+    version = INDEXES[index]['version']
+    return f'{index}-v{version}-{datetime.utcnow():%Y%m%d%H%M%S%f}'
+
+
+def ensure_index(es, index):
+    """Create the index template, and the aliased index, if missing.
+
+    Does nothing if the alias (or an index of that name, made before
+    indexes were aliased) exists. Rebuild it to move it to the alias.
+
+    ---
+
+    Parameters
+    ----------
+    es: Elasticsearch instance
+        the client
+    index: str
+        one of INDEXES
+    """
+
+    if es.indices.exists(index=index):  # true for aliases too
+        return
+    es.indices.put_template(name=index, body=_template(index))
+    name = _physical_name(index)
+    es.indices.create(index=name)
+    es.indices.put_alias(index=name, name=index)
+
+
+def init_elasticsearch(app):
+    """Create the elasticsearch client of the app, if it's reachable.
+
+    Store the client as the elasticsearch attribute of the app.
+    If ELASTICSEARCH_URL isn't set, or the server doesn't answer
+    the ping, set it to None. Search is an optional feature.
+    Also called in every forked gunicorn worker, so workers don't
+    share the parent's http connections. The client is only imported
+    if it's needed, it's heavy. Its requests are timed, for the
+    metrics. Create the indexes which are missing.
+
+    ---
+
+    Parameters
+    ----------
+    app: Flask instance
+        the application the client is created for
+    """
+
+    if app.config['ELASTICSEARCH_URL']:
+        from elasticsearch import Elasticsearch
+        es = Elasticsearch([app.config['ELASTICSEARCH_URL']])
+        instrument_elasticsearch(es)
+        app.elasticsearch = es if es.ping() else None
+    else:
+        app.elasticsearch = None
+    if app.elasticsearch:
+        with app.app_context():
+            for index in INDEXES:
+                ensure_index(app.elasticsearch, index)
+
 
 def add_to_index(index, model):
     """Create/update documents on the index.
@@ -37,6 +183,164 @@ def add_to_index(index, model):
     for field in model.__searchable__:
         payload[field] = getattr(model, field)
     current_app.elasticsearch.index(index=index, id=model.id, body=payload)
+    if _rebuilding(index):  # not to a concrete index, if the alias is gone
+        current_app.elasticsearch.index(index=f'{index}-next', id=model.id,
+                                        body=payload, require_alias=True,
+                                        ignore=404)
+
+
+def bulk_index(index, models, chunk_size=500, op_type='index'):
+    """Create/update many documents, in bulk requests.
+
+    If elastic isn't set up or running, don't do anything.
+    Else, send the documents chunk_size at a time, instead of one
+    request per document like add_to_index(). With the 'create'
+    operation, documents which are already in the index are left as
+    they are, they don't count as failures.
+
+    ---
+
+    Parameters
+    ----------
+    index: elasticsearch index
+        the name of the index to be updated
+    models: iterable of instances of a database models class
+        the records to index, i.e. a query (consumed lazily)
+    chunk_size: int
+        the number of documents per bulk request
+    op_type: str
+        'index' to create or overwrite documents, 'create' to only
+        create the missing ones
+
+    Returns
+    -------
+    the number of documents indexed (or already there)
+    """
+
+    if not current_app.elasticsearch:
+        return 0
+    from elasticsearch.helpers import BulkIndexError, streaming_bulk
+    actions = ({'_op_type': op_type, '_index': index, '_id': model.id,
+                '_source': {field: getattr(model, field)
+                            for field in model.__searchable__}}
+               for model in models)
+    indexed = 0
+    for ok, item in streaming_bulk(current_app.elasticsearch, actions,
+                                   chunk_size=chunk_size,
+                                   raise_on_error=op_type != 'create'):
+        if not ok and item[op_type].get('status') != 409:
+            raise BulkIndexError('A document failed to index', [item])
+        indexed += 1
+    return indexed
+
+
+def _rebuilding(index):
+    """Return True if the index is being rebuilt, by any process.
+
+    Writes then go to the new index too, so that it doesn't miss the
+    changes made while it's loaded. A rebuild beats every chunk, one
+    which didn't for SEARCH_REBUILD_TIMEOUT seconds is dead (i.e. it
+    was killed before it could clear its flag).
+    """
+
+    from personal_blog import store
+    return time.time() - store.get(_rebuilding_key(index)) < \
+        current_app.config['SEARCH_REBUILD_TIMEOUT']
+
+
+def _heartbeat(index, stop=False):
+    """Set the flag of a rebuild of index to now, or clear it."""
+    from personal_blog import store
+    key = _rebuilding_key(index)
+    now = 0 if stop else int(time.time())
+    store.incr(key, now - store.get(key))
+
+
+def rebuild_index(index, models, chunk_size=500):
+    """Load the documents into a new index, then swap the alias to it.
+
+    The new index is loaded with refresh disabled and no replicas,
+    which makes bulk loading much faster. Then its settings are
+    restored, and the alias is moved to it in one atomic action:
+    searches hit the old index until then, and never see a partial
+    one. The old indexes (or the index of that name, made before
+    indexes were aliased) are deleted. If loading fails, the new
+    index is deleted, and the old one keeps serving.
+
+    Meanwhile, live writes go to the new index too (see
+    add_to_index()). The load only creates the documents which aren't
+    there yet, so it doesn't overwrite a newer version written live
+    with the older one it read. A new index left by a rebuild which
+    died is deleted first.
+
+    ---
+
+    Parameters
+    ----------
+    index: str
+        one of INDEXES
+    models: iterable of instances of a database models class
+        all the records to index, i.e. a query (consumed lazily)
+    chunk_size: int
+        the number of documents per bulk request
+
+    Raises
+    ------
+    RuntimeError
+        if another rebuild of the index is running
+
+    Returns
+    -------
+    the number of documents indexed
+    """
+
+    es = current_app.elasticsearch
+    if not es:
+        return 0
+    if _rebuilding(index):
+        raise RuntimeError(f'The {index} index is already being rebuilt')
+    next_alias = f'{index}-next'
+    if es.indices.exists_alias(name=next_alias):
+        for dead in es.indices.get_alias(name=next_alias):
+            es.indices.delete(index=dead, ignore=404)
+    es.indices.put_template(name=index, body=_template(index))
+    name = _physical_name(index)
+    es.indices.create(index=name, body={'settings': {'index': {
+        'refresh_interval': '-1', 'number_of_replicas': 0}}})
+    es.indices.put_alias(index=name, name=next_alias)
+
+    def beating(models):
+        for count, model in enumerate(models):
+            if count % chunk_size == 0:
+                _heartbeat(index)
+            yield model
+
+    _heartbeat(index)
+    try:
+        indexed = bulk_index(name, beating(models), chunk_size, 'create')
+        es.indices.put_settings(index=name, body={'index': {
+            'refresh_interval': None,  # back to the default
+            'number_of_replicas':
+                current_app.config['ELASTICSEARCH_REPLICAS']}})
+        es.indices.refresh(index=name)
+        actions = [{'remove': {'index': name, 'alias': next_alias}},
+                   {'add': {'index': name, 'alias': index}}]
+        old = []
+        if es.indices.exists_alias(name=index):
+            old = list(es.indices.get_alias(name=index))
+            actions += [{'remove': {'index': old_name, 'alias': index}}
+                        for old_name in old]
+        elif es.indices.exists(index=index):
+            actions.append({'remove_index': {'index': index}})
+        es.indices.update_aliases(body={'actions': actions})
+    except Exception:
+        es.indices.delete(index=name, ignore=404)
+        raise
+    finally:
+        _heartbeat(index, stop=True)
+    for old_name in old:
+        es.indices.delete(index=old_name, ignore=404)
+    return indexed
 
 
 def remove_from_index(index, model):
@@ -58,15 +362,24 @@ def remove_from_index(index, model):
     if not current_app.elasticsearch:
         return
     current_app.elasticsearch.delete(index=index, id=model.id)
+    if _rebuilding(index):
+        current_app.elasticsearch.delete(index=f'{index}-next', id=model.id,
+                                         ignore=404)
 
 
-def query_index(index, query, page, per_page):
-    """Search the given index with the given query.
+def query_index(index, query, per_page, after=None):
+    """Search the given index with the given query, a page at a time.
 
-    If elastic isn't set up or running, don't do anything.
-    Else, search the given index with the given query.
-    From the result set, make a list of post ids.
-    Get the total of results (number of matches).
+    Instead of an offset, which makes elasticsearch collect and skip
+    every hit before the page, pages are read from a point in time
+    (a frozen view of the index) after the sort values of the last
+    hit seen. Both are packed in an opaque cursor, so every page costs
+    the same, however deep it is. Most searches never go past the
+    first page, so it's a plain search, and the point in time is only
+    opened for the second one (read at an offset, that of the first
+    page's cursor). Hits are only counted up to
+    SEARCH_TRACK_TOTAL_HITS. The point in time is closed with the
+    last page, else it expires SEARCH_KEEP_ALIVE after the last use.
 
     ---
 
@@ -76,22 +389,75 @@ def query_index(index, query, page, per_page):
         the name of the index where the search should take place
     query: str
         the search expression/keywoard
-    page: int
-        the actual page of the paginated result set
     per_page: int
         the number of results per page
+    after: str or None
+        the cursor returned with the previous page, None for the first
+
+    Raises
+    ------
+    ValueError
+        if the cursor is malformed, or its point in time expired
+        (errors of the first page are raised as they are)
 
     Returns
     -------
-    if elastic isn't running: [], -1
-    if elastic is running: list of post ids, total
+    if elastic isn't running: [], -1, None
+    if elastic is running: list of post ids, total (a lower bound
+    when capped), and the cursor of the next page (None if this is
+    the last one)
     """
 
-    if not current_app.elasticsearch:
-        return [], -1
-    search = current_app.elasticsearch.search(
-        index=index,
-        body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
-              'from': (page - 1) * per_page, 'size': per_page})
-    ids = [int(hit['_id']) for hit in search['hits']['hits']]
-    return ids, search['hits']['total']['value']
+    es = current_app.elasticsearch
+    if not es:
+        return [], -1, None
+    from elasticsearch import NotFoundError, RequestError, TransportError
+    keep_alive = current_app.config['SEARCH_KEEP_ALIVE']
+    body = {'query': {'multi_match': {
+                'query': query, 'fields': INDEXES[index]['search_fields']}},
+            'size': per_page + 1,  # one more, to know if there's a next
+            'sort': ['_score'],  # plus the implicit _shard_doc tiebreaker
+            'track_total_hits':
+                current_app.config['SEARCH_TRACK_TOTAL_HITS']}
+    pit_id = opened = None
+    if after:
+        try:
+            pit_id, score, shard_doc = decode_cursor(after,
+                                                     (str, float, int))
+            body['search_after'] = [score, shard_doc]
+        except ValueError:
+            offset, = decode_cursor(after, (int,))  # the first page's
+            if not 0 < offset <= per_page:
+                raise ValueError('Malformed cursor')
+            body['from'] = offset
+    try:
+        if after and pit_id is None:
+            pit_id = opened = es.open_point_in_time(
+                index=index, keep_alive=keep_alive)['id']
+        if pit_id is None:
+            search = es.search(index=index, body=body)
+        else:
+            body['pit'] = {'id': pit_id, 'keep_alive': keep_alive}
+            search = es.search(body=body)
+    except TransportError as error:
+        if opened:
+            try:
+                es.close_point_in_time(body={'id': opened}, ignore=404)
+            except TransportError:
+                pass  # it expires anyway
+        if after and isinstance(error, (NotFoundError, RequestError)):
+            raise ValueError('Expired or malformed cursor')
+        raise
+    hits = search['hits']['hits']
+    ids = [int(hit['_id']) for hit in hits[:per_page]]
+    if len(hits) <= per_page:
+        cursor = None
+        if pit_id is not None:
+            es.close_point_in_time(body={'id': search['pit_id']},
+                                   ignore=404)
+    elif pit_id is None:
+        cursor = encode_cursor(per_page)
+    else:
+        # the point in time id may change between searches
+        cursor = encode_cursor(search['pit_id'], *hits[per_page - 1]['sort'])
+    return ids, search['hits']['total']['value'], cursor
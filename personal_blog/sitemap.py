@@ -0,0 +1,164 @@
+"""A module used to build the sitemaps of the blog, for crawlers.
+
+A sitemap holds at most 50k urls, so /sitemap.xml is an index of
+shards. Posts and books are sharded by id range (shard n holds the
+ids from n * size + 1 to (n + 1) * size), so a shard is read through
+the primary key, and tags by name order. Shards are generated from
+(id, date) rows, streamed to the client, and cached in the worker
+under the version of their content (see models.bump_post_versions()).
+
+---
+
+Functions
+---------
+shard_count(kind): return int
+    the number of shards of that kind
+index_chunks(): return generator of str
+    the xml of the sitemap index, in pieces
+shard_chunks(kind, shard): return generator of str
+    the xml of a shard, in pieces, from the cache if possible
+
+Attributes
+----------
+KINDS: tuple
+    the kinds of shards, in index order
+"""
+
+from xml.sax.saxutils import escape
+
+from flask import current_app, url_for
+
+from personal_blog import db, store
+from personal_blog.cache import sitemap_cache
+from personal_blog.models import Post, Tag, Book
+
+KINDS = ('pages', 'posts', 'tags', 'books')
+
+# kind: the store key of the version its shards are cached under
+_VERSIONS = {'pages': None, 'posts': 'version:posts',
+             'tags': 'version:posts', 'books': 'version:books'}
+
+_HEADER = ('<?xml version="1.0" encoding="utf-8"?>'
+           '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">')
+
+
+def _size():
+    """Return the number of urls per shard."""
+    return current_app.config['SITEMAP_SHARD_SIZE']
+
+
+def shard_count(kind):
+    """Return the number of shards of that kind.
+
+    ---
+
+    Parameters
+    ----------
+    kind: str
+        one of KINDS
+
+    Returns
+    -------
+    int, 0 if there's nothing to list
+    """
+
+    if kind == 'pages':
+        return 1
+    if kind == 'tags':
+        total = db.session.query(
+            db.func.count(Tag.content.distinct())).scalar()
+    else:
+        model = Post if kind == 'posts' else Book
+        total = db.session.query(db.func.max(model.id)).scalar() or 0
+    return -(-total // _size())
+
+
+def index_chunks():
+    """Yield the xml of the sitemap index, in pieces."""
+    yield ('<?xml version="1.0" encoding="utf-8"?>'
+           '<sitemapindex '
+           'xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">')
+    for kind in KINDS:
+        for shard in range(shard_count(kind)):
+            url = url_for('main.sitemap_shard', kind=kind, shard=shard,
+                          _external=True)
+            yield f'<sitemap><loc>{escape(url)}</loc></sitemap>'
+    yield '</sitemapindex>'
+
+
+def _url(loc, lastmod=None):
+    """Return the xml of a url entry."""
+    lastmod = f'<lastmod>{lastmod:%Y-%m-%d}</lastmod>' if lastmod else ''
+    return f'<url><loc>{escape(loc)}</loc>{lastmod}</url>'
+
+
+def _rows(kind, shard):
+    """Yield the (endpoint arguments, lastmod) of the urls of a shard."""
+    size = _size()
+    if kind == 'pages':
+        for endpoint in ('main.home', 'main.about', 'posts.all_posts',
+                         'posts.tags', 'books.all_books'):
+            yield endpoint, {}, None
+    elif kind == 'posts':
+        rows = db.session.query(
+            Post.id, Post.date_posted, Post.last_comment_at).filter(
+                Post.id.between(shard * size + 1, (shard + 1) * size)
+            ).order_by(Post.id).yield_per(1000)
+        for post_id, date_posted, last_comment_at in rows:
+            yield 'posts.post', {'post_id': post_id}, \
+                max(date_posted, last_comment_at or date_posted)
+    elif kind == 'tags':
+        rows = db.session.query(
+            Tag.content, db.func.max(Post.date_posted)).join(
+                Post, Post.id == Tag.post_id).group_by(Tag.content).order_by(
+                    Tag.content).offset(shard * size).limit(size)
+        for content, lastmod in rows:
+            yield 'posts.posts_by_tag', {'tag_content': content}, lastmod
+    elif kind == 'books':
+        rows = db.session.query(Book.id).filter(
+            Book.id.between(shard * size + 1, (shard + 1) * size)
+        ).order_by(Book.id).yield_per(1000)
+        for book_id, in rows:
+            yield 'books.book', {'book_id': book_id}, None
+
+
+def shard_chunks(kind, shard):
+    """Yield the xml of a shard, in pieces, from the cache if possible.
+
+    On a cache miss, the shard is streamed while it's generated, and
+    cached once it's complete.
+
+    ---
+
+    Parameters
+    ----------
+    kind: str
+        one of KINDS
+    shard: int
+        the number of the shard, from 0
+
+    Yields
+    ------
+    str
+    """
+
+    key = _VERSIONS[kind]
+    version = store.get(key) if key else 0
+    cached = sitemap_cache.get((kind, shard))
+    if cached is not None and cached[0] == version:
+        yield cached[1]
+        return
+    chunks = [_HEADER]
+    yield _HEADER
+    piece = []
+    for endpoint, values, lastmod in _rows(kind, shard):
+        piece.append(_url(url_for(endpoint, _external=True, **values),
+                          lastmod))
+        if len(piece) == 1000:
+            chunks.append(''.join(piece))
+            yield chunks[-1]
+            piece = []
+    chunks.append(''.join(piece) + '</urlset>')
+    yield chunks[-1]
+    sitemap_cache.set((kind, shard), (version, ''.join(chunks)),
+                      current_app.config['SITEMAP_TTL'])
@@ -0,0 +1,214 @@
+"""A module used to tune SQLite databases for concurrent workers.
+
+Several gunicorn workers (and their threads) sharing a SQLite file
+run into 'database is locked' errors with the default settings,
+since readers and writers block each other in the rollback journal
+mode. The profile switches the file to WAL mode, where readers don't
+block the writer, and sets the pragmas which go with it on every new
+connection. Connections are pooled, so the pragmas and the page cache
+aren't thrown away after every request.
+
+---
+
+Functions
+---------
+engine_options(sa_url, options, pool_size): return None
+    make the engine of a SQLite file keep a pool of connections
+apply_profile(engine, pragmas, optimize_interval): return None
+    set the pragmas on every new connection of a SQLite engine
+maintain(dbapi_connection): return None
+    let SQLite refresh its statistics and checkpoint the WAL file
+benchmark(uri, processes, seconds, profile): return dict
+    measure throughput and lock errors of concurrent processes
+"""
+
+import logging
+import multiprocessing
+import random
+import sqlite3
+import time
+from threading import Lock
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool
+
+logger = logging.getLogger(__name__)
+
+_maintained = {'at': time.monotonic()}
+_maintained_lock = Lock()
+
+
+def _is_file(sa_url):
+    """Return True if the url points to a SQLite file (not memory)."""
+    return sa_url.drivername.startswith('sqlite') and \
+        sa_url.database not in (None, '', ':memory:')
+
+
+def engine_options(sa_url, options, pool_size):
+    """Make the engine of a SQLite file keep a pool of connections.
+
+    By default, every checkout opens a new connection to the file.
+    A pool keeps the connections, with their pragmas and page cache.
+    The pool hands a connection to one thread at a time, so SQLite's
+    same-thread check can be turned off.
+
+    ---
+
+    Parameters
+    ----------
+    sa_url: sqlalchemy URL
+        the url the engine is created for
+    options: dict
+        the engine options, updated in place
+    pool_size: int
+        the number of pooled connections, 0 keeps the default
+    """
+
+    if not pool_size or not _is_file(sa_url):
+        return
+    options['poolclass'] = QueuePool
+    options['pool_size'] = pool_size
+    options.setdefault('connect_args', {})['check_same_thread'] = False
+
+
+def apply_profile(engine, pragmas, optimize_interval):
+    """Set the pragmas on every new connection of a SQLite engine.
+
+    If optimize_interval is set, also call maintain() when a
+    connection goes back to the pool, at most once per interval
+    per process.
+
+    ---
+
+    Parameters
+    ----------
+    engine: sqlalchemy Engine
+        the engine to tune, ignored if it's not a SQLite file
+    pragmas: dict
+        pragma name: value, i.e. {'journal_mode': 'WAL'}
+    optimize_interval: int
+        seconds between two maintenance runs, 0 disables them
+    """
+
+    if not pragmas or not _is_file(engine.url):
+        return
+    statements = [f'PRAGMA {name}={value}'
+                  for name, value in pragmas.items()]
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.close()
+
+    if not optimize_interval:
+        return
+
+    @event.listens_for(engine, 'checkin')
+    def maintain_periodically(dbapi_connection, connection_record):
+        now = time.monotonic()
+        with _maintained_lock:
+            if now - _maintained['at'] < optimize_interval:
+                return
+            _maintained['at'] = now
+        maintain(dbapi_connection)
+
+
+def maintain(dbapi_connection):
+    """Let SQLite refresh its statistics and checkpoint the WAL file.
+
+    PRAGMA optimize updates the statistics the query planner uses,
+    for the tables whose contents changed a lot.
+    A passive checkpoint copies the WAL back into the database file,
+    without waiting on readers/writers, so the WAL doesn't keep
+    growing.
+
+    ---
+
+    Parameters
+    ----------
+    dbapi_connection: sqlite3.Connection
+        a connection which isn't in a transaction
+    """
+
+    try:
+        dbapi_connection.execute('PRAGMA optimize')
+        dbapi_connection.execute('PRAGMA wal_checkpoint(PASSIVE)')
+    except sqlite3.Error:
+        logger.exception('SQLite maintenance failed')
+
+
+def _benchmark_worker(uri, seconds, profile, seed):
+    """Run random reads and writes for some seconds, in a process."""
+    random.seed(seed)
+    options = {}
+    engine_options(make_url(uri), options, 5 if profile else 0)
+    engine = create_engine(uri, **options)
+    if profile:
+        apply_profile(engine, profile, 0)
+    reads = writes = locked = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        try:
+            with engine.begin() as connection:
+                if random.random() < 0.2:
+                    connection.execute(
+                        'INSERT INTO item (value) VALUES (?)',
+                        (random.random(),))
+                    writes += 1
+                else:
+                    connection.execute(
+                        'SELECT count(*), max(value) FROM item WHERE id > ?',
+                        (random.randint(0, 10000),)).fetchall()
+                    reads += 1
+        except OperationalError as error:
+            if 'locked' not in str(error):
+                raise
+            locked += 1
+    engine.dispose()
+    return reads, writes, locked
+
+
+def benchmark(uri, processes, seconds, profile):
+    """Measure throughput and lock errors of concurrent processes.
+
+    Create a table of 10000 rows in the given (scratch) database.
+    Then, run processes that read and write it concurrently, about
+    one write for every four reads, and sum up what they managed.
+
+    ---
+
+    Parameters
+    ----------
+    uri: str
+        the sqlalchemy uri of a scratch SQLite file
+    processes: int
+        the number of concurrent processes
+    seconds: float
+        how long every process runs for
+    profile: dict
+        the pragmas to apply, empty for SQLite's defaults
+
+    Returns
+    -------
+    dict with reads, writes, locked (errors) and ops_per_sec keys
+    """
+
+    engine = create_engine(uri)
+    with engine.begin() as connection:
+        connection.execute('DROP TABLE IF EXISTS item')
+        connection.execute('CREATE TABLE item '
+                           '(id INTEGER PRIMARY KEY, value REAL)')
+        connection.execute('INSERT INTO item (value) VALUES (?)',
+                           [(random.random(),) for _ in range(10000)])
+    engine.dispose()
+    with multiprocessing.Pool(processes) as pool:
+        results = pool.starmap(
+            _benchmark_worker,
+            [(uri, seconds, profile, seed) for seed in range(processes)])
+    reads, writes, locked = (sum(column) for column in zip(*results))
+    return {'reads': reads, 'writes': writes, 'locked': locked,
+            'ops_per_sec': round((reads + writes) / seconds, 1)}
@@ -0,0 +1,41 @@
+// Live username/email availability checks for the register/account forms.
+// Checks are debounced, so only a pause in typing hits the server.
+(function () {
+    var url = document.currentScript.dataset.url;
+    var debounceMs = 300;
+
+    ['username', 'email'].forEach(function (field) {
+        var input = document.getElementById(field);
+        if (!input) {
+            return;
+        }
+        var initial = input.value;
+        var feedback = document.createElement('small');
+        var timer = null;
+        input.parentNode.appendChild(feedback);
+
+        input.addEventListener('input', function () {
+            clearTimeout(timer);
+            feedback.textContent = '';
+            if (!input.value || input.value === initial) {
+                return;
+            }
+            timer = setTimeout(function () {
+                var value = input.value;
+                fetch(url + '?' + field + '=' + encodeURIComponent(value))
+                    .then(function (response) {
+                        return response.ok ? response.json() : null;
+                    })
+                    .then(function (result) {
+                        if (!result || input.value !== value) {
+                            return;  // rate limited, or typed on since
+                        }
+                        feedback.className = result.available ?
+                            'text-success' : 'text-danger';
+                        feedback.textContent = result.available ?
+                            'Available' : 'Already taken!';
+                    });
+            }, debounceMs);
+        });
+    });
+})();
@@ -0,0 +1,49 @@
+// Load the next pages of a post's comments, as the reader scrolls down.
+// The 'More comments' button works too, where IntersectionObserver doesn't.
+(function () {
+    var button = document.getElementById('more-comments');
+    if (!button) {
+        return;
+    }
+    var container = document.getElementById('comments');
+    var loading = false;
+
+    function loadMore() {
+        if (loading || !button.dataset.next) {
+            return;
+        }
+        loading = true;
+        var next = encodeURIComponent(button.dataset.next);
+        fetch(button.dataset.url + '?after=' + next)
+            .then(function (response) {
+                return response.ok ? response.json() : null;
+            })
+            .then(function (page) {
+                loading = false;
+                if (!page) {
+                    return;
+                }
+                container.insertAdjacentHTML('beforeend', page.html);
+                button.dataset.next = page.next || '';
+                if (!page.next) {
+                    button.parentNode.removeChild(button);
+                    if (observer) {
+                        observer.disconnect();
+                    }
+                }
+            }, function () {
+                loading = false;
+            });
+    }
+
+    var observer = null;
+    if ('IntersectionObserver' in window) {
+        observer = new IntersectionObserver(function (entries) {
+            if (entries[0].isIntersecting) {
+                loadMore();
+            }
+        }, {rootMargin: '400px'});
+        observer.observe(button);
+    }
+    button.addEventListener('click', loadMore);
+})();
@@ -0,0 +1,67 @@
+// Search-as-you-type suggestions for the search bar of the navigation bar.
+// Requests are debounced, prefixes too short aren't sent, and answers to a
+// prefix the user typed on from are dropped (see personal_blog/suggest.py).
+(function () {
+    var script = document.currentScript;
+    var url = script.dataset.url;
+    var debounceMs = parseInt(script.dataset.debounceMs, 10);
+    var minLength = parseInt(script.dataset.minLength, 10);
+    var input = document.getElementById('q');
+    if (!input) {
+        return;
+    }
+    var list = document.createElement('datalist');
+    var timer = null;
+    var cache = {};
+    var urls = {};
+    list.id = 'q-suggestions';
+    input.parentNode.appendChild(list);
+    input.setAttribute('list', list.id);
+    input.setAttribute('autocomplete', 'off');
+
+    function show(suggestions) {
+        list.textContent = '';
+        urls = {};
+        suggestions.forEach(function (suggestion) {
+            var option = document.createElement('option');
+            option.value = suggestion.kind === 'tag' ?
+                '#' + suggestion.text : suggestion.text;
+            urls[option.value] = suggestion.url;
+            list.appendChild(option);
+        });
+    }
+
+    input.addEventListener('input', function (event) {
+        clearTimeout(timer);
+        var picked = !event.inputType ||
+            event.inputType === 'insertReplacementText';
+        if (picked && urls[input.value]) {
+            window.location = urls[input.value];  // a suggestion was picked
+            return;
+        }
+        var value = input.value.trim();
+        if (value.length < minLength) {
+            show([]);
+            return;
+        }
+        if (cache[value]) {
+            show(cache[value]);
+            return;
+        }
+        timer = setTimeout(function () {
+            fetch(url + '?q=' + encodeURIComponent(value))
+                .then(function (response) {
+                    return response.ok ? response.json() : null;
+                })
+                .then(function (result) {
+                    if (!result) {
+                        return;
+                    }
+                    cache[value] = result.suggestions;
+                    if (input.value.trim() === value) {
+                        show(result.suggestions);  // else typed on since
+                    }
+                });
+        }, debounceMs);
+    });
+})();
@@ -0,0 +1,303 @@
+"""A module used to share small counters and buckets between workers.
+
+Gunicorn runs several worker processes, which share no memory.
+Rate limits and counters kept in a plain dict would be per worker.
+The store keeps them either in memory (single process setups, dev)
+or in a SQLite file which every worker on the host opens.
+Buckets which refilled are swept every SWEEP_INTERVAL seconds, so
+one bucket per client IP or email doesn't grow the store for good.
+
+---
+
+Classes
+-------
+MemoryBackend
+    keeps buckets and counters in the memory of the current process
+SQLiteBackend
+    keeps buckets and counters in a SQLite file shared by processes
+SharedStore
+    the flask extension which picks and exposes the backend
+"""
+
+import os
+import sqlite3
+import time
+from threading import Lock, local
+
+from flask import current_app
+
+
+SWEEP_INTERVAL = 60
+
+
+def _refill(tokens, updated, capacity, rate, now):
+    """Return the tokens of a bucket after refilling it until now."""
+    return min(capacity, tokens + (now - updated) * rate)
+
+
+def _full_at(tokens, capacity, rate, now):
+    """Return the time a bucket will be full again, if it's left alone.
+
+    A full bucket is the same as a missing one, so it can be dropped
+    from then on. Otherwise, every client IP or email ever seen would
+    keep its bucket for good.
+    """
+
+    return now + (capacity - tokens) / rate
+
+
+class MemoryBackend:
+    """Keep buckets and counters in the memory of the current process.
+
+    ---
+
+    Methods
+    -------
+    take(self, key, capacity, rate): return float
+        take a token from the bucket, return seconds to wait if empty
+    incr(self, key, amount): return int
+        increment a counter and return its new value
+    get(self, key): return int
+        return the value of a counter
+    counters(self, prefix): return dict
+        return all counters whose key starts with prefix
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._buckets = {}
+        self._counters = {}
+        self._swept = time.time()
+
+    def take(self, key, capacity, rate):
+        """Take a token from the bucket stored under key.
+
+        ---
+
+        Parameters
+        ----------
+        key: str
+            the key of the bucket, created full if it doesn't exist
+        capacity: float
+            the max number of tokens the bucket holds
+        rate: float
+            the number of tokens added back to the bucket per second
+
+        Returns
+        -------
+        0 if a token was taken, else the seconds until one is available
+        """
+
+        now = time.time()
+        with self._lock:
+            if now - self._swept >= SWEEP_INTERVAL:
+                self._sweep(now)
+            tokens, updated, _ = self._buckets.get(key, (capacity, now, now))
+            tokens = _refill(tokens, updated, capacity, rate, now)
+            taken = tokens >= 1
+            left = tokens - 1 if taken else tokens
+            self._buckets[key] = (left, now,
+                                  _full_at(left, capacity, rate, now))
+        return 0 if taken else (1 - tokens) / rate
+
+    def _sweep(self, now):
+        """Drop the buckets which refilled, call it with the lock held."""
+        self._buckets = {key: bucket for key, bucket in self._buckets.items()
+                         if bucket[2] > now}
+        self._swept = now
+
+    def incr(self, key, amount=1):
+        """Increment the counter stored under key, return its value."""
+        with self._lock:
+            value = self._counters.get(key, 0) + amount
+            self._counters[key] = value
+        return value
+
+    def get(self, key):
+        """Return the counter stored under key, 0 if there's none."""
+        return self._counters.get(key, 0)
+
+    def counters(self, prefix=''):
+        """Return a dict of all counters whose key starts with prefix."""
+        with self._lock:
+            return {key: value for key, value in self._counters.items()
+                    if key.startswith(prefix)}
+
+
+class SQLiteBackend:
+    """Keep buckets and counters in a SQLite file shared by processes.
+
+    Every thread of every process opens its own connection.
+    Bucket updates run in an immediate transaction, so two workers
+    can't both take the last token of a bucket.
+
+    ---
+
+    Methods
+    -------
+    take(self, key, capacity, rate): return float
+        take a token from the bucket, return seconds to wait if empty
+    incr(self, key, amount): return int
+        increment a counter and return its new value
+    get(self, key): return int
+        return the value of a counter
+    counters(self, prefix): return dict
+        return all counters whose key starts with prefix
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = local()
+        self._swept = time.time()
+        with self._connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS bucket '
+                               '(key TEXT PRIMARY KEY, tokens REAL, '
+                               'updated REAL, full_at REAL)')
+            try:  # files made before buckets were swept
+                connection.execute('ALTER TABLE bucket ADD COLUMN '
+                                   'full_at REAL')
+            except sqlite3.OperationalError:
+                pass  # duplicate column
+            connection.execute('CREATE INDEX IF NOT EXISTS bucket_full_at '
+                               'ON bucket (full_at)')
+            connection.execute('CREATE TABLE IF NOT EXISTS counter '
+                               '(key TEXT PRIMARY KEY, value INTEGER)')
+
+    def _connect(self):
+        """Return the connection of the current thread and process."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def take(self, key, capacity, rate):
+        """Take a token from the bucket stored under key.
+
+        ---
+
+        Parameters
+        ----------
+        key: str
+            the key of the bucket, created full if it doesn't exist
+        capacity: float
+            the max number of tokens the bucket holds
+        rate: float
+            the number of tokens added back to the bucket per second
+
+        Returns
+        -------
+        0 if a token was taken, else the seconds until one is available
+        """
+
+        now = time.time()
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute(
+                'SELECT tokens, updated FROM bucket WHERE key = ?',
+                (key,)).fetchone()
+            tokens, updated = row if row else (capacity, now)
+            tokens = _refill(tokens, updated, capacity, rate, now)
+            taken = tokens >= 1
+            left = tokens - 1 if taken else tokens
+            connection.execute(
+                'INSERT OR REPLACE INTO bucket VALUES (?, ?, ?, ?)',
+                (key, left, now, _full_at(left, capacity, rate, now)))
+            if now - self._swept >= SWEEP_INTERVAL:
+                self._swept = now
+                # NULL for rows written before buckets were swept
+                connection.execute(
+                    'DELETE FROM bucket WHERE full_at <= ? OR '
+                    '(full_at IS NULL AND updated <= ?)', (now, now - 86400))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return 0 if taken else (1 - tokens) / rate
+
+    def incr(self, key, amount=1):
+        """Increment the counter stored under key, return its value."""
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute(
+                'INSERT OR IGNORE INTO counter VALUES (?, 0)', (key,))
+            connection.execute(
+                'UPDATE counter SET value = value + ? WHERE key = ?',
+                (amount, key))
+            value = connection.execute(
+                'SELECT value FROM counter WHERE key = ?',
+                (key,)).fetchone()[0]
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return value
+
+    def get(self, key):
+        """Return the counter stored under key, 0 if there's none."""
+        row = self._connect().execute(
+            'SELECT value FROM counter WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else 0
+
+    def counters(self, prefix=''):
+        """Return a dict of all counters whose key starts with prefix."""
+        rows = self._connect().execute(
+            'SELECT key, value FROM counter WHERE substr(key, 1, ?) = ?',
+            (len(prefix), prefix))
+        return dict(rows)
+
+
+class SharedStore:
+    """The flask extension which picks and exposes the store backend.
+
+    If SHARED_STORE_PATH is set, use a SQLiteBackend on that file.
+    Else, use a MemoryBackend, which is fine for a single process.
+
+    ---
+
+    Methods
+    -------
+    init_app(self, app): return None
+        create the backend for the app
+    take(self, key, capacity, rate): return float
+        take a token from the bucket, return seconds to wait if empty
+    incr(self, key, amount): return int
+        increment a counter and return its new value
+    get(self, key): return int
+        return the value of a counter
+    counters(self, prefix): return dict
+        return all counters whose key starts with prefix
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Create the backend, and store it on app.extensions."""
+        path = app.config.get('SHARED_STORE_PATH')
+        backend = SQLiteBackend(path) if path else MemoryBackend()
+        app.extensions['shared_store'] = backend
+
+    @property
+    def backend(self):
+        """The backend of the current application."""
+        return current_app.extensions['shared_store']
+
+    def take(self, key, capacity, rate):
+        return self.backend.take(key, capacity, rate)
+
+    def incr(self, key, amount=1):
+        return self.backend.incr(key, amount)
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def counters(self, prefix=''):
+        return self.backend.counters(prefix)
@@ -0,0 +1,259 @@
+"""A module used to suggest post titles and tags, while the user types.
+
+Suggestions must come back within a few milliseconds, for every pause
+in typing. Tags, and the latest post titles, are kept in prefix tries
+in the memory of the worker, rebuilt when the version of titles
+changes (bumped by title, date and tag changes, not by comments).
+Every node of a trie keeps its best entries, so a lookup only walks
+down the prefix. If elasticsearch is reachable, and the
+post index has the search-as-you-type field, titles are looked up
+there instead, which covers every post and matches inside titles.
+
+Lookups are cached for a short while, and coalesced: concurrent
+requests for the same prefix wait for a single lookup, instead of
+all hitting elasticsearch (or rebuilding the tries) at once.
+
+The client side contract (see static/js/suggest.js): wait for
+SUGGEST_DEBOUNCE_MS after the last keystroke, don't send prefixes
+shorter than SUGGEST_MIN_LENGTH, and drop the answers to stale
+prefixes. The responses can be cached by browsers and proxies.
+
+---
+
+Classes
+-------
+PrefixTrie
+    a prefix tree, whose nodes keep their best entries
+
+Functions
+---------
+normalize(text): return str
+    lowercase text and collapse its whitespace, for lookups
+suggest(prefix): return list(dict)
+    the titles and tags matching prefix, best first
+"""
+
+import re
+from threading import Event, Lock
+
+from flask import current_app, url_for
+
+from personal_blog import db, store
+from personal_blog.cache import suggestion_cache
+from personal_blog.models import Post, Tag
+
+WHITESPACE = re.compile(r'\s+')
+
+
+class PrefixTrie:
+    """A prefix tree, whose nodes keep their best entries.
+
+    Entries must be inserted best first. Every node on the path of a
+    key keeps the first size entries inserted under it, so find()
+    answers in the time it takes to walk down the prefix, however many
+    keys share it. Keys are cut to depth characters, which bounds the
+    size of the tree.
+
+    ---
+
+    Methods
+    -------
+    insert(self, key, entry): return None
+        add entry under key, and under every prefix of it
+    find(self, prefix): return list
+        the best entries of the keys starting with prefix
+    """
+
+    __slots__ = ('size', 'depth', '_root')
+
+    def __init__(self, size, depth):
+        self.size = size
+        self.depth = depth
+        self._root = ({}, [])
+
+    def insert(self, key, entry):
+        """Add entry under key, and under every prefix of it."""
+        children, entries = self._root
+        for char in key[:self.depth]:
+            node = children.get(char)
+            if node is None:
+                node = children[char] = ({}, [])
+            children, entries = node
+            if len(entries) < self.size and entry not in entries:
+                entries.append(entry)
+
+    def find(self, prefix):
+        """Return the best entries of the keys starting with prefix."""
+        node = self._root
+        for char in prefix[:self.depth]:
+            node = node[0].get(char)
+            if node is None:
+                return []
+        return node[1]
+
+
+class _Tries:
+    """The tries of a worker, and the version of titles they were built at."""
+
+    version = None
+    tags = None
+    titles = None
+    lock = Lock()
+
+
+_flights = {}
+_flights_lock = Lock()
+
+
+def _coalesced(key, compute):
+    """Return compute(), sharing a single call among concurrent callers.
+
+    The first caller of a key computes it, the others wait for its
+    result. If it fails, they compute it themselves.
+    """
+
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = [Event(), None]
+    if not leader:
+        flight[0].wait(1)
+        return flight[1] if flight[1] is not None else compute()
+    try:
+        flight[1] = compute()
+    finally:
+        with _flights_lock:
+            del _flights[key]
+        flight[0].set()
+    return flight[1]
+
+
+def normalize(text):
+    """Lowercase text and collapse its whitespace, for lookups."""
+    return WHITESPACE.sub(' ', text).strip().lower()
+
+
+def _build_tries(version):
+    """Build the tries of tags and of the latest titles.
+
+    Tags are ranked by their number of posts, titles by recency.
+    A title is found by the start of any of its words.
+    """
+
+    config = current_app.config
+    size, depth = config['SUGGEST_LIMIT'], config['SUGGEST_MAX_PREFIX']
+    tags = PrefixTrie(size, depth)
+    count = db.func.count(Tag.id)
+    for content, _ in db.session.query(Tag.content, count).group_by(
+            Tag.content).order_by(count.desc(), Tag.content):
+        tags.insert(normalize(content), content)
+    titles = PrefixTrie(size, depth)
+    for post_id, title in db.session.query(Post.id, Post.title).order_by(
+            Post.date_posted.desc(), Post.id.desc()).limit(
+            config['SUGGEST_TRIE_TITLES']):
+        words = normalize(title).split(' ')
+        for first in range(len(words)):
+            titles.insert(' '.join(words[first:]), (post_id, title))
+    _Tries.tags, _Tries.titles, _Tries.version = tags, titles, version
+
+
+def _tries(version):
+    """Return the tries, rebuilt first if titles or tags changed since.
+
+    A single thread rebuilds them, the others keep using the stale
+    tries meanwhile (unless there are none yet, then they wait).
+    """
+
+    if _Tries.version != version:
+        if _Tries.lock.acquire(blocking=_Tries.version is None):
+            try:
+                if _Tries.version != version:
+                    _build_tries(version)
+            finally:
+                _Tries.lock.release()
+    return _Tries.tags, _Tries.titles
+
+
+def _has_suggest_field(es):
+    """Return True if the post index has the search-as-you-type field.
+
+    It's missing from indexes built before it was added to the
+    mappings, until `flask reindex`. The answer is cached a minute.
+    """
+
+    cached = suggestion_cache.get('has_suggest_field')
+    if cached is None:
+        mappings = es.indices.get_field_mapping(fields='title.suggest',
+                                                index=Post.__tablename__)
+        cached = any(index['mappings'] for index in mappings.values())
+        suggestion_cache.set('has_suggest_field', cached, 60)
+    return cached
+
+
+def _search_titles(es, prefix, limit):
+    """Return the (id, title) of the posts whose title matches prefix."""
+    search = es.search(index=Post.__tablename__, body={
+        'size': limit, '_source': ['title'],
+        'query': {'multi_match': {
+            'query': prefix, 'type': 'bool_prefix',
+            'fields': ['title.suggest', 'title.suggest._2gram',
+                       'title.suggest._3gram']}}})
+    return [(int(hit['_id']), hit['_source']['title'])
+            for hit in search['hits']['hits']]
+
+
+def _lookup(prefix, version):
+    """Look up the tags and titles matching prefix."""
+    limit = current_app.config['SUGGEST_LIMIT']
+    tags, titles = _tries(version)
+    matching_tags = tags.find(prefix)[:max(limit // 3, 1)]
+    matching_titles = None
+    es = current_app.elasticsearch
+    if es:
+        from elasticsearch import TransportError
+        try:
+            if _has_suggest_field(es):
+                matching_titles = _search_titles(
+                    es, prefix, limit - len(matching_tags))
+        except TransportError:
+            current_app.logger.warning('Title suggestions fell back to '
+                                       'the trie', exc_info=True)
+    if matching_titles is None:
+        matching_titles = titles.find(prefix)[:limit - len(matching_tags)]
+    return ([{'kind': 'tag', 'text': tag,
+              'url': url_for('posts.posts_by_tag', tag_content=tag)}
+             for tag in matching_tags] +
+            [{'kind': 'post', 'text': title,
+              'url': url_for('posts.post', post_id=post_id)}
+             for post_id, title in matching_titles])
+
+
+def suggest(prefix):
+    """Return the titles and tags matching prefix, best first.
+
+    Tags come first, they take up to a third of SUGGEST_LIMIT.
+    Prefixes shorter than SUGGEST_MIN_LENGTH get no suggestions.
+
+    ---
+
+    Parameters
+    ----------
+    prefix: str
+        what the user typed so far
+
+    Returns
+    -------
+    list of dicts, with kind ('tag' or 'post'), text and url keys
+    """
+
+    config = current_app.config
+    prefix = normalize(prefix)[:config['SUGGEST_MAX_PREFIX']]
+    if len(prefix) < config['SUGGEST_MIN_LENGTH']:
+        return []
+    key = (store.get('version:titles'), prefix)
+    suggestions = suggestion_cache.get(key)
+    if suggestions is None:
+        suggestions = _coalesced(key, lambda: _lookup(prefix, key[0]))
+        suggestion_cache.set(key, suggestions, config['SUGGEST_TTL'])
+    return suggestions
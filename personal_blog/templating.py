@@ -0,0 +1,187 @@
+"""A module used to compile the Jinja templates ahead of requests.
+
+Jinja compiles a template to Python code the first time it's used,
+in every process. A fresh gunicorn worker compiles the layout, the
+navigation bar, the sidebar and the page on its first request, which
+shows up as a latency spike after every deploy and worker recycling.
+Compiled templates are kept in a bytecode cache on disk, shared by
+every worker on the host, and the templates can be compiled at boot,
+in the gunicorn master, before workers are forked off it.
+
+Rendered fragments are cached too: a {% cache key, version %} block
+is rendered once, and its HTML is reused by every page of the worker
+until the version changes (i.e. content_version('posts'), bumped by
+models.bump_post_versions()). Personalized pages still reuse the
+shared fragments, since only the blocks are cached, not the pages.
+
+---
+
+Classes
+-------
+AtomicBytecodeCache
+    a filesystem bytecode cache which workers can share safely
+FragmentCacheExtension
+    the Jinja extension of the {% cache key, version %} block
+
+Functions
+---------
+content_version(name): return int
+    the version counter of a kind of content, for templates
+init_templates(app): return None
+    set up the bytecode cache and the fragment cache of the app
+precompile_templates(app): return int
+    compile every template of the app, ahead of the first request
+"""
+
+import os
+import stat
+
+from flask import current_app
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+
+from personal_blog.cache import fragment_cache
+
+
+class AtomicBytecodeCache(FileSystemBytecodeCache):
+    """A filesystem bytecode cache which workers can share safely.
+
+    Jinja writes cache files in place, so a worker could read a file
+    another worker is still writing. Files are written under a temporary
+    name, then renamed, so they're always read whole.
+    """
+
+    def dump_bytecode(self, bucket):
+        """Write the bytecode of bucket to its cache file, atomically."""
+        filename = self._get_cache_filename(bucket)
+        temporary = f'{filename}.{os.getpid()}.tmp'
+        try:
+            with open(temporary, 'wb') as f:
+                bucket.write_bytecode(f)
+            os.replace(temporary, filename)
+        except BaseException:
+            try:
+                os.remove(temporary)
+            except OSError:
+                pass
+            raise
+
+
+class FragmentCacheExtension(Extension):
+    """The Jinja extension of the {% cache key, version %} block.
+
+    The key names the fragment, and must tell apart every variant of
+    it (i.e. 'post-body-' ~ post.id). The version is optional, the
+    fragment is rendered again when it changes. Fragments expire
+    after FRAGMENT_CACHE_TTL seconds, 0 disables the cache.
+    """
+
+    tags = {'cache'}
+
+    def parse(self, parser):
+        """Parse {% cache key[, version] %} ... {% endcache %}."""
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        if parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        else:
+            args.append(nodes.Const(None))
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render', args), [], [],
+                               body).set_lineno(lineno)
+
+    def _render(self, key, version, caller):
+        """Return the cached HTML of the fragment, or render it."""
+        ttl = current_app.config['FRAGMENT_CACHE_TTL']
+        if not ttl:
+            return caller()
+        cached = fragment_cache.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        html = caller()
+        fragment_cache.set(key, (version, html), ttl)
+        return html
+
+
+def content_version(name):
+    """Return the version counter of a kind of content, for templates.
+
+    ---
+
+    Parameters
+    ----------
+    name: str
+        the name of the counter, without the 'version:' prefix
+        (i.e. 'posts', 'post:3', 'books')
+
+    Returns
+    -------
+    int
+    """
+
+    from personal_blog import store
+    return store.get(f'version:{name}')
+
+
+def _private_folder(path):
+    """Create a folder only we can access, or check an existing one."""
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or \
+            hasattr(os, 'getuid') and info.st_uid != os.getuid():
+        raise RuntimeError(f'JINJA_CACHE_PATH {path} is not a folder owned '
+                           'by this user, set it to a private folder')
+    if stat.S_IMODE(info.st_mode) & 0o077:
+        os.chmod(path, 0o700)
+
+
+def init_templates(app):
+    """Set up the bytecode cache and the fragment cache of the app.
+
+    The bytecode cache is only used if JINJA_CACHE_PATH is set. Its
+    files are checked against the template sources, so an edited
+    template is compiled again. Whoever can write to the folder can
+    run code in the app, so it's created private (0700), and refused
+    if it's owned by another user, i.e. made first in a shared temp
+    dir.
+
+    ---
+
+    Parameters
+    ----------
+    app: Flask instance
+        the application
+    """
+
+    app.jinja_env.add_extension(FragmentCacheExtension)
+    app.jinja_env.globals['content_version'] = content_version
+    path = app.config.get('JINJA_CACHE_PATH')
+    if path:
+        _private_folder(path)
+        app.jinja_env.bytecode_cache = AtomicBytecodeCache(path)
+
+
+def precompile_templates(app):
+    """Compile every template of the app, ahead of the first request.
+
+    The templates under personal_blog/templates are loaded into the
+    environment's cache (and the bytecode cache, if there's one).
+    Called in the gunicorn master, the compiled templates are shared
+    by every worker forked off it.
+
+    ---
+
+    Parameters
+    ----------
+    app: Flask instance
+        the application
+
+    Returns
+    -------
+    int, the number of compiled templates
+    """
+
+    names = app.jinja_loader.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
@@ -22,7 +22,7 @@ from wtforms import StringField, PasswordField, SubmitField, BooleanField
 from wtforms.validators import DataRequired, Length, Email, EqualTo,\
     ValidationError
 from flask_login import current_user
-from personal_blog.models import User
+from personal_blog.users.utilities import is_taken
 
 
 class RegistrationForm(FlaskForm):
@@ -30,6 +30,9 @@ class RegistrationForm(FlaskForm):
 
     Inherit from FlaskForm base class.
     Create class variables, which are used as form fields and buttons.
+    Usernames and emails aren't checked for uniqueness here.
+    The register route inserts the user, and relies on the unique
+    constraints of the table, saving a query per field.
 
     ---
 
@@ -45,13 +48,6 @@ class RegistrationForm(FlaskForm):
         the user password confirm field, mandatory
     submit: SubmitField
         the form submit button
-
-    Methods
-    -------
-    validate_username(self, username): return None
-        raise ValidationError if the username already exists
-    validate_email(self, email): return None
-        raise ValidationError if the email already exists
     """
 
     username = StringField('Username', validators=[DataRequired(),
@@ -64,36 +60,6 @@ class RegistrationForm(FlaskForm):
                                                  EqualTo('password')])
     submit = SubmitField('Register')
 
-    def validate_username(self, username):
-        """Raise ValidationError if username is already registered.
-
-        ---
-
-        Parameters
-        ----------
-        username: str
-            the username of the current user being created
-        """
-
-        user = User.query.filter_by(username=username.data).first()
-        if user:
-            raise ValidationError('Username is already taken!')
-
-    def validate_email(self, email):
-        """Raise ValidationError if email is already registered.
-
-        ---
-
-        Parameters
-        ----------
-        email: str
-            the email of the current user being created
-        """
-
-        user = User.query.filter_by(email=email.data).first()
-        if user:
-            raise ValidationError('Email is already taken!')
-
 
 class LoginForm(FlaskForm):
     """The class used to build the login form.
@@ -159,8 +125,9 @@ class UpdateAccountForm(FlaskForm):
     def validate_username(self, username):
         """Raise ValidationError if username already exists.
 
-        If there's already a user with that username, and that user
-        is not the current user, raise a ValidationError.
+        If the username changed, and there's already a user with it,
+        raise a ValidationError. Use is_taken(), which only queries
+        the db when the in-memory filter says it's probably taken.
 
         ---
 
@@ -170,15 +137,16 @@ class UpdateAccountForm(FlaskForm):
             the user username to be validated
         """
 
-        user = User.query.filter_by(username=username.data).first()
-        if user and user.username != current_user.username:
+        if username.data != current_user.username and \
+                is_taken('username', username.data):
             raise ValidationError('Username is already taken!')
 
     def validate_email(self, email):
         """Raise ValidationError if email already exists.
 
-        If there's already a user with that email, and that user
-        is not the current user, raise a ValidationError.
+        If the email changed, and there's already a user with it,
+        raise a ValidationError. Use is_taken(), which only queries
+        the db when the in-memory filter says it's probably taken.
 
         ---
 
@@ -188,8 +156,8 @@ class UpdateAccountForm(FlaskForm):
             the user email to be validated
         """
 
-        user = User.query.filter_by(email=email.data).first()
-        if user and user.email != current_user.email:
+        if email.data != current_user.email and \
+                is_taken('email', email.data):
             raise ValidationError('Email is already taken!')
 
 
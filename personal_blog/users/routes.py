@@ -18,18 +18,23 @@ reset_request(): return http response
    the route for requesting a password reset
 reset_token(): return http response
     the route for resetting the password
+availability(): return json response
+    the route for checking if a username/email is still free
 """
 
 from flask import Blueprint, render_template, url_for, flash, redirect,\
-        request, current_app, session
+        request, current_app, session, jsonify, abort
 from flask_login import login_user, current_user, logout_user, login_required
+from sqlalchemy.exc import IntegrityError
 
-from personal_blog import db, bcrypt
-from personal_blog.models import User
+from personal_blog import db
+from personal_blog.models import User, Post, Comment, invalidate_user
 from personal_blog.users.forms import RegistrationForm, LoginForm,\
     UpdateAccountForm, RequestResetForm, ResetPasswordForm
 from personal_blog.users.utilities import save_profile_picture,\
-        delete_old_profile_picture, send_reset_email
+        delete_old_profile_picture, send_reset_email, hash_password,\
+        check_password, password_needs_rehash, throttle, is_taken,\
+        add_taken_errors
 
 users = Blueprint('users', __name__)
 
@@ -40,8 +45,12 @@ def register():
 
     If the current user is already authenticated, redirect home.
     If the form validates, create the new user and commit to db.
-    Hash the passsword first. Set the is_admin property to yes
-    if no other user has it on (there can be only 1 admin).
+    Hash the passsword first, via the bcrypt process pool.
+    Set the is_admin property to yes if no other user has it on
+    (there can be only 1 admin).
+    The username/email uniqueness is left to the db constraints.
+    If the insert violates one, roll back, set the field errors,
+    and render the template again.
     Flash the message, and redirect to the login route.
     If the form doesn't validate, simply render the template.
 
@@ -56,15 +65,21 @@ def register():
         return redirect(url_for('main.home'))
     form = RegistrationForm()
     if form.validate_on_submit():
-        passwd = form.password.data
-        hashed_passwd = bcrypt.generate_password_hash(passwd).decode('utf-8')
+        hashed_passwd = hash_password(form.password.data)
         user = User()
         user.username = form.username.data
         user.email = form.email.data
         user.password = hashed_passwd
         user.is_admin = 0 if User.query.filter_by(is_admin=1).first() else 1
         db.session.add(user)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError as error:
+            db.session.rollback()
+            if not add_taken_errors(form, error):
+                raise
+            return render_template('users/register.html', title='Register',
+                                   form=form, hide_sidebar=True)
         flash(f'Account {form.username.data} has been registered. '
               'You can proceed with the login.', 'success')
         return redirect(url_for('users.login'))
@@ -77,9 +92,13 @@ def login():
     """The route for logging a user in.
 
     If the user is already authenticated, redirect home.
-    If the form validates, and the credentials match a
-    user in the db, log the user in. Set the session to
-    permanent, in order for timeouts to work.
+    If the form validates, take a rate limit token for the client
+    ip and for the account, before anything else (a 429 is raised
+    if either is used up). If the credentials match a
+    user in the db, log the user in. If the stored hash was
+    made with an outdated cost factor, rehash the password
+    and commit to db. Set the session to permanent, in
+    order for timeouts to work.
     Get the next page url parameter from the request object.
     If there is a next page, redirect to it. Else, to home.
     If the form validates, but credentials dont match,
@@ -97,9 +116,13 @@ def login():
         return redirect(url_for('main.home'))
     form = LoginForm()
     if form.validate_on_submit():
+        throttle('login_ip', request.remote_addr)
+        throttle('login_account', form.email.data.lower())
         user = User.query.filter_by(email=form.email.data).first()
-        if user and bcrypt.check_password_hash(user.password,
-                                               form.password.data):
+        if user and check_password(user.password, form.password.data):
+            if password_needs_rehash(user.password):
+                user.password = hash_password(form.password.data)
+                db.session.commit()
             session.permanent = True
             login_user(user, remember=form.remember.data)
             next_page = request.args.get('next')  # url parameter
@@ -135,10 +158,14 @@ def logout():
 def account():
     """The route for displaying/editing a user account profile.
 
-    If the form validates, update the current user.
-    If there was an update of profile picture, delete the old
-    one from the filesystem, and store the new one.
-    Commit to db, flash the message, and redirect to this route.
+    If the form validates, query and update the current user
+    (current_user is a read-only snapshot).
+    If there was an update of profile picture, store the new one.
+    Commit to db, delete the old picture from the filesystem,
+    invalidate the cached user, flash the message, and redirect to
+    this route. If the commit violates the unique constraints (a name
+    taken since validation), delete the new picture instead, set the
+    field errors and render the template.
     If the form doesn't validate and request is GET, simply
     preload the account form with data, and render the template.
 
@@ -151,17 +178,31 @@ def account():
 
     form = UpdateAccountForm()
     if form.validate_on_submit():
+        user = User.query.get(current_user.id)
+        old_profile_pic = profile_pic_file = None
         if form.profile_pic.data:
-            delete_old_profile_picture(current_user.profile_pic,
-                                       current_app.root_path)
+            old_profile_pic = user.profile_pic
             profile_pic_file = save_profile_picture(form.profile_pic.data,
                                                     current_app.root_path)
-            current_user.profile_pic = profile_pic_file
-        current_user.username = form.username.data
-        current_user.email = form.email.data
-        db.session.commit()
-        flash('Profile has been updated', 'success')
-        return redirect(url_for('users.account'))
+            user.profile_pic = profile_pic_file
+        user.username = form.username.data
+        user.email = form.email.data
+        try:
+            db.session.commit()
+        except IntegrityError as error:  # lost a race for the name
+            db.session.rollback()
+            if profile_pic_file:
+                delete_old_profile_picture(profile_pic_file,
+                                           current_app.root_path)
+            if not add_taken_errors(form, error):
+                raise
+        else:
+            if old_profile_pic:
+                delete_old_profile_picture(old_profile_pic,
+                                           current_app.root_path)
+            invalidate_user(user.id)
+            flash('Profile has been updated', 'success')
+            return redirect(url_for('users.account'))
     elif request.method == 'GET':
         form.username.data = current_user.username
         form.email.data = current_user.email
@@ -180,9 +221,11 @@ def deactivate_account():
 
     If the current user is admin, do not allow the deactivation.
     Flash the message, and redirect to that user's account.
-    Else, delete the current user, commit to db, delete their
-    profile picture from the filesystem, flash the message, and
-    redirect to the logout route.
+    Else, delete the current user (and their comments, on cascade),
+    recount the comments of the posts they commented on, commit to
+    db, invalidate the cached user, delete their profile picture
+    from the filesystem, flash the message, and redirect to the
+    logout route.
 
     ---
 
@@ -194,9 +237,14 @@ def deactivate_account():
     if current_user.is_admin:
         flash('Admin account cannot be deactivated', 'danger')
         return redirect(url_for('users.account'))
-    filename = current_user.profile_pic
-    db.session.delete(current_user)
+    user = User.query.get(current_user.id)
+    filename = user.profile_pic
+    post_ids = [post_id for post_id, in db.session.query(
+        Comment.post_id).filter_by(user_id=user.id).distinct()]
+    db.session.delete(user)
+    Post.refresh_comment_stats(post_ids)
     db.session.commit()
+    invalidate_user(user.id)
     delete_old_profile_picture(filename, root_path=current_app.root_path)
     flash('Your account has been deactivated!', 'success')
     return redirect(url_for('users.logout'))
@@ -207,7 +255,9 @@ def reset_request():
     """The route for requesting a password reset.
 
     If the current user is authenticated, redirect home.
-    If the form validates, get the user with that email.
+    If the form validates, take a rate limit token for the client
+    ip and for the email (a 429 is raised if either is used up).
+    Then, get the user with that email.
     If the user exists, send the reset email. But flash
     the message anyway as a security best practice, and
     redirect to the login route.
@@ -221,9 +271,11 @@ def reset_request():
     """
 
     if current_user.is_authenticated:
-        return redirect(url_for('users.home'))
+        return redirect(url_for('main.home'))
     form = RequestResetForm()
     if form.validate_on_submit():
+        throttle('reset_ip', request.remote_addr)
+        throttle('reset_account', form.email.data.lower())
         user = User.query.filter_by(email=form.email.data).first()
         if user:
             send_reset_email(user)
@@ -241,8 +293,8 @@ def reset_token(token):
     If the current user is authenticated, redirect home.
     If the token isn't valid, flash the message and
     redirect to the reset_request route.
-    If the form validates, get the new password, hash its
-    value and update the user with it.
+    If the form validates, get the new password, hash its value
+    via the bcrypt process pool and update the user with it.
     Commit to db, flash the message and redirect to login.
     If the form doesn't validate, simply render the template.
 
@@ -254,19 +306,47 @@ def reset_token(token):
     """
 
     if current_user.is_authenticated:
-        return redirect(url_for('users.home'))
+        return redirect(url_for('main.home'))
     user = User.verify_reset_token(token)
     if not user:
         flash('Invalid/expired token', 'warning')
         return redirect(url_for('users.reset_request'))
     form = ResetPasswordForm()
     if form.validate_on_submit():
-        passwd = form.password.data
-        hashed_passwd = bcrypt.generate_password_hash(passwd).decode('utf-8')
-        user.password = hashed_passwd
+        user.password = hash_password(form.password.data)
         db.session.commit()
         flash('Your password has been updated. '
               'You can proceed with the login.', 'success')
         return redirect(url_for('users.login'))
     return render_template('users/reset_token.html', title='Reset Password',
                            form=form)
+
+
+@users.route('/register/available')
+def availability():
+    """The route for checking if a username/email is still free.
+
+    Used by the register and account pages, while the user types.
+    Expects either a username or an email url parameter.
+    Take a rate limit token for the client ip, so the route can't be
+    used to cheaply enumerate registered emails.
+    The current user's own username/email counts as available.
+    Otherwise, ask is_taken(), which answers most checks from an
+    in-memory filter and falls back to the db on probable hits.
+
+    ---
+
+    Returns
+    -------
+    json response, with field, value and available keys
+    """
+
+    field = 'username' if 'username' in request.args else 'email'
+    value = request.args.get(field)
+    if not value:
+        abort(400)
+    throttle('availability_ip', request.remote_addr)
+    available = (current_user.is_authenticated and
+                 getattr(current_user, field) == value) or \
+        not is_taken(field, value)
+    return jsonify(field=field, value=value, available=available)
@@ -11,17 +11,49 @@ delete_old_profile_picture(filename, root_path): return None
     from the filesystem
 send_reset_email(user): return None
     the function used to send a password reset email
+hash_password(password): return str
+    hash a password through the bcrypt process pool
+check_password(hashed_password, password): return bool
+    verify a password through the bcrypt process pool
+password_needs_rehash(hashed_password): return bool
+    check if a hash was made with a different cost factor
+benchmark_bcrypt(target_ms): return int, list
+    pick the highest cost factor that stays within a target latency
+throttle(scope, key): return None
+    take a token from a rate limit bucket, raise Throttled if empty
+throttle_counters(): return dict
+    the number of rejected requests, per rate limit scope
+is_taken(field, value): return bool
+    check if a username/email is registered, filter first, db second
+add_taken_errors(form, error): return bool
+    turn a unique constraint violation into form field errors
+
+Classes
+-------
+Throttled: child of werkzeug's TooManyRequests
+    the exception raised when a rate limit bucket is empty
 """
 
+import math
+import multiprocessing
 import os
+import re
 import secrets
-from threading import Thread
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
+from threading import BoundedSemaphore, Lock, Thread
 
-from PIL import Image
-from flask_mail import Message
 from flask import url_for, current_app
+from werkzeug.exceptions import TooManyRequests
 
-from personal_blog import mail
+from personal_blog import db, mail, store
+from personal_blog.cache import BloomFilter
+from personal_blog.metrics import registry, tracked
+from personal_blog.models import User
+
+UNIQUE_FAILED = re.compile(r'UNIQUE constraint failed: ([\w., ]+)')
+DUPLICATE_KEY = re.compile(r"for key '([\w.]+)'")
 
 
 def save_profile_picture(profile_pic, root_path):
@@ -52,11 +84,13 @@ def save_profile_picture(profile_pic, root_path):
     filename = random_hex + f_ext
     filepath = os.path.join(root_path, 'static/profile_pics', filename)
 
-    file_dimensions = (125, 125)
-    image = Image.open(profile_pic)
-    image.thumbnail(file_dimensions)
+    from PIL import Image  # heavy, and only needed here
 
-    image.save(filepath)
+    file_dimensions = (125, 125)
+    with tracked('image_queue_depth'):
+        image = Image.open(profile_pic)
+        image.thumbnail(file_dimensions)
+        image.save(filepath)
     return filename
 
 
@@ -87,6 +121,8 @@ def delete_old_profile_picture(filename, root_path):
 def send_async_email(app, msg):
     """Helper function for send_reset_email()'s threads.
 
+    The message leaves the mail queue of the metrics once it's sent.
+
     ---
 
     Parameters
@@ -97,8 +133,11 @@ def send_async_email(app, msg):
         the message to be sent via email
     """
 
-    with app.app_context():
-        mail.send(msg)
+    try:
+        with app.app_context():
+            mail.send(msg)
+    finally:
+        registry.inc('mail_queue_depth', -1)
 
 
 def send_reset_email(user):
@@ -118,6 +157,8 @@ def send_reset_email(user):
         the user to whom the email should be sent
     """
 
+    from flask_mail import Message
+
     token = user.get_reset_token()
     msg = Message('Password Reset Request', sender='admin@blog.com',
                   recipients=[user.email])
@@ -126,5 +167,418 @@ def send_reset_email(user):
 
 If you did not make this request, simply ignore this email.
     '''
+    registry.inc('mail_queue_depth')  # queued until the thread sends it
     Thread(target=send_async_email,
            args=(current_app._get_current_object(), msg)).start()
+
+
+_pool = None
+_pool_pid = None
+_pool_slots = None
+_pool_lock = Lock()
+
+
+def _hash(password, rounds):
+    """Hash the password with a fresh salt, runs in the pool."""
+    import bcrypt
+    salt = bcrypt.gensalt(rounds=rounds)
+    return bcrypt.hashpw(password.encode('utf-8'), salt).decode('utf-8')
+
+
+def _check(hashed_password, password):
+    """Compare the password against the hash, runs in the pool."""
+    import bcrypt
+    try:
+        return bcrypt.checkpw(password.encode('utf-8'),
+                              hashed_password.encode('utf-8'))
+    except ValueError:  # not a bcrypt hash, it can't match anything
+        return False
+
+
+def _get_pool(size, backlog):
+    """Return the process pool of this worker, and its job slots.
+
+    The pool is created lazily, on the first hashing request.
+    It's also recreated if the current process isn't the one that
+    created it, since gunicorn forks workers off a master process.
+    Processes are started with forkserver (or spawn), because forking
+    a process which runs request threads is not safe.
+    The slots semaphore bounds the number of running plus queued jobs.
+
+    ---
+
+    Parameters
+    ----------
+    size: int
+        the number of processes in the pool
+    backlog: int
+        the number of jobs allowed to wait for a free process
+
+    Returns
+    -------
+    the pool: ProcessPoolExecutor instance
+    the slots: BoundedSemaphore instance
+    """
+
+    global _pool, _pool_pid, _pool_slots
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            methods = multiprocessing.get_all_start_methods()
+            method = 'forkserver' if 'forkserver' in methods else 'spawn'
+            _pool = ProcessPoolExecutor(
+                max_workers=size,
+                mp_context=multiprocessing.get_context(method))
+            _pool_pid = os.getpid()
+            _pool_slots = BoundedSemaphore(size + backlog)
+        return _pool, _pool_slots
+
+
+def _run(func, *args):
+    """Run func in the bcrypt process pool, or inline if disabled.
+
+    Bcrypt is deliberately slow, and it holds the request thread for
+    its whole cost. Running it in a bounded pool caps the number of
+    cores spent on hashing, no matter how many logins come in at once.
+
+    ---
+
+    Parameters
+    ----------
+    func: function
+        the module level function to be run
+    args: tuple
+        the arguments passed to func
+
+    Returns
+    -------
+    the return value of func
+    """
+
+    size = current_app.config['BCRYPT_POOL_SIZE']
+    if not size:
+        return func(*args)
+    pool, slots = _get_pool(size, current_app.config['BCRYPT_POOL_BACKLOG'])
+    with slots:
+        return pool.submit(func, *args).result()
+
+
+def hash_password(password):
+    """Hash the password with the configured cost factor.
+
+    ---
+
+    Parameters
+    ----------
+    password: str
+        the plain text password
+
+    Returns
+    -------
+    the hashed password: str
+    """
+
+    return _run(_hash, password, current_app.config['BCRYPT_LOG_ROUNDS'])
+
+
+def check_password(hashed_password, password):
+    """Check if the password matches the stored hash.
+
+    ---
+
+    Parameters
+    ----------
+    hashed_password: str
+        the hash stored for the user
+    password: str
+        the plain text password to be verified
+
+    Returns
+    -------
+    True if they match, else False
+    """
+
+    return _run(_check, hashed_password, password)
+
+
+def password_needs_rehash(hashed_password):
+    """Check if the hash was made with a different cost factor.
+
+    A bcrypt hash looks like $2b$12$<salt and checksum>, where
+    the second field is the cost it was made with.
+
+    ---
+
+    Parameters
+    ----------
+    hashed_password: str
+        the hash stored for the user
+
+    Returns
+    -------
+    True if the cost differs from BCRYPT_LOG_ROUNDS, else False
+    """
+
+    try:
+        rounds = int(hashed_password.split('$')[2])
+    except (IndexError, ValueError):
+        return True
+    return rounds != current_app.config['BCRYPT_LOG_ROUNDS']
+
+
+def benchmark_bcrypt(target_ms, samples=3):
+    """Pick the highest cost factor that stays within a target latency.
+
+    Time hashing for increasing cost factors, starting from the
+    minimum (4). Each step doubles the cost, so stop as soon as the
+    median time goes over the target.
+
+    ---
+
+    Parameters
+    ----------
+    target_ms: float
+        the time, in milliseconds, a single hash should take at most
+    samples: int
+        the number of hashes timed for every cost factor
+
+    Returns
+    -------
+    the chosen cost: int
+        4 if even the minimum cost is over the target
+    the timings: list of (int, float) tuples
+        cost factor and median milliseconds, for every cost tried
+    """
+
+    timings = []
+    chosen = 4
+    for rounds in range(4, 32):
+        times = []
+        for _ in range(samples):
+            start = time.perf_counter()
+            _hash('benchmark-password', rounds)
+            times.append((time.perf_counter() - start) * 1000)
+        median = sorted(times)[len(times) // 2]
+        timings.append((rounds, median))
+        if median > target_ms:
+            break
+        chosen = rounds
+    return chosen, timings
+
+
+class Throttled(TooManyRequests):
+    """The exception raised when a rate limit bucket is empty.
+
+    Inherit from werkzeug's TooManyRequests, so it's a 429 response.
+
+    ---
+
+    Attributes
+    ----------
+    retry_after: int
+        seconds after which the client may try again
+    """
+
+    def __init__(self, retry_after):
+        super().__init__()
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+def throttle(scope, key):
+    """Take a token from a rate limit bucket, raise Throttled if empty.
+
+    The bucket size and refill time come from the THROTTLE_<SCOPE>
+    config value, i.e. (5, 300) allows a burst of 5 attempts and
+    gives one back every 60 seconds.
+    Buckets live in the shared store, so limits hold across workers.
+    Every rejection increments a counter in the store too, so they
+    can be monitored and alerted on.
+
+    ---
+
+    Parameters
+    ----------
+    scope: str
+        the name of the limit, i.e. 'login_ip'
+    key: str
+        what the limit is applied to, i.e. the client ip address
+    """
+
+    if not current_app.config['THROTTLE_ENABLED']:
+        return
+    capacity, period = current_app.config['THROTTLE_' + scope.upper()]
+    retry_after = store.take(f'throttle:{scope}:{key}', capacity,
+                             capacity / period)
+    if retry_after:
+        store.incr(f'throttle_rejected:{scope}')
+        current_app.logger.warning('Throttled %s for %s', scope, key)
+        raise Throttled(retry_after)
+
+
+def throttle_counters():
+    """Return the number of rejected requests, per rate limit scope."""
+    prefix = 'throttle_rejected:'
+    return {key[len(prefix):]: value
+            for key, value in store.counters(prefix).items()}
+
+
+_taken = None
+_taken_version = None
+_taken_lock = Lock()
+
+
+def _taken_filters():
+    """Return this worker's filters of registered usernames and emails.
+
+    Build them on first use, with a single query which streams just
+    the two columns. Rebuild them when the users version in the shared
+    store has moved on, since another worker registered/renamed a user,
+    or when they're over capacity.
+
+    ---
+
+    Returns
+    -------
+    dict with 'username' and 'email' keys, and BloomFilter values
+    """
+
+    global _taken, _taken_version
+    version = store.get('version:users')
+    with _taken_lock:
+        if _taken is None or _taken_version != version or \
+                _taken['username'].count > _taken['username'].capacity:
+            capacity = 2 * User.query.count()
+            filters = {'username': BloomFilter(capacity),
+                       'email': BloomFilter(capacity)}
+            rows = db.session.query(User.username, User.email)
+            for username, email in rows.yield_per(1000):
+                filters['username'].add(username)
+                filters['email'].add(email)
+            _taken, _taken_version = filters, version
+        return _taken
+
+
+def _collect_taken(session, flush_context):
+    """Remember the names of users inserted/renamed by a flush."""
+    for obj in chain(session.new, session.dirty):
+        if not isinstance(obj, User):
+            continue
+        state = db.inspect(obj)
+        if obj in session.new or \
+                state.attrs.username.history.has_changes() or \
+                state.attrs.email.history.has_changes():
+            session.info.setdefault('taken', []).append(
+                (obj.username, obj.email))
+
+
+def _add_taken(session):
+    """Add the names of the commited users to the filters.
+
+    Bump the users version, so other workers rebuild their filters.
+    If this worker's filters were up to date, add the names to them
+    instead of rebuilding.
+    """
+
+    global _taken_version
+    taken = session.info.pop('taken', None)
+    if not taken:
+        return
+    version = store.incr('version:users')
+    with _taken_lock:
+        if _taken is not None and _taken_version == version - 1:
+            for username, email in taken:
+                _taken['username'].add(username)
+                _taken['email'].add(email)
+            _taken_version = version
+
+
+def _forget_taken(session):
+    """Drop the names collected by a rolled back transaction."""
+    session.info.pop('taken', None)
+
+
+db.event.listen(db.session, 'after_flush', _collect_taken)
+db.event.listen(db.session, 'after_commit', _add_taken)
+db.event.listen(db.session, 'after_rollback', _forget_taken)
+
+
+def is_taken(field, value):
+    """Check if a username/email is registered, filter first, db second.
+
+    Most checks are for free names, which the filter answers without
+    a query. Only when the filter says it probably is taken, ask the db.
+
+    ---
+
+    Parameters
+    ----------
+    field: str
+        either 'username' or 'email'
+    value: str
+        the username/email to be checked
+
+    Returns
+    -------
+    True if a user has it, else False
+    """
+
+    if value not in _taken_filters()[field]:
+        return False
+    column = getattr(User, field)
+    return db.session.query(User.id).filter(column == value).first() \
+        is not None
+
+
+def _violated_columns(orig):
+    """Return the names of the columns a unique constraint violation is on.
+
+    Postgres names the violated constraint in the diagnostics of the
+    error (user_email_key, ix_user_username), SQLite lists the columns
+    (UNIQUE constraint failed: user.email), MySQL names the key
+    (for key 'user.username'). Values are never looked at, since a
+    username can very well contain 'email'.
+    """
+
+    diag = getattr(orig, 'diag', None)
+    if diag is not None and (diag.column_name or diag.constraint_name):
+        if diag.column_name:
+            return {diag.column_name}
+        return set(diag.constraint_name.split('_'))
+    message = str(orig)
+    match = UNIQUE_FAILED.search(message)
+    if match:
+        return {column.strip().rpartition('.')[2]
+                for column in match.group(1).split(',')}
+    match = DUPLICATE_KEY.search(message)
+    if match:
+        return set(match.group(1).rpartition('.')[2].split('_'))
+    return set()
+
+
+def add_taken_errors(form, error):
+    """Turn a unique constraint violation into form field errors.
+
+    The field is found from the name of the violated constraint or
+    column, as reported by the db (see _violated_columns).
+
+    ---
+
+    Parameters
+    ----------
+    form: FlaskForm instance
+        a form with username and email fields
+    error: IntegrityError instance
+        the error raised by the commit
+
+    Returns
+    -------
+    True if the error was about username/email, else False
+    """
+
+    columns = _violated_columns(error.orig)
+    found = False
+    for field in ('username', 'email'):
+        if field in columns:
+            form[field].errors.append(
+                f'{field.capitalize()} is already taken!')
+            found = True
+    return found
@@ -0,0 +1,25 @@
+"""
+A module used to serve the application in production
+
+---
+
+Examples
+--------
+    Change directory to the app's top level directory, and hit:
+
+        $ gunicorn -c gunicorn_config.py
+
+    which serves this module's app. Point FLASK_APP to this module,
+    so that the flask commands (i.e. `flask db upgrade`) run with the
+    same configuration as the served app.
+
+Attributes
+----------
+app : FlaskApp
+    the application instance, created with ProductionConfig
+"""
+
+from personal_blog import create_app
+from personal_blog.config import ProductionConfig
+
+app = create_app(ProductionConfig)